@@ -19,7 +19,6 @@ from flask_jwt_extended import JWTManager
 from decouple import config as sys_config
 from config import IMAGE_UPLOAD_CONFIG
 from dotenv import load_dotenv
-from app.search import PropertyDataMapping
 
 load_dotenv()
 
@@ -80,7 +79,21 @@ def init_celery(flask_app):
                 "task": "app.tasks.delete_user_account",
                 "schedule": crontab(minute=0, hour='*/3'),  # execute every three hours
                 "args": (accounts_data_schema.dump(queried_data),),
-            }
+            },
+            # The outbox is drained after every commit that changes a listing; this catches up on the drains that
+            # couldn't be queued or ran out of retries.
+            "drain_search_outbox": {
+                "task": "app.tasks.drain_search_outbox",
+                "schedule": crontab(),  # execute every minute
+            },
+            "check_search_index_drift": {
+                "task": "app.tasks.check_search_index_drift",
+                "schedule": crontab(minute=30, hour="*/6"),  # execute every six hours
+            },
+            "remove_expired_staged_uploads": {
+                "task": "app.tasks.remove_expired_staged_uploads",
+                "schedule": crontab(minute=15),  # execute every hour
+            },
         },
     )
 
@@ -108,11 +121,19 @@ def register_blueprints(app):
         app.register_blueprint(module.blueprint)
 
 
+def register_commands(app):
+    module = import_module("app.commands")
+    for command in module.commands:
+        app.cli.add_command(command)
+
+
 def configure_database(app):
+    from app.search import init_index
+
     @app.before_first_request
     def initialize_database_and_index_data():
         db.create_all()
-        PropertyDataMapping.init()  # Create the index and mappings in ElasticSearch
+        init_index()  # Create the search index, see app.search.SearchBackend.init()
 
     @app.teardown_request
     def shutdown_session(exception=None):
@@ -130,7 +151,6 @@ def create_image_upload_directories():
         "cover_image_upload_dir": IMAGE_UPLOAD_CONFIG["IMAGE_SAVE_DIRECTORIES"][
             "USER_COVER_IMAGES"
         ],
-        "temp_image_dir": IMAGE_UPLOAD_CONFIG["IMAGE_SAVE_DIRECTORIES"]["TEMP_DIR"],
         "property_listing_images_dir": IMAGE_UPLOAD_CONFIG["IMAGE_SAVE_DIRECTORIES"][
             "PROPERTY_LISTING_IMAGES"
         ],
@@ -148,5 +168,6 @@ def create_app(config):
     app.celery = init_celery(app)
     app.app_context().push()
     register_blueprints(app)
+    register_commands(app)
     create_image_upload_directories()
     return app, app.celery
@@ -1,10 +1,67 @@
 import os
+import re
+import json
+from decimal import Decimal, InvalidOperation
 from decouple import config
 from datetime import datetime
+from flask import current_app
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash
-from app import db, login_manager
-from app.search import add_to_index, delete_from_index, search_docs
+from sqlalchemy.orm import make_transient_to_detached, object_session
+from app import db, login_manager, redis_client
+from app.geocoding import geocode
+from app.clustering import invalidate_listing_coordinates
+from app.search import (
+    reindex_listings,
+    search_docs,
+    search_result,
+    property_document,
+    SEARCH_OUTBOX_BATCH_SIZE,
+    SEARCH_OUTBOX_STATS_KEY,
+)
+from app.cache import (
+    cached,
+    purge_surrogate_keys,
+    listing_surrogate_key,
+    FEED_SURROGATE_KEY,
+    LISTING_CACHE_TTL,
+    LISTING_CACHE_VERSION,
+    USER_CACHE_TTL,
+)
+
+# A number written with thousands separators e.g "2,500", "1 200 000.50", optionally followed by a multiplier
+PRICE_NUMBER = r"((?:\d{1,3}(?:[, ]\d{3})+|\d+)(?:\.\d+)?)\s*(k|m|thousand|million)?\b"
+PRICE_RE = re.compile(PRICE_NUMBER, re.IGNORECASE)
+# Prefer the number written after a currency e.g the "2,500" in "3 bedroomed house, K2,500 per month"
+CURRENCY_PRICE_RE = re.compile(r"(?:zmw|zk|k|\$)\s*" + PRICE_NUMBER, re.IGNORECASE)
+PRICE_MULTIPLIERS = {"k": 1000, "thousand": 1000, "m": 1000000, "million": 1000000}
+# Amounts from here on don't fit in Property.price_amount, a Numeric(12, 2)
+PRICE_AMOUNT_LIMIT = 10 ** 10
+
+
+def parse_price(price):
+    """
+    Extracts the amount from the free text price of a listing e.g "K2,500" -> Decimal("2500"),
+    "ZMW 1.2m" -> Decimal("1200000"). Returns None if the price doesn't hold an amount e.g "Negotiable", or holds one
+    too large for Property.price_amount e.g a phone number.
+    """
+    match = CURRENCY_PRICE_RE.search(price or "") or PRICE_RE.search(price or "")
+    if match is None:
+        return None
+    number, multiplier = match.groups()
+    try:
+        amount = Decimal(re.sub(r"[, ]", "", number))
+    except InvalidOperation:
+        return None
+    if multiplier:
+        amount *= PRICE_MULTIPLIERS[multiplier.lower()]
+    try:
+        amount = amount.quantize(Decimal("0.01"))
+    except InvalidOperation:  # more digits than the decimal context holds
+        return None
+    if amount >= PRICE_AMOUNT_LIMIT:  # e.g a phone number rather than a price
+        return None
+    return amount
 
 
 class User(db.Model, UserMixin):
@@ -29,6 +86,9 @@ class User(db.Model, UserMixin):
         db.String(100), nullable=True
     )  # specifies the server hosting the image
     date_registered = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
     is_verified = db.Column(db.Boolean, nullable=False, default=False)
     date_verified = db.Column(db.DateTime, nullable=True)
     username = db.Column(db.String, unique=True, nullable=False)
@@ -39,6 +99,8 @@ class User(db.Model, UserMixin):
     user_property_listings = db.relationship(
         "Property", backref="property_listing_owner", lazy=True
     )
+    # Columns that cached_principal() leaves out
+    UNCACHED_COLUMNS = ("password",)
 
     def __init__(self, **kwargs):
         for key, value in kwargs.items():
@@ -52,6 +114,36 @@ class User(db.Model, UserMixin):
     def __repr__(self):
         return str(f"User <{self.username}")
 
+    @classmethod
+    @cached("user", ttl=USER_CACHE_TTL)
+    def cached_principal(cls, user_id):
+        """
+        Returns the column values of a user as a dictionary that can be cached, or None if the user doesn't exist.
+        The password hash is left out, so it is never copied to redis or the memory of the workers. The cache entry
+        is invalidated whenever the user row is updated or deleted, see invalidate_user_principals().
+        """
+        user = cls.query.get(user_id)
+        if user is None:
+            return None
+        return {
+            column.key: getattr(user, column.key)
+            for column in cls.__mapper__.column_attrs
+            if column.key not in cls.UNCACHED_COLUMNS
+        }
+
+    @classmethod
+    def from_cached_principal(cls, user_data):
+        """
+        Rebuilds a User from the dictionary returned by cached_principal() and attaches it to the session without
+        querying the database, so that changes made to it (e.g on the profile page) are saved on commit as usual.
+        The columns left out of the cache are loaded from the database when they are first accessed.
+        """
+        user = cls.__mapper__.class_manager.new_instance()
+        for key, value in user_data.items():
+            setattr(user, key, value)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
 
 class Property(db.Model):
     __tablename__ = "property"
@@ -60,8 +152,15 @@ class Property(db.Model):
     name = db.Column(db.Text, nullable=False)
     desc = db.Column(db.Text, nullable=False)
     date_listed = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
-    price = db.Column(db.String, nullable=False)
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+    price = db.Column(db.String, nullable=False)  # as entered by the user e.g "K2,500" or "Negotiable"
+    price_amount = db.Column(db.Numeric(12, 2), nullable=True)  # parsed from price, see parse_price()
     location = db.Column(db.Text, nullable=False)
+    # Coordinates of the location, see app.geocoding.geocode(). None if the location is not a known place
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
     images_folder = db.Column(db.Text, nullable=True)
     photos = db.Column(db.Text, nullable=False)
     photos_location = db.Column(
@@ -72,38 +171,139 @@ class Property(db.Model):
     deal_done = db.Column(db.Boolean, default=False)
     user_id = db.Column(db.ForeignKey("User.id"), nullable=False)
     owner = db.relationship("User")
+    property_photos = db.relationship(
+        "PropertyPhoto",
+        order_by="PropertyPhoto.position",
+        cascade="all, delete-orphan",
+        lazy=True,
+    )
+
+    __table_args__ = (
+        # Backs the keyset pagination of the listings feed, see Property.listings_feed()
+        db.Index("ix_property_date_listed_id", "date_listed", "id"),
+    )
 
     def __repr__(self):
         return str(f"Property Listing <{self.name}")
 
+    @db.validates("price")
+    def validate_price(self, key, price):
+        # Keep the numeric price, which search filters on, in step with the price shown to users
+        self.price_amount = parse_price(price)
+        return price
+
+    @db.validates("location")
+    def validate_location(self, key, location):
+        self.latitude, self.longitude = geocode(location) or (None, None)
+        return location
+
     @classmethod
-    def search_property(cls, search_term, page, per_page):
+    def listings_feed(cls, cursor=None, per_page=24):
         """
-        This method queries for properties in database matching the ids returned by the search_docs().
+        Returns a page of property listings, newest first, using keyset pagination on (date_listed, id). The cursor is
+        the (date_listed, id) of the last listing on the previous page, so each page is a range scan on the
+        ix_property_date_listed_id index no matter how deep into the feed the page is. Returns the listings and the
+        cursor for the next page, which is None on the last page.
         """
-        ids, total = search_docs(search_term, page, per_page)
-        if total == 0 or isinstance(total, dict):
-            return cls.query.filter_by(id=0), 0
-        ids_to_query = []
-        for i in range(len(ids)):
-            ids_to_query.append((ids[i], i))
-        results = cls.query.filter(cls.id.in_(ids)).order_by(
-            db.case(ids_to_query, value=cls.id)
+        query = cls.query.order_by(cls.date_listed.desc(), cls.id.desc())
+        if cursor is not None:
+            query = query.filter(
+                db.tuple_(cls.date_listed, cls.id) < db.tuple_(*cursor)
+            )
+        # Fetch one extra row to find out if there is a next page without running a COUNT query
+        listings = query.limit(per_page + 1).all()
+        next_cursor = None
+        if len(listings) > per_page:
+            listings = listings[:per_page]
+            next_cursor = (listings[-1].date_listed, listings[-1].id)
+        return listings, next_cursor
+
+    @classmethod
+    @cached("listing", ttl=LISTING_CACHE_TTL, version=LISTING_CACHE_VERSION)
+    def details_view_model(cls, listing_id):
+        """
+        Builds the data shown on the property listing details page as a dictionary. The result is cached, call
+        Property.details_view_model.invalidate(listing_id) after changing the listing. Returns None if the listing
+        doesn't exist.
+        """
+        listing = cls.query.get(listing_id)
+        if listing is None:
+            return None
+        return {
+            "id": listing.id,
+            "name": listing.name,
+            "desc": listing.desc,
+            "price": listing.price,
+            "location": listing.location,
+            "type": listing.type,
+            "date_listed": listing.date_listed,
+            "updated_at": listing.updated_at,
+            "is_available": listing.is_available,
+            "user_id": listing.user_id,
+            "owner": {"username": listing.owner.username},
+            "photos": [
+                {
+                    "storage_location": photo.storage_location,
+                    "folder": photo.folder,
+                    "filename": photo.filename,
+                    "variants": json.loads(photo.variants) if photo.variants else None,
+                }
+                for photo in listing.property_photos
+            ],
+        }
+
+    @classmethod
+    def search_property(
+        cls, search_term, per_page, search_after=None, reverse=False, pit_id=None, filters=None
+    ):
+        """
+        Searches for property listings with search_docs(). The results are built from the documents returned by
+        the search backend; only listings whose documents were indexed without all the fields shown in the search
+        results are loaded from the database, with one query. filters narrows the results, see SearchBackend.search().
+
+        Returns the results, the total number of results and a dictionary describing the page: whether there are
+        more results in the direction of the search, the sort values of the first and last hits (used as cursors
+        for the previous and next pages), the point in time id to use for the other pages and the facet counts.
+        """
+        search_page = search_docs(
+            search_term, per_page, search_after, reverse, pit_id, filters
         )
-        return results, total
+        hits, total = search_page["hits"], search_page["total"]
+        page_info = {
+            "has_more": search_page["has_more"],
+            "first_sort": hits[0]["sort"] if hits else None,
+            "last_sort": hits[-1]["sort"] if hits else None,
+            "pit_id": search_page["pit_id"],
+            "facets": search_page["facets"],
+        }
+        if total == 0 or isinstance(total, dict):
+            return [], 0, page_info
+
+        results = {hit["id"]: search_result(hit) for hit in hits}
+        ids_to_hydrate = [listing_id for listing_id, result in results.items() if result is None]
+        if ids_to_hydrate:
+            listings = cls.query.options(
+                db.joinedload(cls.owner), db.selectinload(cls.property_photos)
+            ).filter(cls.id.in_(ids_to_hydrate))
+            for listing in listings:
+                results[listing.id] = search_result(property_document(listing))
+        # Keep the order of the hits and skip hits whose listing no longer exists in the database
+        return [results[hit["id"]] for hit in hits if results[hit["id"]]], total, page_info
 
     @classmethod
     def add_property(cls, prop_data):
         """
-        Saves the Property listing data to the database.
+        Saves the Property listing data to the database. Returns the new listing.
         """
         new_property = cls(**prop_data)
-        db.session.add(new_property)
-        db.session.commit()
-        # Add Property listing data to ElasticSearch index
-        add_to_index(
-            new_property.id, prop_data["name"], prop_data["desc"], prop_data["location"]
+        new_property.property_photos = PropertyPhoto.from_photos_json(
+            prop_data["photos"], prop_data.get("photos_location")
         )
+        db.session.add(new_property)
+        db.session.commit()  # the listing is indexed by the search outbox, see SearchOutbox
+        purge_surrogate_keys(FEED_SURROGATE_KEY)
+        invalidate_listing_coordinates()
+        return new_property
 
     @classmethod
     def update_property(cls, listing, form_data):
@@ -114,7 +314,9 @@ class Property(db.Model):
                 continue
             setattr(listing, key, value)
         db.session.commit()
-        add_to_index(listing.id, listing.name, listing.desc, listing.location)
+        cls.details_view_model.invalidate(listing.id)
+        purge_surrogate_keys(listing_surrogate_key(listing.id), FEED_SURROGATE_KEY)
+        invalidate_listing_coordinates()  # the location may have changed
 
     @classmethod
     def update_property_images(cls, listing, images_folder, images_list_json):
@@ -123,16 +325,212 @@ class Property(db.Model):
         """
         listing.images_folder = f"{images_folder}/"
         listing.photos = images_list_json
+        listing.property_photos = PropertyPhoto.from_photos_json(
+            images_list_json, listing.photos_location
+        )
         db.session.commit()
+        cls.details_view_model.invalidate(listing.id)
+        purge_surrogate_keys(listing_surrogate_key(listing.id))
 
     @classmethod
     def delete_property(cls, listing):
         """
         Deletes the Property listing in the database.
         """
-        delete_from_index(listing.id)  # Delete property in ElasticSearch index
+        listing_id = listing.id
         db.session.delete(listing)
         db.session.commit()
+        cls.details_view_model.invalidate(listing_id)
+        purge_surrogate_keys(listing_surrogate_key(listing_id), FEED_SURROGATE_KEY)
+        invalidate_listing_coordinates()
+
+
+class PropertyPhoto(db.Model):
+    """
+    A single image of a property listing. The images used to be stored only as a JSON list in Property.photos, this
+    table allows the images of a page of listings to be fetched with one query and stores the dimensions and the
+    resized variants of each image once they have been processed.
+    """
+
+    __tablename__ = "property_photo"
+
+    id = db.Column(db.Integer, primary_key=True)
+    property_id = db.Column(
+        db.ForeignKey("property.id", ondelete="CASCADE"), nullable=False
+    )
+    position = db.Column(db.Integer, nullable=False, default=0)
+    folder = db.Column(db.String(100), nullable=False)
+    filename = db.Column(db.String(100), nullable=False)
+    storage_location = db.Column(
+        db.String(100), nullable=True
+    )  # specifies the server hosting the image
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    # JSON object of the resized variants of the image by size, see app.images.save_derivatives() e.g
+    # {"thumb": {"width": 200, "height": 150, "filename": "79cff318_thumb.jpg", "webp": "79cff318_thumb.webp"}, ...}
+    variants = db.Column(db.Text, nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_property_photo_property_id_position", "property_id", "position"),
+    )
+
+    def __repr__(self):
+        return f"<PropertyPhoto {self.folder}{self.filename}>"
+
+    @classmethod
+    def from_photos_json(cls, photos_json, storage_location):
+        """
+        Creates PropertyPhoto objects from the JSON list stored in Property.photos, where the first item is the images
+        folder and the remaining items are the image filenames e.g ["5de13ba062fa4/", "79cff318.jpg"].
+        """
+        images_folder, *image_filenames = json.loads(photos_json)
+        return [
+            cls(
+                position=position,
+                folder=images_folder,
+                filename=image_filename,
+                storage_location=storage_location,
+            )
+            for position, image_filename in enumerate(image_filenames)
+        ]
+
+    @classmethod
+    def for_listings(cls, listing_ids):
+        """
+        Fetches the photos of many property listings with a single query. Returns a dictionary of
+        {listing id: [photos ordered by position]}.
+        """
+        photos_by_listing = {listing_id: [] for listing_id in listing_ids}
+        if not listing_ids:
+            return photos_by_listing
+        photos = (
+            cls.query.filter(cls.property_id.in_(listing_ids))
+            .order_by(cls.property_id, cls.position)
+            .all()
+        )
+        for photo in photos:
+            photos_by_listing[photo.property_id].append(photo)
+        return photos_by_listing
+
+    @classmethod
+    def record_variants(cls, listing_id, folder, variants_by_filename):
+        """
+        Records the dimensions and the resized variants (see app.images.save_derivatives()) of the images of a
+        listing in folder once they have been processed, in one transaction. variants_by_filename is a dictionary of
+        {filename: variants}. The listing is marked as updated so the pages and the search document showing its
+        images pick up the variants.
+        """
+        for filename, variants in variants_by_filename.items():
+            # property_id first, it is the leading column of ix_property_photo_property_id_position
+            cls.query.filter_by(property_id=listing_id, folder=folder, filename=filename).update(
+                {
+                    "width": variants["full"]["width"],
+                    "height": variants["full"]["height"],
+                    "variants": json.dumps(variants),
+                },
+                synchronize_session=False,
+            )
+        listing = Property.query.get(listing_id)
+        if listing is not None:
+            listing.updated_at = datetime.utcnow()
+        db.session.commit()
+        if listing is not None:
+            Property.details_view_model.invalidate(listing.id)
+            purge_surrogate_keys(listing_surrogate_key(listing.id))
+
+
+class SearchOutbox(db.Model):
+    """
+    The listings whose search index documents are out of date. An entry is written in the same transaction as every
+    change to a listing (see record_search_outbox_entry()), so the database and the search index can't disagree for
+    longer than it takes the drain_search_outbox task to catch up, even if the search backend is down when the
+    listing is saved.
+    """
+
+    __tablename__ = "search_outbox"
+    # Key of the Postgres advisory lock that serializes drains, see drain()
+    DRAIN_LOCK_ID = 0x5E4C_0B0C
+
+    id = db.Column(db.Integer, primary_key=True)
+    # Not a foreign key, the entry of a deleted listing outlives the listing
+    listing_id = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<SearchOutbox listing {self.listing_id}>"
+
+    @classmethod
+    def drain(cls, batch_size=SEARCH_OUTBOX_BATCH_SIZE):
+        """
+        Applies the oldest batch_size entries to the search index and deletes them. A listing changed several times
+        is reindexed once, from its current row. Returns the number of entries drained.
+
+        Drains run one at a time: two drains with entries of the same listing could otherwise read its row in one
+        order and write it to the index in the other, leaving the older document in the index. A drain waits for
+        the transaction of the one before it with a transaction level advisory lock, released by the commit.
+        """
+        db.session.execute(db.select([db.func.pg_advisory_xact_lock(cls.DRAIN_LOCK_ID)]))
+        entries = cls.query.order_by(cls.id).limit(batch_size).all()
+        if not entries:
+            db.session.rollback()  # release the snapshot
+            return 0
+        entry_ids = [entry.id for entry in entries]
+        oldest_entry_at = entries[0].created_at
+        # The listings are read after the entries, so their rows hold at least the changes that the entries record
+        indexed, deleted = reindex_listings(Property, {entry.listing_id for entry in entries})
+        cls.query.filter(cls.id.in_(entry_ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+        now = datetime.utcnow()
+        pipeline = redis_client.pipeline()
+        pipeline.hincrby(SEARCH_OUTBOX_STATS_KEY, "drained", len(entry_ids))
+        pipeline.hincrby(SEARCH_OUTBOX_STATS_KEY, "indexed", indexed)
+        pipeline.hincrby(SEARCH_OUTBOX_STATS_KEY, "deleted", deleted)
+        pipeline.hincrby(SEARCH_OUTBOX_STATS_KEY, "batches", 1)
+        pipeline.hset(
+            SEARCH_OUTBOX_STATS_KEY, "last_lag_seconds", (now - oldest_entry_at).total_seconds()
+        )
+        pipeline.hset(SEARCH_OUTBOX_STATS_KEY, "last_drained_at", now.isoformat())
+        pipeline.execute()
+        return len(entry_ids)
+
+    @classmethod
+    def record_failure(cls):
+        redis_client.hincrby(SEARCH_OUTBOX_STATS_KEY, "failures", 1)
+
+    @classmethod
+    def stats(cls):
+        """
+        Returns the number of pending entries, the age in seconds of the oldest one, which is how far the search
+        index lags behind the database, and the counters updated by drain() e.g
+        {"pending": 2, "lag_seconds": 1.5, "drained": 120, "indexed": 100, "deleted": 18, "batches": 40,
+        "failures": 0, "last_lag_seconds": 0.8, "last_drained_at": "2021-06-18T10:05:10.123456"}.
+        """
+        pending, oldest_entry_at = db.session.query(
+            db.func.count(cls.id), db.func.min(cls.created_at)
+        ).one()
+        stats = {
+            "pending": pending,
+            "lag_seconds": (datetime.utcnow() - oldest_entry_at).total_seconds()
+            if oldest_entry_at
+            else 0,
+            "drained": 0,
+            "indexed": 0,
+            "deleted": 0,
+            "batches": 0,
+            "failures": 0,
+            "last_lag_seconds": None,
+            "last_drained_at": None,
+        }
+        for field, value in redis_client.hgetall(SEARCH_OUTBOX_STATS_KEY).items():
+            field, value = field.decode("utf-8"), value.decode("utf-8")
+            if field == "last_drained_at":
+                stats[field] = value
+            elif field == "last_lag_seconds":
+                stats[field] = float(value)
+            else:
+                stats[field] = int(value)
+        return stats
 
 
 class DeactivatedUserAccounts(db.Model):
@@ -156,13 +554,69 @@ class TokenBlacklist(db.Model):
     created_at = db.Column(db.DateTime, nullable=False)
 
 
+@db.event.listens_for(User, "after_update")
+@db.event.listens_for(User, "after_delete")
+def mark_user_principal_stale(mapper, connection, target):
+    """
+    Remembers which users have changed so that their cached principal is invalidated once the change is committed.
+    Invalidating on commit rather than on flush stops another request from caching the old row in between.
+    """
+    object_session(target).info.setdefault("stale_user_ids", set()).add(target.id)
+
+
+@db.event.listens_for(db.session, "after_commit")
+def invalidate_user_principals(session):
+    for user_id in session.info.pop("stale_user_ids", set()):
+        User.cached_principal.invalidate(user_id)
+
+
+@db.event.listens_for(db.session, "after_soft_rollback")
+def discard_stale_user_principals(session, previous_transaction):
+    session.info.pop("stale_user_ids", None)
+
+
+@db.event.listens_for(Property, "after_insert")
+@db.event.listens_for(Property, "after_update")
+@db.event.listens_for(Property, "after_delete")
+def record_search_outbox_entry(mapper, connection, target):
+    """
+    Adds an entry for the listing to the search outbox in the flush that writes the listing, so the entry is
+    committed or rolled back with the change.
+    """
+    connection.execute(
+        SearchOutbox.__table__.insert().values(listing_id=target.id, created_at=datetime.utcnow())
+    )
+    object_session(target).info["search_outbox_pending"] = True
+
+
+@db.event.listens_for(db.session, "after_commit")
+def queue_search_outbox_drain(session):
+    """
+    Asks a worker to apply the committed outbox entries to the search index. If the task can't be queued the entries
+    are drained by the periodic run of the task instead.
+    """
+    if session.info.pop("search_outbox_pending", False):
+        try:
+            current_app.celery.send_task("app.tasks.drain_search_outbox")
+        except Exception:
+            current_app.logger.exception("Failed to queue the drain of the search outbox")
+
+
+@db.event.listens_for(db.session, "after_soft_rollback")
+def discard_search_outbox_pending(session, previous_transaction):
+    session.info.pop("search_outbox_pending", None)
+
+
 @login_manager.user_loader
 def user_loader(id):
-    return User.query.filter_by(id=id).first()
+    user_data = User.cached_principal(int(id))
+    return User.from_cached_principal(user_data) if user_data else None
 
 
 @login_manager.request_loader
 def request_loader(request):
     username = request.form.get("username")
+    if not username:
+        return None
     user = User.query.filter_by(username=username).first()
     return user if user else None
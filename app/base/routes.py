@@ -16,7 +16,7 @@ from app.base.forms import (
 )
 from app.base.models import User, DeactivatedUserAccounts
 from app.base.utils import (
-    save_image_to_redis,
+    stage_image,
     confirm_token,
     generate_url_and_email_template,
 )
@@ -224,7 +224,7 @@ def user_profile():
                     s3_bucket_name=aws_s3_bucket_name,
                 )
                 file = request.files.get("profile_photo")
-                filename = save_image_to_redis(file)
+                filename = stage_image(file)
                 profile_image_process.delay(filename, photo_type="profile")
                 current_user.profile_photo = filename
                 current_user.prof_photo_loc = image_server_config
@@ -239,7 +239,7 @@ def user_profile():
                     s3_bucket_name=aws_s3_bucket_name,
                 )
                 file = request.files.get("cover_photo")
-                filename = save_image_to_redis(file)
+                filename = stage_image(file)
                 profile_image_process.delay(filename, photo_type="cover")
                 current_user.cover_photo = filename
                 current_user.cover_photo_loc = image_server_config
@@ -0,0 +1,27 @@
+/*
+ * "Listings near me" button of the search page. Asks the browser for the user's position and repeats the search
+ * with a lat/lon filter (the server's default radius applies).
+ */
+
+"use strict";
+document.addEventListener("DOMContentLoaded", function () {
+    const nearMeButton = document.querySelector("button[data-near-me]");
+    if (!nearMeButton || !navigator.geolocation) {
+        return;
+    }
+    nearMeButton.addEventListener("click", function () {
+        nearMeButton.disabled = true;
+        navigator.geolocation.getCurrentPosition(
+            function (position) {
+                const searchUrl = new URL(window.location.href);
+                searchUrl.searchParams.set("lat", position.coords.latitude.toFixed(3));
+                searchUrl.searchParams.set("lon", position.coords.longitude.toFixed(3));
+                searchUrl.searchParams.delete("cursor"); // start from the first page
+                window.location.href = searchUrl.toString();
+            },
+            function () {
+                nearMeButton.disabled = false; // permission denied or position unavailable
+            }
+        );
+    });
+});
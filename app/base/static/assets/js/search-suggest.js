@@ -0,0 +1,48 @@
+/*
+ * Search-as-you-type for the navbar search box. Fetches suggestions for the text typed so far from
+ * /search/suggest and shows them in the search box's <datalist>.
+ */
+
+"use strict";
+document.addEventListener("DOMContentLoaded", function () {
+    const searchInput = document.querySelector("input[data-suggest-url]");
+    if (!searchInput) {
+        return;
+    }
+    const suggestionList = document.getElementById(searchInput.getAttribute("list"));
+    const minPrefixLength = 2;
+    const debounceDelay = 150; // milliseconds
+    let debounceTimer = null;
+    let pendingRequest = null;
+
+    function showSuggestions(suggestions) {
+        suggestionList.innerHTML = "";
+        suggestions.forEach(function (suggestion) {
+            const option = document.createElement("option");
+            option.value = suggestion;
+            suggestionList.appendChild(option);
+        });
+    }
+
+    function fetchSuggestions(prefix) {
+        if (pendingRequest) {
+            pendingRequest.abort(); // only the suggestions for the latest text are needed
+        }
+        pendingRequest = new AbortController();
+        const url = searchInput.dataset.suggestUrl + "?q=" + encodeURIComponent(prefix);
+        fetch(url, {signal: pendingRequest.signal})
+            .then(function (response) { return response.json(); })
+            .then(function (data) { showSuggestions(data.suggestions); })
+            .catch(function () { /* aborted or offline, keep the previous suggestions */ });
+    }
+
+    searchInput.addEventListener("input", function () {
+        clearTimeout(debounceTimer);
+        const prefix = searchInput.value.trim();
+        if (prefix.length < minPrefixLength) {
+            showSuggestions([]);
+            return;
+        }
+        debounceTimer = setTimeout(function () { fetchSuggestions(prefix); }, debounceDelay);
+    });
+});
@@ -1,14 +1,26 @@
 import os
+import json
+import math
 import uuid
+import base64
+import hashlib
+import binascii
+from datetime import datetime
 from functools import wraps
-from flask import redirect, url_for, render_template
+from flask import redirect, url_for, render_template, request, session, current_app
 from flask_login import current_user
 from itsdangerous import URLSafeTimedSerializer
 from decouple import config
-from app import redis_client
+from app.uploads import stage_upload
+from app.base.models import PropertyPhoto
+from app.search import GEO_RADIUS_DEFAULT_KM, GEO_RADIUS_MAX_KM
 from config import IMAGE_UPLOAD_CONFIG
 
 bucket = IMAGE_UPLOAD_CONFIG["AMAZON_S3"]["S3_BUCKET"]
+amazon_s3_url = IMAGE_UPLOAD_CONFIG["AMAZON_S3"]["S3_URL"]
+property_listing_images_dir = IMAGE_UPLOAD_CONFIG["IMAGE_SAVE_DIRECTORIES"][
+    "PROPERTY_LISTING_IMAGES"
+]
 serializer = URLSafeTimedSerializer(os.environ.get("SECRET_KEY", config("SECRET_KEY")))
 salt = os.environ.get("SECURITY_PASSWORD_SALT", config("SECURITY_PASSWORD_SALT"))
 
@@ -62,13 +74,13 @@ def generate_url_and_email_template(
     return email_template, subject
 
 
-def save_image_to_redis(image_file):
+def stage_image(image_file):
     """
-    Change the filename of the uploaded image and save it temporary to redis.
+    Change the filename of the uploaded image and stage it until it is processed, see app.uploads.
     """
     _, file_extension = os.path.splitext(image_file.filename)
     new_filename = uuid.uuid4().__str__()[:8] + file_extension
-    redis_client.set(new_filename, image_file.read())
+    stage_upload(image_file, new_filename)
     return new_filename
 
 
@@ -91,6 +103,86 @@ def confirm_token(token, expiration=3600):
     return user_data
 
 
+def encode_cursor(values):
+    """
+    Encodes a tuple of values (e.g the (date_listed, id) of the last listing on a page) into an opaque url safe
+    string that can be passed to the next page as a cursor.
+    """
+    cursor_values = [
+        {"dt": value.isoformat()} if isinstance(value, datetime) else value
+        for value in values
+    ]
+    return base64.urlsafe_b64encode(json.dumps(cursor_values).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created with encode_cursor() back into a tuple of values. Returns None if the cursor is missing
+    or has been tampered with, in which case the caller should start from the first page.
+    """
+    if not cursor:
+        return None
+    try:
+        cursor_values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return tuple(
+            datetime.fromisoformat(value["dt"]) if isinstance(value, dict) else value
+            for value in cursor_values
+        )
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        return None
+
+
+def compute_etag(*parts):
+    """
+    Computes an ETag from the values a page depends on. The logged in user (whose details are shown in the navigation
+    bar) and the ETAG_VERSION setting are always part of the ETag.
+    """
+    if current_user.is_authenticated:
+        user_part = f"{current_user.id}:{current_user.updated_at}"
+    else:
+        user_part = "anonymous"
+    etag_source = ":".join(
+        str(part) for part in (current_app.config["ETAG_VERSION"], user_part, *parts)
+    )
+    return hashlib.sha1(etag_source.encode("utf-8")).hexdigest()
+
+
+def not_modified_response(etag, last_modified=None):
+    """
+    Returns a 304 Not Modified response if the browser's cached copy of the page is still valid according to the
+    If-None-Match or If-Modified-Since request headers, else None. Call it before rendering the template so that the
+    template is only rendered when the page has changed.
+    """
+    if "_flashes" in session:  # flashed messages are only shown once so the page must be rendered
+        return None
+    if request.if_none_match:
+        is_modified = not request.if_none_match.contains(etag)
+    elif request.if_modified_since and last_modified:
+        is_modified = last_modified.replace(microsecond=0) > request.if_modified_since.replace(
+            tzinfo=None
+        )
+    else:
+        return None
+    if is_modified:
+        return None
+    response = current_app.response_class(status=304)
+    return add_cache_validators(response, etag, last_modified)
+
+
+def add_cache_validators(response, etag, last_modified=None):
+    """
+    Adds the ETag and Last-Modified headers to a response. Cache-Control: no-cache tells browsers and proxies to
+    revalidate the page on every request, which is answered with a 304 if it hasn't changed.
+    """
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = (
+        "private, no-cache" if current_user.is_authenticated else "no-cache"
+    )
+    return response
+
+
 def email_verification_required(function):
     """
     This function decorator will check if the user has verified the email.
@@ -119,17 +211,213 @@ def check_account_status(function):
     return wrapped_func
 
 
-def save_property_listing_images_to_redis(image_files):
+def stage_property_listing_images(image_files):
     """
-    Saves the image files to redis in a hash map. The image_files_redis_key will be used to get the images in redis
-    for resizing. The image_files_redis_key will also be used a folder name where the processed images will be saved.
+    Stages the image files of a property listing in a new folder until they are processed (see app.uploads). The
+    name of the folder is also the name of the folder where the processed images will be saved. Returns the folder
+    name and the new filenames of the images.
     """
-    image_files_redis_key = uuid.uuid4().__str__()[:15].replace("-", "")
-    image_data_dict = {}
+    images_folder = uuid.uuid4().__str__()[:15].replace("-", "")
+    image_filenames = []
     for image_file in image_files:
         _, file_extension = os.path.splitext(image_file.filename)
-        new_image_filename = uuid.uuid4().__str__()[:8]
-        image_data_dict[f"{new_image_filename}{file_extension}"] = image_file.read()
-    # update to use redis_client.hset("myKey", mapping=data) as a resolve to deprecated redis_client.hmset()
-    redis_client.hset(image_files_redis_key, mapping=image_data_dict)
-    return image_files_redis_key
+        new_image_filename = f"{uuid.uuid4().__str__()[:8]}{file_extension}"
+        stage_upload(image_file, f"{images_folder}/{new_image_filename}")
+        image_filenames.append(new_image_filename)
+    return images_folder, image_filenames
+
+
+def listing_images(property_photos):
+    """
+    Resolves the photos of a property listing into what the templates need to render them (see
+    listing_image_sources()), skipping the photos whose storage location is unknown.
+    """
+    images = [
+        listing_image_sources(
+            photo.storage_location,
+            photo.folder,
+            photo.filename,
+            json.loads(photo.variants) if photo.variants else None,
+        )
+        for photo in property_photos
+    ]
+    return [image for image in images if image]
+
+
+def listing_image_sources(storage_location, folder, filename, variants):
+    """
+    Resolves a property listing image into a dictionary with the URL of the full size image and, once the image has
+    been resized (see app.images), the srcset attributes of its variants in the format of the upload and as WebP.
+    The srcsets are None until then. Returns None if the storage location is unknown.
+    """
+    url = listing_image_url(storage_location, f"{folder}{filename}")
+    if url is None:
+        return None
+    image = {"url": url, "srcset": None, "webp_srcset": None}
+    if variants:
+        for srcset, format_key in (("srcset", "filename"), ("webp_srcset", "webp")):
+            image[srcset] = ", ".join(
+                f"{listing_image_url(storage_location, folder + variant[format_key])} {variant['width']}w"
+                for variant in variants.values()
+            )
+    return image
+
+
+def listing_image_url(storage_location, image_path):
+    """
+    Resolves the path of a property listing image (e.g "5de13ba062fa4/79cff318.jpg") into a URL. Returns None if the
+    storage location is unknown.
+    """
+    image_path = f"{property_listing_images_dir}{image_path}"
+    if storage_location == "amazon_s3":
+        return f"{amazon_s3_url}/{image_path}"
+    if storage_location == "app_server_storage":
+        return url_for("static", filename=image_path)
+    return None
+
+
+def build_listing_photo_map(property_listings):
+    """
+    Builds a dictionary of {listing id: [images]} (see listing_image_sources()) for the property listings on a page.
+    The photos of all the listings are fetched with one query and the map is built once per request so that the
+    templates can look up the images of each listing directly instead of searching through the photos of every other
+    listing on the page.
+    """
+    photos_by_listing = PropertyPhoto.for_listings(
+        [listing.id for listing in property_listings]
+    )
+    return {
+        listing_id: listing_images(photos)
+        for listing_id, photos in photos_by_listing.items()
+    }
+
+
+def build_search_result_photo_map(search_results):
+    """
+    Builds the same {listing id: [images]} map as build_listing_photo_map() for search results, from the cover
+    photo stored in the search index instead of from the database.
+    """
+    photo_map = {}
+    for result in search_results:
+        image = None
+        if result["cover_photo_path"]:
+            folder, filename = result["cover_photo_path"].rsplit("/", 1)
+            image = listing_image_sources(
+                result["cover_photo_location"], f"{folder}/", filename, result["cover_photo_variants"]
+            )
+        photo_map[result["id"]] = [image] if image else []
+    return photo_map
+
+
+def search_filters_from_args(args):
+    """
+    Reads the search filters (see app.search.SEARCH_FILTERS) from the query string of the search page, skipping the
+    empty and invalid ones.
+    """
+    filters = {}
+    for name in ("type", "location"):
+        value = args.get(name, "").strip()
+        if value:
+            filters[name] = value
+    for name in ("min_price", "max_price"):
+        value = number_arg(args, name)
+        if value is not None and value >= 0:
+            filters[name] = value
+    latitude, longitude = number_arg(args, "lat"), number_arg(args, "lon")
+    if latitude is not None and longitude is not None and abs(latitude) <= 90 and abs(longitude) <= 180:
+        # Rounded to about 100m, which is plenty for a radius in km and lets nearby searches share cached pages
+        filters["lat"], filters["lon"] = round(latitude, 3), round(longitude, 3)
+        radius = number_arg(args, "radius")
+        filters["radius"] = (
+            min(radius, GEO_RADIUS_MAX_KM) if radius and radius > 0 else GEO_RADIUS_DEFAULT_KM
+        )
+    return filters
+
+
+def number_arg(args, name):
+    """
+    Returns the value of a query string argument as a number, or None if it is missing or not a finite number.
+    """
+    try:
+        value = float(args.get(name, ""))
+    except ValueError:
+        return None
+    if not math.isfinite(value):
+        return None
+    return int(value) if value.is_integer() else value
+
+
+def price_range_label(low, high):
+    if low is None:
+        return f"Under K{high:,.0f}"
+    if high is None:
+        return f"Over K{low:,.0f}"
+    return f"K{low:,.0f} - K{high:,.0f}"
+
+
+def build_search_facets(search_term, filters, facets):
+    """
+    Builds what the search page shows to narrow down the results: the facets, whose options link to the search with
+    that option picked and show how many results it has, and a chip for every filter in use which links to the search
+    without it.
+    """
+
+    def search_url(**changed_filters):
+        new_filters = dict(filters, **changed_filters)
+        return url_for(
+            "home_blueprint.search",
+            q=search_term,
+            **{name: value for name, value in new_filters.items() if value is not None},
+        )
+
+    facet_groups = [
+        {
+            "title": title,
+            "options": [
+                {
+                    "label": option["value"],
+                    "count": option["count"],
+                    "url": search_url(**{name: option["value"]}),
+                    "active": filters.get(name) == option["value"],
+                }
+                for option in facets[name]
+            ],
+        }
+        for title, name in (("Type", "type"), ("Location", "location"))
+    ]
+    facet_groups.append(
+        {
+            "title": "Price",
+            "options": [
+                {
+                    "label": price_range_label(low, high),
+                    "count": option["count"],
+                    "url": search_url(min_price=low, max_price=high),
+                    "active": (filters.get("min_price"), filters.get("max_price")) == (low, high),
+                }
+                for option in facets["price"]
+                for low, high in [option["value"]]
+            ],
+        }
+    )
+
+    filter_chips = [
+        {"label": filters[name], "url": search_url(**{name: None})}
+        for name in ("type", "location")
+        if name in filters
+    ]
+    if "min_price" in filters or "max_price" in filters:
+        filter_chips.append(
+            {
+                "label": price_range_label(filters.get("min_price"), filters.get("max_price")),
+                "url": search_url(min_price=None, max_price=None),
+            }
+        )
+    if "lat" in filters:
+        filter_chips.append(
+            {
+                "label": f"Within {filters['radius']} km",
+                "url": search_url(lat=None, lon=None, radius=None),
+            }
+        )
+    return facet_groups, filter_chips
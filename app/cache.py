@@ -0,0 +1,396 @@
+import os
+import json
+import time
+import inspect
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime
+from functools import wraps
+from flask import request, session, g, make_response, current_app
+from flask_login import current_user
+from app import redis_client
+
+# Bump LISTING_CACHE_VERSION whenever the shape of the cached listing view model changes so that entries written by
+# an older version of the app are not read back.
+LISTING_CACHE_VERSION = 3
+LISTING_CACHE_TTL = 60 * 60  # seconds
+USER_CACHE_TTL = 60  # seconds
+MISSING = object()
+CACHE_STATS_KEY = "cache:stats"
+PAGE_CACHE_TTL = 5 * 60  # seconds
+# How long the count of deletes of a key is kept, see TwoTierCache.invalidation_token(). It must be longer than it
+# takes to compute a cached value.
+INVALIDATION_TOKEN_TTL = 5 * 60  # seconds
+# Tags the cached first page of the listings feed, purged whenever a listing is added, updated or deleted. Later
+# pages are addressed by a keyset cursor so only the listings on them can change, which purge them by their own keys.
+FEED_SURROGATE_KEY = "feed"
+# Tags cached search result pages. Any write to the search index can add a listing to or remove it from any search,
+# so they are all purged whenever the search generation is bumped, see app.search.bump_search_generation().
+SEARCH_SURROGATE_KEY = "search"
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _json_object_hook(obj):
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+def dumps(value):
+    """
+    Serializes a value to JSON for storing in redis. Datetime objects are preserved.
+    """
+    return json.dumps(value, default=_json_default)
+
+
+def loads(value):
+    """
+    Deserializes a value stored in redis with dumps().
+    """
+    return json.loads(value, object_hook=_json_object_hook)
+
+
+class CacheStats:
+    """
+    Counts cache lookups in memory and flushes the counts to a redis hash in batches, so that a lookup served from the
+    in-process cache doesn't pay for a redis round trip just to count it.
+    """
+
+    def __init__(self, flush_every=100, flush_interval=10):
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval  # seconds
+        self._counts = Counter()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, cache_name, counter):
+        with self._lock:
+            self._counts[f"{cache_name}:{counter}"] += 1
+            self._pending += 1
+            if (
+                self._pending < self.flush_every
+                and time.monotonic() - self._last_flush < self.flush_interval
+            ):
+                return
+            counts, self._counts = self._counts, Counter()
+            self._pending = 0
+            self._last_flush = time.monotonic()
+        self._flush(counts)
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            self._pending = 0
+            self._last_flush = time.monotonic()
+        self._flush(counts)
+
+    @staticmethod
+    def _flush(counts):
+        if not counts:
+            return
+        pipeline = redis_client.pipeline()
+        for field, count in counts.items():
+            pipeline.hincrby(CACHE_STATS_KEY, field, count)
+        pipeline.execute()
+
+
+cache_stats_counter = CacheStats()
+
+
+def record_cache_lookup(cache_name, hit, local=False):
+    """
+    Increments the hit or miss counter of a cache. Hits served from the in-process cache are counted separately
+    as local_hits.
+    """
+    cache_stats_counter.record(
+        cache_name, ("local_hits" if local else "hits") if hit else "misses"
+    )
+
+
+def cache_stats():
+    """
+    Returns the hit and miss counters of the caches e.g {"listing": {"local_hits": 40, "hits": 10, "misses": 2}}.
+    """
+    cache_stats_counter.flush()
+    stats = {}
+    for field, count in redis_client.hgetall(CACHE_STATS_KEY).items():
+        cache_name, counter = field.decode("utf-8").rsplit(":", 1)
+        stats.setdefault(cache_name, {"hits": 0, "misses": 0})[counter] = int(count)
+    return stats
+
+
+class TwoTierCache:
+    """
+    A cache with a small in-process LRU (L1) in front of redis (L2). Every worker process keeps its own L1, bounded
+    by size and TTL. Deleting a key publishes it on a redis pub/sub channel and every worker subscribed to the channel
+    drops the key from its L1, so workers don't keep serving stale entries after a write.
+
+    Values are stored as JSON (see dumps()) and decoded on every hit so callers can't mutate the cached copy.
+
+    A value computed from data read before a write must not be cached after the write has deleted the key, or it
+    would outlive the write. Read an invalidation_token() before computing the value and pass it to set(), which
+    then doesn't cache the value if the key has been deleted in between.
+    """
+
+    def __init__(self, channel, max_size=1024, local_ttl=30):
+        self.channel = channel
+        self.max_size = max_size
+        self.local_ttl = local_ttl  # seconds
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._listener = None
+        self._listener_pid = None
+
+    def _ensure_listener(self):
+        """
+        Starts the pub/sub listener thread. This is done lazily, and again after a fork, because threads started in
+        the gunicorn master are not copied into the worker processes.
+        """
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._local.clear()
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{self.channel: self._handle_invalidation})
+            self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+            self._listener_pid = os.getpid()
+
+    def _handle_invalidation(self, message):
+        keys = json.loads(message["data"])
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            return value
+
+    def _set_local(self, key, value):
+        with self._lock:
+            self._local[key] = (value, time.monotonic() + self.local_ttl)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_size:
+                self._local.popitem(last=False)
+
+    def get(self, key, cache_name="default"):
+        """
+        Returns the cached value of the key or MISSING.
+        """
+        self._ensure_listener()
+        value = self._get_local(key)
+        if value is not None:
+            record_cache_lookup(cache_name, hit=True, local=True)
+            return loads(value)
+
+        value = redis_client.get(key)
+        if value is not None:
+            record_cache_lookup(cache_name, hit=True)
+            self._set_local(key, value)
+            return loads(value)
+
+        record_cache_lookup(cache_name, hit=False)
+        return MISSING
+
+    @staticmethod
+    def _invalidations_key(key):
+        return f"{key}:invalidations"
+
+    def invalidation_token(self, key):
+        """
+        Returns the number of times the key has been deleted recently, to be passed to set().
+        """
+        return (redis_client.get(self._invalidations_key(key)) or b"0").decode("utf-8")
+
+    def set(self, key, value, ttl, invalidation_token=None):
+        """
+        Caches the value. With an invalidation_token the value is only cached if the key hasn't been deleted since
+        the token was read. Returns whether the value was cached.
+        """
+        self._ensure_listener()
+        serialized_value = dumps(value)
+        if invalidation_token is None:
+            redis_client.set(key, serialized_value, ex=ttl)
+        elif not _set_unless_invalidated_script(
+            keys=[key, self._invalidations_key(key)], args=[serialized_value, ttl, invalidation_token]
+        ):
+            return False
+        self._set_local(key, serialized_value)
+        return True
+
+    def delete(self, *keys):
+        """
+        Deletes the keys from redis and from the in-process cache of every worker.
+        """
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+        pipeline = redis_client.pipeline()
+        pipeline.delete(*keys)
+        for key in keys:
+            pipeline.incr(self._invalidations_key(key))
+            pipeline.expire(self._invalidations_key(key), INVALIDATION_TOKEN_TTL)
+        pipeline.publish(self.channel, json.dumps(keys))
+        pipeline.execute()
+
+
+# Sets the key only if it hasn't been deleted since the invalidation token was read, see TwoTierCache.set()
+_set_unless_invalidated_script = redis_client.register_script(
+    """
+    if (redis.call("GET", KEYS[2]) or "0") ~= ARGV[3] then
+        return 0
+    end
+    redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2])
+    return 1
+    """
+)
+
+
+two_tier_cache = TwoTierCache(
+    "cache:invalidate",
+    max_size=int(os.environ.get("CACHE_LOCAL_MAX_SIZE", 1024)),
+    local_ttl=int(os.environ.get("CACHE_LOCAL_TTL", 30)),
+)
+
+
+def cached(cache_name, ttl, version=1):
+    """
+    Decorator that caches the return value of a function in the two tier cache, keyed by the cache name, version and
+    the arguments of the function. None is never cached, nor is a value that invalidate() was called for while it
+    was being computed. Works on functions and classmethods (the class argument is not part of the key) and adds an
+    invalidate(*args) function to the decorated function e.g
+
+        @classmethod
+        @cached("listing", ttl=3600)
+        def details_view_model(cls, listing_id):
+            ...
+
+        Property.details_view_model.invalidate(listing_id)
+    """
+
+    def decorator(func):
+        parameters = list(inspect.signature(func).parameters)
+        skip_first_arg = bool(parameters) and parameters[0] == "cls"
+
+        def cache_key(args):
+            key_args = args[1:] if skip_first_arg else args
+            return f"{cache_name}:v{version}:" + ":".join(str(arg) for arg in key_args)
+
+        @wraps(func)
+        def wrapped_func(*args):
+            key = cache_key(args)
+            value = two_tier_cache.get(key, cache_name)
+            if value is not MISSING:
+                return value
+            # Read before func() so that a value computed from data that an invalidate() call has since made stale
+            # isn't cached
+            invalidation_token = two_tier_cache.invalidation_token(key)
+            value = func(*args)
+            if value is not None:
+                two_tier_cache.set(key, value, ttl, invalidation_token)
+            return value
+
+        def invalidate(*args):
+            two_tier_cache.delete(cache_key((None, *args) if skip_first_arg else args))
+
+        wrapped_func.invalidate = invalidate
+        return wrapped_func
+
+    return decorator
+
+
+def listing_surrogate_key(listing_id):
+    return f"listing-{listing_id}"
+
+
+def add_surrogate_keys(*keys):
+    """
+    Tags the page being rendered with surrogate keys. When the page is cached, purging any of these keys with
+    purge_surrogate_keys() removes the page from the cache.
+    """
+    g.setdefault("surrogate_keys", set()).update(keys)
+
+
+def purge_surrogate_keys(*keys):
+    """
+    Removes every cached page tagged with any of the surrogate keys.
+    """
+    surrogate_set_keys = [f"surrogate:{key}" for key in keys]
+    page_keys = set()
+    for surrogate_set_key in surrogate_set_keys:
+        page_keys.update(redis_client.smembers(surrogate_set_key))
+    pipeline = redis_client.pipeline()
+    if page_keys:
+        pipeline.delete(*page_keys)
+    pipeline.delete(*surrogate_set_keys)
+    pipeline.execute()
+
+
+def cache_page(view):
+    """
+    View decorator that caches the rendered HTML of GET requests made by anonymous users in redis. A page is not
+    cached or served from the cache if there are flashed messages waiting to be shown. Views tag their pages with
+    add_surrogate_keys() so that writes can purge only the pages they affect.
+    """
+
+    @wraps(view)
+    def wrapped_view(*args, **kwargs):
+        if (
+            request.method != "GET"
+            or current_user.is_authenticated
+            or "_flashes" in session
+        ):
+            return view(*args, **kwargs)
+
+        page_key = f"page:{hashlib.sha1(request.full_path.encode('utf-8')).hexdigest()}"
+        cached_page = redis_client.hgetall(page_key)
+        if cached_page:
+            record_cache_lookup("page", hit=True)
+            response = current_app.response_class(
+                cached_page[b"body"], mimetype="text/html"
+            )
+            if cached_page.get(b"etag"):
+                response.set_etag(cached_page[b"etag"].decode("utf-8"))
+            if cached_page.get(b"last_modified"):
+                response.headers["Last-Modified"] = cached_page[b"last_modified"]
+            response.headers["Cache-Control"] = "no-cache"
+            return response.make_conditional(request)
+
+        record_cache_lookup("page", hit=False)
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            surrogate_keys = g.get("surrogate_keys", set())
+            pipeline = redis_client.pipeline()
+            pipeline.hset(
+                page_key,
+                mapping={
+                    "body": response.get_data(),
+                    "etag": response.get_etag()[0] or "",
+                    "last_modified": response.headers.get("Last-Modified", ""),
+                },
+            )
+            pipeline.expire(page_key, PAGE_CACHE_TTL)
+            for key in surrogate_keys:
+                pipeline.sadd(f"surrogate:{key}", page_key)
+                pipeline.expire(f"surrogate:{key}", PAGE_CACHE_TTL)
+            pipeline.execute()
+            response.headers["Surrogate-Key"] = " ".join(sorted(surrogate_keys))
+        return response
+
+    return wrapped_view
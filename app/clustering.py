@@ -0,0 +1,128 @@
+"""
+Clustering of the listings shown on the map view. The coordinates of every listing are kept in compact NumPy arrays
+(cached in redis and in each worker's memory) and the listings inside the map's viewport are binned into a grid of
+map tiles with vectorized NumPy operations, so only one marker per cluster is sent to the browser no matter how many
+listings there are.
+"""
+import threading
+import numpy as np
+from app import redis_client
+from app.search import MAP_CLUSTER_ZOOM_OFFSET, MAP_MAX_ZOOM
+
+# Incremented whenever a listing is added, deleted or moved. The coordinates cached under an older version are
+# ignored and expire after LISTING_COORDINATES_TTL.
+LISTING_COORDINATES_VERSION_KEY = "map:coordinates:version"
+LISTING_COORDINATES_KEY = "map:coordinates:{version}"
+LISTING_COORDINATES_TTL = 60 * 60  # seconds
+
+_local_coordinates = {"version": None, "arrays": None}
+_local_coordinates_lock = threading.Lock()
+
+
+def invalidate_listing_coordinates():
+    redis_client.incr(LISTING_COORDINATES_VERSION_KEY)
+
+
+def listing_coordinates():
+    """
+    Returns the ids (int32), latitudes and longitudes (float32) of all the geocoded listings as three NumPy arrays,
+    12 bytes per listing. They are read from this worker's memory, else from redis, else from the database.
+    """
+    version = int(redis_client.get(LISTING_COORDINATES_VERSION_KEY) or 0)
+    if _local_coordinates["version"] == version:
+        return _local_coordinates["arrays"]
+
+    with _local_coordinates_lock:
+        if _local_coordinates["version"] == version:
+            return _local_coordinates["arrays"]
+        key = LISTING_COORDINATES_KEY.format(version=version)
+        cached_coordinates = redis_client.get(key)
+        if cached_coordinates is not None:
+            arrays = unpack_coordinates(cached_coordinates)
+        else:
+            arrays = load_listing_coordinates()
+            redis_client.set(key, pack_coordinates(*arrays), ex=LISTING_COORDINATES_TTL)
+        _local_coordinates.update(version=version, arrays=arrays)
+        return arrays
+
+
+def load_listing_coordinates():
+    from app.base.models import Property  # imported here because app.base.models imports this module
+
+    rows = (
+        Property.query.with_entities(Property.id, Property.latitude, Property.longitude)
+        .filter(Property.latitude.isnot(None), Property.longitude.isnot(None))
+        .order_by(Property.id)
+        .all()
+    )
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int32, count=len(rows))
+    latitudes = np.fromiter((row[1] for row in rows), dtype=np.float32, count=len(rows))
+    longitudes = np.fromiter((row[2] for row in rows), dtype=np.float32, count=len(rows))
+    return ids, latitudes, longitudes
+
+
+def pack_coordinates(ids, latitudes, longitudes):
+    return ids.astype("<i4").tobytes() + latitudes.astype("<f4").tobytes() + longitudes.astype("<f4").tobytes()
+
+
+def unpack_coordinates(data):
+    count = len(data) // 12
+    ids = np.frombuffer(data, dtype="<i4", count=count)
+    latitudes = np.frombuffer(data, dtype="<f4", count=count, offset=count * 4)
+    longitudes = np.frombuffer(data, dtype="<f4", count=count, offset=count * 8)
+    return ids, latitudes, longitudes
+
+
+def cluster_listings(bounding_box, zoom):
+    """
+    Returns the clusters of all the listings inside the bounding box (west, south, east, north) of the map view at
+    the zoom level of the map, see cluster_points().
+    """
+    return cluster_points(*listing_coordinates(), bounding_box, zoom)
+
+
+def cluster_points(ids, latitudes, longitudes, bounding_box, zoom):
+    """
+    Groups the points inside the bounding box by the web mercator map tile they fall in at MAP_CLUSTER_ZOOM_OFFSET
+    zoom levels deeper than the map, the same grid as the geotile_grid aggregation used by the ElasticSearch search
+    backend, and places each cluster at the centroid of its points.
+
+    Returns a list of {"lat", "lon", "count", "listing_id"} dictionaries, where listing_id is the id of one of the
+    points of the cluster, which is the point itself for a cluster of one point.
+    """
+    west, south, east, north = bounding_box
+    in_view = (latitudes >= south) & (latitudes <= north)
+    if west <= east:
+        in_view &= (longitudes >= west) & (longitudes <= east)
+    else:  # the viewport crosses the antimeridian
+        in_view &= (longitudes >= west) | (longitudes <= east)
+    ids, latitudes, longitudes = ids[in_view], latitudes[in_view], longitudes[in_view]
+    if not len(ids):
+        return []
+
+    tiles_per_side = 2 ** (min(zoom, MAP_MAX_ZOOM) + MAP_CLUSTER_ZOOM_OFFSET)
+    latitudes_rad = np.radians(latitudes.astype(np.float64))
+    x = (longitudes.astype(np.float64) + 180.0) / 360.0 * tiles_per_side
+    y = (1.0 - np.arcsinh(np.tan(latitudes_rad)) / np.pi) / 2.0 * tiles_per_side
+    tile_x = np.clip(x.astype(np.int64), 0, tiles_per_side - 1)
+    tile_y = np.clip(y.astype(np.int64), 0, tiles_per_side - 1)
+
+    _, first_index, cell_of_point, counts = np.unique(
+        tile_x * tiles_per_side + tile_y,
+        return_index=True,
+        return_inverse=True,
+        return_counts=True,
+    )
+    centroid_latitudes = np.bincount(cell_of_point, weights=latitudes) / counts
+    centroid_longitudes = np.bincount(cell_of_point, weights=longitudes) / counts
+    return [
+        {
+            "lat": round(float(lat), 5),
+            "lon": round(float(lon), 5),
+            "count": int(count),
+            "listing_id": int(listing_id),
+        }
+        for lat, lon, count, listing_id in zip(
+            centroid_latitudes, centroid_longitudes, counts, ids[first_index]
+        )
+    ]
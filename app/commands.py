@@ -0,0 +1,98 @@
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from app import redis_client
+
+
+def require_elasticsearch_backend():
+    if current_app.config["SEARCH_BACKEND"] != "elasticsearch":
+        raise click.ClickException(
+            "This command only applies to the elasticsearch search backend. The memory search backend builds its "
+            "index from the database when a worker starts."
+        )
+
+
+def print_reindex_progress(indexed, failed, total, last_id, elapsed):
+    docs_per_second = indexed / elapsed if elapsed else 0
+    click.echo(
+        f"{indexed + failed}/{total} documents ({failed} failed) | last id {last_id} | "
+        f"{docs_per_second:.0f} docs/s"
+    )
+
+
+@click.command("search-reindex")
+@click.option("--batch-size", default=500, show_default=True, help="Documents per bulk request.")
+@click.option("--chunk-size", default=1000, show_default=True, help="Rows read from the database per query.")
+@click.option("--threads", default=4, show_default=True, help="Bulk requests in flight at once.")
+@click.option("--resume", is_flag=True, help="Continue from the last id indexed by an interrupted run.")
+@with_appcontext
+def search_reindex(batch_size, chunk_size, threads, resume):
+    """
+    Index every property listing in the database into ElasticSearch.
+    """
+    from app.base.models import Property
+    from app.search.elasticsearch_backend import bulk_index_existing_data
+
+    require_elasticsearch_backend()
+    summary = bulk_index_existing_data(
+        Property,
+        batch_size=batch_size,
+        chunk_size=chunk_size,
+        thread_count=threads,
+        resume=resume,
+        checkpoint_store=redis_client,
+        progress_callback=print_reindex_progress,
+    )
+    click.echo(
+        f"Indexed {summary['indexed']} documents ({summary['failed']} failed) in {summary['seconds']}s "
+        f"({summary['docs_per_second']} docs/s)."
+    )
+    if summary["failed"]:
+        raise click.ClickException(
+            f"{summary['failed']} documents failed to be indexed. Run the command again with --resume to continue "
+            f"after id {summary['checkpoint_id']}."
+        )
+
+
+@click.command("search-rebuild")
+@click.option("--keep", default=1, show_default=True, help="Old index versions to keep for rolling back.")
+@click.option("--batch-size", default=500, show_default=True, help="Documents per bulk request.")
+@click.option("--threads", default=4, show_default=True, help="Bulk requests in flight at once.")
+@with_appcontext
+def search_rebuild(keep, batch_size, threads):
+    """
+    Rebuild the search index into a new versioned index and switch the property_index alias to it.
+    """
+    from app.base.models import Property
+    from app.search.elasticsearch_backend import rebuild_index
+
+    require_elasticsearch_backend()
+    new_index = rebuild_index(
+        Property,
+        keep=keep,
+        batch_size=batch_size,
+        thread_count=threads,
+        progress_callback=print_reindex_progress,
+    )
+    click.echo(f"The property_index alias now points to {new_index}.")
+
+
+@click.command("search-check-drift")
+@click.option("--dry-run", is_flag=True, help="Only report the differences, don't repair them.")
+@click.option("--chunk-size", default=1000, show_default=True, help="Rows and documents read per request.")
+@with_appcontext
+def search_check_drift(dry_run, chunk_size):
+    """
+    Compare the search index with the database and reindex the listings that differ.
+    """
+    from app.base.models import Property
+    from app.search.drift import check_index_drift
+
+    counts = check_index_drift(Property, repair=not dry_run, chunk_size=chunk_size)
+    click.echo(
+        f"Checked {counts['database']} listings against {counts['index']} documents: {counts['missing']} missing, "
+        f"{counts['stale']} stale and {counts['orphaned']} orphaned. Repaired {counts['repaired']}."
+    )
+
+
+commands = [search_reindex, search_rebuild, search_check_drift]
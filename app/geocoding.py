@@ -0,0 +1,117 @@
+"""
+Offline geocoding of the free text location of property listings. Locations are matched against a table of Zambian
+towns and Lusaka areas so listings get coordinates without calling a geocoding service.
+"""
+import re
+
+# Place name: (latitude, longitude, town the place is in)
+TOWNS = {
+    "lusaka": (-15.4167, 28.2833, "lusaka"),
+    "ndola": (-12.9587, 28.6366, "ndola"),
+    "kitwe": (-12.8024, 28.2132, "kitwe"),
+    "kabwe": (-14.4469, 28.4464, "kabwe"),
+    "chingola": (-12.5290, 27.8838, "chingola"),
+    "mufulira": (-12.5497, 28.2407, "mufulira"),
+    "livingstone": (-17.8419, 25.8543, "livingstone"),
+    "luanshya": (-13.1367, 28.4166, "luanshya"),
+    "kasama": (-10.2129, 31.1808, "kasama"),
+    "chipata": (-13.6333, 32.6500, "chipata"),
+    "solwezi": (-12.1688, 26.3894, "solwezi"),
+    "mansa": (-11.1998, 28.8943, "mansa"),
+    "mongu": (-15.2484, 23.1274, "mongu"),
+    "choma": (-16.8065, 26.9531, "choma"),
+    "mazabuka": (-15.8561, 27.7480, "mazabuka"),
+    "kafue": (-15.7691, 28.1814, "kafue"),
+    "chililabombwe": (-12.3700, 27.8280, "chililabombwe"),
+    "kalulushi": (-12.8415, 28.0948, "kalulushi"),
+    "kapiri mposhi": (-13.9710, 28.6690, "kapiri mposhi"),
+    "siavonga": (-16.5383, 28.7088, "siavonga"),
+    "monze": (-16.2803, 27.4732, "monze"),
+    "chirundu": (-16.0333, 28.8500, "chirundu"),
+    "mpika": (-11.8343, 31.4529, "mpika"),
+    "petauke": (-14.2426, 31.3253, "petauke"),
+    "nakonde": (-9.3444, 32.7470, "nakonde"),
+    "mbala": (-8.8446, 31.3656, "mbala"),
+    "kaoma": (-14.7833, 24.8000, "kaoma"),
+    "chongwe": (-15.3290, 28.6820, "chongwe"),
+    "chibombo": (-14.6570, 28.0700, "chibombo"),
+    "lundazi": (-12.2928, 33.1783, "lundazi"),
+    "sesheke": (-17.4760, 24.2960, "sesheke"),
+    "kasempa": (-13.4584, 25.8338, "kasempa"),
+    "samfya": (-11.3650, 29.5550, "samfya"),
+    "nchelenge": (-9.3450, 28.7340, "nchelenge"),
+}
+AREAS = {
+    "kabulonga": (-15.4250, 28.3400, "lusaka"),
+    "woodlands": (-15.4320, 28.3200, "lusaka"),
+    "roma": (-15.3800, 28.3150, "lusaka"),
+    "rhodes park": (-15.4050, 28.3100, "lusaka"),
+    "longacres": (-15.4080, 28.3000, "lusaka"),
+    "olympia": (-15.3900, 28.3200, "lusaka"),
+    "chelston": (-15.3700, 28.3800, "lusaka"),
+    "avondale": (-15.3750, 28.3600, "lusaka"),
+    "ibex hill": (-15.4450, 28.3650, "lusaka"),
+    "meanwood": (-15.4550, 28.3750, "lusaka"),
+    "chalala": (-15.4700, 28.3300, "lusaka"),
+    "kalingalinga": (-15.4150, 28.3300, "lusaka"),
+    "matero": (-15.3750, 28.2500, "lusaka"),
+    "chilenje": (-15.4450, 28.3050, "lusaka"),
+    "emmasdale": (-15.3850, 28.2750, "lusaka"),
+    "makeni": (-15.4600, 28.2550, "lusaka"),
+    "libala": (-15.4400, 28.3000, "lusaka"),
+    "kamwala": (-15.4300, 28.2850, "lusaka"),
+    "northmead": (-15.4000, 28.3050, "lusaka"),
+    "fairview": (-15.4100, 28.2950, "lusaka"),
+    "mass media": (-15.4120, 28.3180, "lusaka"),
+    "leopards hill": (-15.4750, 28.4200, "lusaka"),
+    "foxdale": (-15.3550, 28.3250, "lusaka"),
+    "salama park": (-15.4600, 28.3600, "lusaka"),
+    "mtendere": (-15.4100, 28.3600, "lusaka"),
+    "kabwata": (-15.4350, 28.2950, "lusaka"),
+    "bauleni": (-15.4400, 28.3500, "lusaka"),
+    "lilayi": (-15.5100, 28.3000, "lusaka"),
+    "state lodge": (-15.4800, 28.4100, "lusaka"),
+    "silverest": (-15.4000, 28.4700, "lusaka"),
+    "chudleigh": (-15.4200, 28.3250, "lusaka"),
+    "thorn park": (-15.4180, 28.2900, "lusaka"),
+    "villa elizabetta": (-15.3950, 28.2650, "lusaka"),
+    "jesmondine": (-15.4550, 28.3200, "lusaka"),
+    "chainama": (-15.3950, 28.3500, "lusaka"),
+    "kamanga": (-15.3650, 28.3950, "lusaka"),
+    "kaunda square": (-15.3850, 28.3800, "lusaka"),
+    "chamba valley": (-15.3350, 28.3300, "lusaka"),
+    "chunga": (-15.3550, 28.2400, "lusaka"),
+    "kalundu": (-15.3800, 28.3300, "lusaka"),
+}
+
+
+def normalize_place_name(text):
+    """
+    Lowercases the text and replaces punctuation with spaces e.g "Plot 12, Ibex-Hill" -> "plot 12 ibex hill".
+    """
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", (text or "").lower()).split())
+
+
+def find_places(text, places):
+    padded_text = f" {normalize_place_name(text)} "
+    return {name: place for name, place in places.items() if f" {name} " in padded_text}
+
+
+def geocode(location):
+    """
+    Returns the (latitude, longitude) of the most specific place mentioned in the location of a listing e.g
+    "Plot 5, Kabulonga, Lusaka" -> the coordinates of Kabulonga. Returns None if no known place is mentioned.
+
+    Area names are only trusted when the location doesn't name another town, so that "Woodlands, Kitwe" resolves to
+    Kitwe and not to Woodlands in Lusaka.
+    """
+    towns = find_places(location, TOWNS)
+    areas = find_places(location, AREAS)
+    if towns:
+        areas = {name: area for name, area in areas.items() if area[2] in towns}
+    # Prefer the longest (usually most specific) name when several areas or several towns are mentioned
+    for places in (areas, towns):
+        if places:
+            latitude, longitude, _ = places[max(places, key=len)]
+            return latitude, longitude
+    return None
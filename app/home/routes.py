@@ -3,20 +3,52 @@
 Copyright (c) 2019 - present AppSeed.us
 """
 import json
-from flask import flash, render_template, request, redirect, url_for, g, current_app
+from datetime import datetime
+from flask import (
+    flash,
+    render_template,
+    request,
+    redirect,
+    url_for,
+    g,
+    current_app,
+    abort,
+    jsonify,
+    make_response,
+)
 from flask_login import current_user
 from jinja2 import TemplateNotFound
 from flask_login import login_required
-from app import redis_client
+from app.cache import (
+    cache_stats,
+    cache_page,
+    add_surrogate_keys,
+    listing_surrogate_key,
+    FEED_SURROGATE_KEY,
+    SEARCH_SURROGATE_KEY,
+)
 from app.home import blueprint
 from app.base.forms import CreatePropertyForm, UpdatePropertyForm, SearchForm
 from app.base.utils import (
-    save_property_listing_images_to_redis,
+    stage_property_listing_images,
     email_verification_required,
     check_account_status,
+    encode_cursor,
+    decode_cursor,
+    listing_image_sources,
+    build_listing_photo_map,
+    build_search_result_photo_map,
+    compute_etag,
+    not_modified_response,
+    add_cache_validators,
+    search_filters_from_args,
+    build_search_facets,
 )
 from app.tasks import process_property_listing_images, delete_property_listing_images
-from app.base.models import Property
+from app.base.models import Property, SearchOutbox
+from app.search import suggest_docs, map_clusters
+from app.search.drift import last_drift_report
+from app.clustering import cluster_listings
 from config import IMAGE_UPLOAD_CONFIG
 profile_image_upload_dir = IMAGE_UPLOAD_CONFIG["IMAGE_SAVE_DIRECTORIES"][
     "USER_PROFILE_IMAGES"
@@ -24,7 +56,6 @@ profile_image_upload_dir = IMAGE_UPLOAD_CONFIG["IMAGE_SAVE_DIRECTORIES"][
 property_listings_images_dir = IMAGE_UPLOAD_CONFIG["IMAGE_SAVE_DIRECTORIES"][
     "PROPERTY_LISTING_IMAGES"
 ]
-amazon_s3_url = IMAGE_UPLOAD_CONFIG["AMAZON_S3"]["S3_URL"]
 
 
 @blueprint.before_request
@@ -54,17 +85,51 @@ def internal_error(error):
 
 @blueprint.route("/index")
 @check_account_status
+@cache_page
 def index():
-    property_listings = Property.query.all()
-    property_listing_photos = [json.loads(p.photos) for p in property_listings]
-    return render_template(
-        "index.html",
-        segment="index",
-        property_listings=property_listings,
-        photos_list=property_listing_photos,
-        image_folder=property_listings_images_dir,
-        amazon_s3_url=amazon_s3_url
+    per_page = current_app.config["LISTINGS_PER_PAGE"]
+    cursor = request.args.get("cursor")
+    # The cursor is the (date_listed, id) of the last listing on the previous page. A cursor of any other shape has
+    # been tampered with, so the first page is shown instead.
+    feed_cursor = decode_cursor(cursor)
+    if not (
+        feed_cursor
+        and len(feed_cursor) == 2
+        and isinstance(feed_cursor[0], datetime)
+        and type(feed_cursor[1]) is int
+    ):
+        cursor = feed_cursor = None
+
+    property_listings, next_cursor = Property.listings_feed(feed_cursor, per_page)
+    add_surrogate_keys(*[listing_surrogate_key(p.id) for p in property_listings])
+    if not cursor:
+        add_surrogate_keys(FEED_SURROGATE_KEY)
+
+    etag = compute_etag(
+        "index", cursor, next_cursor, *[(p.id, p.updated_at) for p in property_listings]
+    )
+    # No Last-Modified: a listing deleted from the page, or sliding onto it, changes the page without changing the
+    # newest updated_at on it, so only the ETag tells whether the page has changed.
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
+
+    next_url = (
+        url_for("home_blueprint.index", cursor=encode_cursor(next_cursor))
+        if next_cursor
+        else None
+    )
+    response = make_response(
+        render_template(
+            "index.html",
+            segment="index",
+            property_listings=property_listings,
+            listing_photos=build_listing_photo_map(property_listings),
+            next_url=next_url,
+            first_page_url=url_for("home_blueprint.index") if cursor else None,
+        )
     )
+    return add_cache_validators(response, etag)
 
 
 @blueprint.route("/<template>")
@@ -105,31 +170,26 @@ def get_segment(request):
 def create_property():
     form = CreatePropertyForm()
     if request.method == "POST" and form.validate_on_submit():
-        redis_image_hashmap_key = save_property_listing_images_to_redis(
+        images_folder, image_filenames = stage_property_listing_images(
             request.files.getlist("photos")
         )
-        process_property_listing_images.delay(redis_image_hashmap_key)
-        image_filenames = redis_client.hgetall(redis_image_hashmap_key)
-
-        list_of_image_filenames = [
-            image_name.decode("utf-8") for image_name in image_filenames.keys()
-        ]
-        # add redis_image_hashmap_key on first index since it is used as a directory name of where to save image files
-        list_of_image_filenames.insert(0, f"{redis_image_hashmap_key}/")
-        img_list_to_json = json.dumps(list_of_image_filenames)
+        # add images_folder on first index since it is used as a directory name of where to save image files
+        img_list_to_json = json.dumps([f"{images_folder}/", *image_filenames])
 
         prop_data = {
             "name": form.name.data,
             "desc": form.desc.data,
             "price": form.price.data,
-            "images_folder": f"{redis_image_hashmap_key}/",
+            "images_folder": f"{images_folder}/",
             "photos": img_list_to_json,
             "photos_location": IMAGE_UPLOAD_CONFIG["STORAGE_LOCATION"],
             "location": form.location.data,
             "type": form.type.data,
             "user_id": current_user.id,
         }
-        Property.add_property(prop_data)
+        new_listing = Property.add_property(prop_data)
+        # Process the images after the listing is saved so that the task can record the image dimensions
+        process_property_listing_images.delay(new_listing.id, images_folder, image_filenames)
         flash("Your Property has been listed.", "success")
         return redirect(url_for("home_blueprint.index"))
     return render_template("create_property.html", form=form)
@@ -138,15 +198,29 @@ def create_property():
 @blueprint.route("/property/details/<int:listing_id>")
 @login_required
 def listing_details(listing_id):
-    property_listing = Property.query.get_or_404(listing_id)
-    photos = json.loads(property_listing.photos)
-    return render_template(
-        "property_details.html",
-        property_listing=property_listing,
-        photos_list=photos,
-        image_folder=property_listings_images_dir,
-        amazon_s3_url=amazon_s3_url,
+    property_listing = Property.details_view_model(listing_id)
+    if property_listing is None:
+        abort(404)
+
+    etag = compute_etag("details", listing_id, property_listing["updated_at"])
+    not_modified = not_modified_response(etag, property_listing["updated_at"])
+    if not_modified:
+        return not_modified
+
+    images = [
+        listing_image_sources(
+            photo["storage_location"], photo["folder"], photo["filename"], photo["variants"]
+        )
+        for photo in property_listing["photos"]
+    ]
+    response = make_response(
+        render_template(
+            "property_details.html",
+            property_listing=property_listing,
+            images=[image for image in images if image],
+        )
     )
+    return add_cache_validators(response, etag, property_listing["updated_at"])
 
 
 @blueprint.route("/property/update/<int:listing_id>", methods=["GET", "POST"])
@@ -172,22 +246,18 @@ def update_listing(listing_id):
                     IMAGE_UPLOAD_CONFIG["AMAZON_S3"]["S3_BUCKET"],
                 )
 
-                redis_image_hashmap_key = save_property_listing_images_to_redis(
+                images_folder, image_filenames = stage_property_listing_images(
                     request.files.getlist("photos")
                 )
-                process_property_listing_images.delay(redis_image_hashmap_key)
-                image_filenames = redis_client.hgetall(redis_image_hashmap_key)
-
-                list_of_image_filenames = [
-                    image_name.decode("utf-8") for image_name in image_filenames.keys()
-                ]
-                # add redis_image_hashmap_key on first index since it is used as a
+                # add images_folder on first index since it is used as a
                 # directory name of where to save image files
-                list_of_image_filenames.insert(0, f"{redis_image_hashmap_key}/")
-                img_list_to_json = json.dumps(list_of_image_filenames)
+                img_list_to_json = json.dumps([f"{images_folder}/", *image_filenames])
 
                 Property.update_property_images(
-                    listing_to_update, redis_image_hashmap_key, img_list_to_json
+                    listing_to_update, images_folder, img_list_to_json
+                )
+                process_property_listing_images.delay(
+                    listing_to_update.id, images_folder, image_filenames
                 )
         # Catch a key error exception that occurs during testing
         except KeyError:
@@ -223,35 +293,158 @@ def delete_listing(listing_id):
         return render_template("errors/403.html"), 403
 
 
+@blueprint.route("/metrics")
+@login_required
+def metrics():
+    """
+    Exposes the cache hit and miss counters, the lag of the search index behind the database and the counts of the
+    last search index drift check as JSON.
+    """
+    return jsonify(
+        caches=cache_stats(),
+        search_outbox=SearchOutbox.stats(),
+        search_drift=last_drift_report(),
+    )
+
+
+@blueprint.route("/search/suggest")
+def search_suggestions():
+    """
+    Returns suggestions for the text typed in the navbar search box as JSON.
+    """
+    response = jsonify(suggestions=suggest_docs(request.args.get("q", "")))
+    response.headers["Cache-Control"] = "public, max-age=60"
+    return response
+
+
+@blueprint.route("/search/map-markers")
+def map_markers():
+    """
+    Returns the markers of the map view as JSON: the listings inside the bounding box of the map, passed as
+    bbox=west,south,east,north, clustered for the zoom level of the map. The search term and filters are the same
+    as on the search page; without them the markers are computed by app.clustering instead of ElasticSearch.
+    """
+    try:
+        west, south, east, north = (
+            float(value) for value in request.args.get("bbox", "").split(",")
+        )
+        zoom = int(request.args.get("zoom", ""))
+    except ValueError:
+        abort(400)
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180 and zoom >= 0):
+        abort(400)
+
+    search_term = request.args.get("q")
+    filters = search_filters_from_args(request.args)
+    if search_term or filters:
+        markers = map_clusters((west, south, east, north), zoom, search_term, filters)
+    else:
+        # The map of every listing is clustered from the cached coordinates without querying ElasticSearch
+        markers = cluster_listings((west, south, east, north), zoom)
+    for marker in markers:
+        marker["url"] = (
+            url_for("home_blueprint.listing_details", listing_id=marker["listing_id"])
+            if marker["count"] == 1
+            else None
+        )
+    response = jsonify(markers=markers)
+    response.headers["Cache-Control"] = "public, max-age=60"
+    return response
+
+
 @blueprint.route("/search/")
+@cache_page
 def search():
     per_page = current_app.config["RESULTS_PER_PAGE"]
+    search_term = g.search_form.q.data
+    # e.g {"type": "Rent", "location": "Kabulonga", "max_price": 5000}
+    filters = search_filters_from_args(request.args)
 
-    page = request.args.get("page", 1, type=int)
-    search_results, total = Property.search_property(
-        g.search_form.q.data, page, per_page
+    # The cursor holds the direction to page in, the page number, the point in time id and the sort values of the
+    # hit to search after e.g ("after", 2, "46ToAwMD...", 3.97, 12)
+    cursor = request.args.get("cursor")
+    try:
+        direction, page, pit_id, *sort_values = decode_cursor(cursor)
+        # The sort values are the score and the id of the hit, see ElasticsearchBackend.search()
+        if (
+            direction not in ("after", "before")
+            or type(page) is not int
+            or not (pit_id is None or isinstance(pit_id, str))
+            or len(sort_values) != 2
+            or type(sort_values[0]) not in (int, float)
+            or type(sort_values[1]) is not int
+        ):
+            raise ValueError("Invalid search cursor")
+    except (TypeError, ValueError):
+        direction, page, pit_id, sort_values = "after", 1, None, None
+
+    search_results, total, page_info = Property.search_property(
+        search_term,
+        per_page,
+        search_after=sort_values,
+        reverse=direction == "before",
+        pit_id=pit_id,
+        filters=filters,
+    )
+    add_surrogate_keys(SEARCH_SURROGATE_KEY)
+
+    etag = compute_etag(
+        "search",
+        search_term,
+        sorted(filters.items()),
+        cursor,
+        total,
+        *[(result["id"], result["updated_at"]) for result in search_results],
     )
-    photos = [json.loads(p.photos) for p in search_results]
+    # No Last-Modified, see index()
+    not_modified = not_modified_response(etag)
+    if not_modified:
+        return not_modified
 
+    has_next_page = page_info["has_more"] if direction == "after" else True
     next_url = (
-        url_for("home_blueprint.search", q=g.search_form.q.data, page=page + 1)
-        if total > page * per_page
+        url_for(
+            "home_blueprint.search",
+            q=search_term,
+            cursor=encode_cursor(
+                ("after", page + 1, page_info["pit_id"], *page_info["last_sort"])
+            ),
+            **filters,
+        )
+        if search_results and has_next_page
         else None
     )
-    prev_url = (
-        url_for("home_blueprint.search", q=g.search_form.q.data, page=page - 1)
-        if page > 1
-        else None
+    if page == 2:
+        # Start the first page afresh rather than paging backwards to it
+        prev_url = url_for("home_blueprint.search", q=search_term, **filters)
+    elif page > 2 and search_results:
+        prev_url = url_for(
+            "home_blueprint.search",
+            q=search_term,
+            cursor=encode_cursor(
+                ("before", page - 1, page_info["pit_id"], *page_info["first_sort"])
+            ),
+            **filters,
+        )
+    else:
+        prev_url = None
+
+    facet_groups, filter_chips = build_search_facets(
+        search_term, filters, page_info["facets"]
     )
-    return render_template(
-        "search.html",
-        title="search",
-        search_results=search_results,
-        total=total,
-        image_folder=property_listings_images_dir,
-        photos_list=photos,
-        amazon_s3_url=amazon_s3_url,
-        next_url=next_url,
-        prev_url=prev_url,
-        search_term=g.search_form.q.data,
+    response = make_response(
+        render_template(
+            "search.html",
+            title="search",
+            search_results=search_results,
+            total=total,
+            listing_photos=build_search_result_photo_map(search_results),
+            next_url=next_url,
+            prev_url=prev_url,
+            search_term=search_term,
+            filters=filters,
+            facet_groups=facet_groups,
+            filter_chips=filter_chips,
+        )
     )
+    return add_cache_validators(response, etag)
@@ -0,0 +1,158 @@
+"""
+Resizing of the images of property listings. Every uploaded image is decoded once and resized into each of the
+IMAGE_DERIVATIVES sizes, which are saved in the format of the upload and as WebP. Pages list them in srcset
+attributes (see app.base.utils.listing_image_sources()) so browsers download the smallest file that fills the space
+of the image.
+
+Images are decoded by open_image(), which decodes JPEG images at a reduced resolution from the start, applies their
+EXIF orientation and drops their metadata. Resized images are encoded into memory and handed to a store callable,
+which writes them where they are served from (see app.storage.store_image()).
+"""
+import io
+import os
+from PIL import Image, ImageOps
+
+# Bounding boxes of the resized images, largest first. "full" is shown on the details page and "card" in the listing
+# cards of the index and search pages, or "thumb" where a card is 200 pixels wide or less.
+IMAGE_DERIVATIVES = {"full": (800, 800), "card": (400, 400), "thumb": (200, 200)}
+WEBP_QUALITY = 75  # the default quality of JPEG images saved by Pillow
+PROFILE_IMAGE_SIZE = (800, 800)
+# Images are first reduced by an integer factor (DCT scaling for JPEG images, Image.reduce() for the others) to no
+# less than REDUCING_GAP times the target size, then resampled to the target size. Larger values are slower and
+# sharper; at 2 the result can't be told apart from resampling the full resolution image.
+REDUCING_GAP = 2.0
+# The metadata kept on resized images. The EXIF data, which may hold the location a photo was taken at, is dropped;
+# the ICC profile keeps the colors of wide gamut photos right.
+KEPT_METADATA = ("icc_profile", "transparency")
+EXIF_ORIENTATION = 0x0112
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)  # the orientations that swap the width and height of the image
+IMAGE_CONTENT_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+}
+
+
+def derivative_filename(filename, derivative, extension=None):
+    """
+    Returns the filename of a derivative of an image in the format of the upload, or in the format of the extension
+    if it is given e.g ("79cff318.jpg", "card") -> "79cff318_card.jpg", ("79cff318.jpg", "card", ".webp") ->
+    "79cff318_card.webp". The full size image in the format of the upload keeps the filename of the upload.
+    """
+    name, upload_extension = os.path.splitext(filename)
+    extension = extension or upload_extension
+    if derivative == "full" and extension == upload_extension:
+        return filename
+    return f"{name}_{derivative}{extension}"
+
+
+def derivative_filenames(filename):
+    """
+    Returns the filenames of all the derivatives of an image.
+    """
+    return [
+        derivative_filename(filename, derivative, extension)
+        for derivative in IMAGE_DERIVATIVES
+        for extension in (None, ".webp")
+    ]
+
+
+def open_image(image_file, max_size):
+    """
+    Decodes an image to be resized to fit in max_size. JPEG images are decoded at the smallest of 1/8, 1/4, 1/2 or
+    full scale that is at least REDUCING_GAP times the resized size (see Image.draft()), so a 12 megapixel phone
+    photo resized to 800 pixels is decoded at 1/2 scale, in a fraction of the time and memory. The image is rotated to
+    its EXIF orientation and its metadata is dropped except for KEPT_METADATA. Returns the image and the format of the
+    file.
+    """
+    image = Image.open(image_file)
+    image_format = image.format
+    max_width, max_height = max_size
+    if image.getexif().get(EXIF_ORIENTATION) in ROTATED_ORIENTATIONS:  # the box is rotated with the image
+        max_width, max_height = max_height, max_width
+    scale = min(max_width / image.width, max_height / image.height)
+    if scale < 1:
+        # draft() only scales down to a size at least as large as the one requested, in both dimensions. It is a
+        # no-op for formats other than JPEG and must be called before the image is loaded.
+        image.draft(
+            None, (int(image.width * scale * REDUCING_GAP), int(image.height * scale * REDUCING_GAP))
+        )
+    image = ImageOps.exif_transpose(image)
+    image.info = {key: value for key, value in image.info.items() if key in KEPT_METADATA}
+    return image, image_format
+
+
+def resize_image(image, size):
+    """
+    Returns a copy of the image resized to fit in size, or an unchanged copy if it already fits.
+    """
+    resized = image.copy()
+    resized.thumbnail(size, reducing_gap=REDUCING_GAP)
+    return resized
+
+
+def save_options(image):
+    """
+    Returns the options of Image.save() that write the metadata kept by open_image().
+    """
+    return {"icc_profile": image.info["icc_profile"]} if image.info.get("icc_profile") else {}
+
+
+def encode_image(image, image_format, **options):
+    """
+    Encodes the image into a BytesIO positioned at its start, with the metadata kept by open_image().
+    """
+    image_file = io.BytesIO()
+    image.save(image_file, format=image_format, **options, **save_options(image))
+    image_file.seek(0)
+    return image_file
+
+
+def resize_derivatives(image):
+    """
+    Yields the (derivative, resized image) pairs of IMAGE_DERIVATIVES. Every size is resized from the one before
+    it rather than from the decoded image, so only the first resize works on the full resolution.
+    """
+    resized = image
+    for derivative, size in IMAGE_DERIVATIVES.items():
+        resized = resize_image(resized, size)
+        yield derivative, resized
+
+
+def webp_compatible(image):
+    if image.mode in ("RGB", "RGBA"):
+        return image
+    return image.convert("RGBA" if "transparency" in image.info or "A" in image.mode else "RGB")
+
+
+def save_derivatives(image_file, filename, store):
+    """
+    Decodes the image file uploaded as filename and resizes it into its derivatives, each of which is passed to
+    store(encoded_image, derivative_filename) as a BytesIO. Returns the variants of the image as recorded in
+    PropertyPhoto.variants e.g {"full": {"width": 800, "height": 600, "filename": "79cff318.jpg", "webp":
+    "79cff318_full.webp"}, "card": {...}, "thumb": {...}}.
+    """
+    image, image_format = open_image(image_file, IMAGE_DERIVATIVES["full"])
+    variants = {}
+    for derivative, resized in resize_derivatives(image):
+        upload_format_filename = derivative_filename(filename, derivative)
+        webp_filename = derivative_filename(filename, derivative, ".webp")
+        store(encode_image(resized, image_format), upload_format_filename)
+        store(encode_image(webp_compatible(resized), "WEBP", quality=WEBP_QUALITY), webp_filename)
+        variants[derivative] = {
+            "width": resized.width,
+            "height": resized.height,
+            "filename": upload_format_filename,
+            "webp": webp_filename,
+        }
+    return variants
+
+
+def save_profile_image(image_file, filename, store):
+    """
+    Decodes a profile or cover photo uploaded as filename, resizes it to fit in PROFILE_IMAGE_SIZE and passes it to
+    store(encoded_image, filename) as a BytesIO.
+    """
+    image, image_format = open_image(image_file, PROFILE_IMAGE_SIZE)
+    store(encode_image(resize_image(image, PROFILE_IMAGE_SIZE), image_format), filename)
@@ -0,0 +1,203 @@
+"""
+Search of property listings. Listings are indexed and searched through a search backend (see SearchBackend), chosen
+with the SEARCH_BACKEND setting: "elasticsearch" (the default) or "memory", an index kept in the memory of every
+worker process for installs without ElasticSearch. The functions of this module add caching on top of the backend.
+"""
+import hashlib
+from importlib import import_module
+from flask import current_app
+from sqlalchemy.orm import Session
+from app import db, redis_client
+from app.cache import two_tier_cache, purge_surrogate_keys, MISSING, SEARCH_SURROGATE_KEY
+from app.search.backend import SearchBackend
+from app.search.documents import (
+    property_document,
+    suggestion_inputs,
+    search_result,
+    iter_property_documents,
+    DESC_EXCERPT_LENGTH,
+    SUGGEST_MIN_PREFIX_LENGTH,
+    SUGGEST_MAX_PREFIX_LENGTH,
+    SEARCH_RESULT_FIELDS,
+    SEARCH_FIELD_BOOSTS,
+    SEARCH_FILTERS,
+    GEO_RADIUS_DEFAULT_KM,
+    GEO_RADIUS_MAX_KM,
+    LOCATION_FACET_SIZE,
+    PRICE_RANGES,
+    MAP_MAX_CLUSTERS,
+    MAP_CLUSTER_ZOOM_OFFSET,
+    MAP_MAX_ZOOM,
+)
+
+SEARCH_BACKENDS = {
+    "elasticsearch": "app.search.elasticsearch_backend.ElasticsearchBackend",
+    "memory": "app.search.memory_backend.InMemorySearchBackend",
+}
+# Incremented on every write to the index. It is part of the key of every cached search so bumping it makes all the
+# cached searches unreachable at once, and they expire after SEARCH_CACHE_TTL without having to be deleted.
+SEARCH_GENERATION_KEY = "search:generation"
+# Sorted set of the ids of the listings written to the index, scored by the generation of their last write. Backends
+# that keep a copy of the index in every process use it to find out what changed, see InMemorySearchBackend.sync().
+SEARCH_CHANGES_KEY = "search:changes"
+# Counters and lag of the draining of the search outbox, see app.base.models.SearchOutbox
+SEARCH_OUTBOX_STATS_KEY = "search:outbox:stats"
+SEARCH_OUTBOX_BATCH_SIZE = 500
+SEARCH_CACHE_TTL = 5 * 60  # seconds
+SUGGEST_CACHE_TTL = 60  # seconds
+
+# Increments the generation and records the listings as changed at the new generation atomically, so that nobody can
+# see the new generation without the changes.
+_bump_search_generation_script = redis_client.register_script(
+    """
+    local generation = redis.call("INCR", KEYS[1])
+    for _, listing_id in ipairs(ARGV) do
+        redis.call("ZADD", KEYS[2], generation, listing_id)
+    end
+    return generation
+    """
+)
+_search_backend = None
+
+
+def search_backend():
+    """
+    Returns the search backend set by the SEARCH_BACKEND setting. The backend is created on first use and its module
+    is only imported then, so e.g the ElasticSearch client isn't needed with SEARCH_BACKEND=memory.
+    """
+    global _search_backend
+    if _search_backend is None:
+        backend_name = current_app.config["SEARCH_BACKEND"]
+        if backend_name not in SEARCH_BACKENDS:
+            raise ValueError(
+                f"Unknown SEARCH_BACKEND {backend_name!r}, use one of {', '.join(SEARCH_BACKENDS)}"
+            )
+        module_name, class_name = SEARCH_BACKENDS[backend_name].rsplit(".", 1)
+        _search_backend = getattr(import_module(module_name), class_name)()
+    return _search_backend
+
+
+def init_index():
+    """
+    Prepares the search backend e.g creates the index and mappings in ElasticSearch.
+    """
+    search_backend().init()
+
+
+def normalize_search_term(search_term):
+    """
+    Normalizes a search term so that searches that are scored the same way share a cache entry:
+    "Lusaka  Apartment" and "apartment lusaka" both become "apartment lusaka".
+    """
+    return " ".join(sorted((search_term or "").lower().split()))
+
+
+def search_generation():
+    return int(redis_client.get(SEARCH_GENERATION_KEY) or 0)
+
+
+def bump_search_generation(*listing_ids):
+    """
+    Increments the search generation, recording the listings that changed if there are any. The cached search
+    result pages are purged with it, since the write may change the results of any search.
+    """
+    if not listing_ids:
+        generation = redis_client.incr(SEARCH_GENERATION_KEY)
+    else:
+        generation = _bump_search_generation_script(
+            keys=[SEARCH_GENERATION_KEY, SEARCH_CHANGES_KEY], args=list(listing_ids)
+        )
+    purge_surrogate_keys(SEARCH_SURROGATE_KEY)
+    return generation
+
+
+def search_docs(search_term, per_page, search_after=None, reverse=False, pit_id=None, filters=None):
+    """
+    Searches for property listings, see SearchBackend.search(). Results are cached in the two tier cache (see
+    app.cache) keyed by the normalized search term, the filters, the page cursor, the page size and the search
+    generation, which every write to the index bumps (see reindex_listings()) so a write to the index is never
+    hidden by a cached search.
+    """
+    normalized_search_term = normalize_search_term(search_term)
+    filters = filters or {}
+    key_source = f"{normalized_search_term}|{sorted(filters.items())}|{search_after}|{reverse}|{per_page}"
+    cache_key = f"search:{search_generation()}:{hashlib.sha1(key_source.encode('utf-8')).hexdigest()}"
+
+    search_page = two_tier_cache.get(cache_key, "search")
+    if search_page is not MISSING:
+        # The cached page is the same at any point in time of this generation
+        return dict(search_page, pit_id=pit_id)
+
+    if search_after and pit_id is None:
+        # A point in time is only opened once the user pages through results that aren't cached, and is then passed
+        # on in the cursors of the next pages. Opening one for every first page or cache hit would leave
+        # ElasticSearch holding a search context per search until it expires.
+        pit_id = open_point_in_time()
+    search_page = search_backend().search(
+        normalized_search_term, per_page, search_after, reverse, pit_id, filters
+    )
+    two_tier_cache.set(cache_key, dict(search_page, pit_id=None), SEARCH_CACHE_TTL)
+    return search_page
+
+
+def suggest_docs(prefix, size=8):
+    """
+    Returns up to `size` listing names and locations that complete the prefix typed in the search box. The
+    suggestions for a prefix are cached in the two tier cache for SUGGEST_CACHE_TTL seconds (per search generation),
+    so the popular prefixes are usually answered from the worker's memory.
+    """
+    prefix = " ".join((prefix or "").lower().split())[:SUGGEST_MAX_PREFIX_LENGTH]
+    if len(prefix) < SUGGEST_MIN_PREFIX_LENGTH:
+        return []
+    cache_key = f"suggest:{search_generation()}:{size}:{prefix}"
+    suggestions = two_tier_cache.get(cache_key, "suggest")
+    if suggestions is not MISSING:
+        return suggestions
+
+    suggestions = search_backend().suggest(prefix, size)
+    two_tier_cache.set(cache_key, suggestions, SUGGEST_CACHE_TTL)
+    return suggestions
+
+
+def map_clusters(bounding_box, zoom, search_term=None, filters=None):
+    """
+    Returns the listings inside the bounding box (west, south, east, north) of the map view grouped into clusters of
+    nearby listings, for the map to show one marker per cluster, see SearchBackend.map_clusters(). The search term
+    and filters are applied as on the search page.
+    """
+    return search_backend().map_clusters(bounding_box, zoom, search_term, filters)
+
+
+def open_point_in_time():
+    """
+    Opens a point in time for paginating through search results. Returns None if the backend doesn't support them.
+    """
+    return search_backend().open_point_in_time()
+
+
+def reindex_listings(db_model, listing_ids):
+    """
+    Brings the documents of the listings in the search index in line with the rows of db_model: the listings that
+    exist are (re)indexed and the others are deleted from the index, each kind with one bulk write. Returns the
+    number of documents indexed and deleted.
+    """
+    listing_ids = set(listing_ids)
+    # Read the listings with a session of our own, iter_property_documents() expunges the objects of the session
+    session = Session(bind=db.engine)
+    try:
+        documents = list(
+            iter_property_documents(
+                db_model, ids=listing_ids, chunk_size=len(listing_ids) or 1, session=session
+            )
+        )
+    finally:
+        session.close()
+    deleted_ids = sorted(listing_ids - {document["id"] for document in documents})
+    backend = search_backend()
+    backend.index_documents(documents)
+    backend.delete_documents(deleted_ids)
+    if listing_ids:
+        # Bump the generation once the documents are searchable, otherwise a search made in between could cache
+        # results without them under the new generation
+        bump_search_generation(*sorted(listing_ids))
+    return len(documents), len(deleted_ids)
@@ -0,0 +1,80 @@
+class SearchBackend:
+    """
+    The interface of the search backends. A backend indexes the documents built by property_document() and answers
+    the searches of the search page, the navbar suggestions and the map view. The backend in use is chosen with the
+    SEARCH_BACKEND setting, see app.search.search_backend().
+    """
+
+    def init(self):
+        """
+        Prepares the backend to serve searches e.g creates the index. Called once when the app starts.
+        """
+
+    def search(self, search_term, per_page, search_after=None, reverse=False, pit_id=None, filters=None):
+        """
+        Returns a page of the listings matching the search term and filters (see SEARCH_FILTERS), sorted by score
+        then id and paginated with search_after: pass the sort values of the last hit of a page to get the next page,
+        or the sort values of the first hit with reverse=True to get the previous page.
+
+        Returns a dictionary with the hits (the SEARCH_RESULT_FIELDS of the listings, each with its "sort" values),
+        the total number of results, whether there are more results after the page in the direction of the search,
+        the point in time id to use for the next page and the facets, a {"type", "location", "price"} dictionary of
+        lists of {"value", "count"} dictionaries.
+        """
+        raise NotImplementedError
+
+    def suggest(self, prefix, size):
+        """
+        Returns up to `size` listing names and locations that complete the prefix typed in the search box.
+        """
+        raise NotImplementedError
+
+    def map_clusters(self, bounding_box, zoom, search_term=None, filters=None):
+        """
+        Returns the listings matching the search term and filters inside the bounding box (west, south, east, north)
+        of the map view grouped into clusters, as a list of {"lat", "lon", "count", "listing_id"} dictionaries. See
+        app.clustering.cluster_points() for how listings are clustered.
+        """
+        raise NotImplementedError
+
+    def open_point_in_time(self):
+        """
+        Returns the id of a point in time for paginating through search results consistently, or None if the
+        backend doesn't support them.
+        """
+        return None
+
+    def index_document(self, document):
+        """
+        Adds or replaces the document of a listing. The document must be searchable when this returns.
+        """
+        raise NotImplementedError
+
+    def delete_document(self, listing_id):
+        """
+        Deletes the document of a listing, if it is in the index. The listing must no longer be found by searches
+        when this returns.
+        """
+        raise NotImplementedError
+
+    def iter_document_hashes(self, chunk_size=1000):
+        """
+        Streams the (listing id, content hash) pairs of the indexed documents ordered by listing id, reading
+        chunk_size documents at a time. The hash is None for documents indexed without one. See app.search.drift.
+        """
+        raise NotImplementedError
+
+    def index_documents(self, documents):
+        """
+        Adds or replaces the documents of many listings, see index_document(). Backends that can write in bulk
+        override this.
+        """
+        for document in documents:
+            self.index_document(document)
+
+    def delete_documents(self, listing_ids):
+        """
+        Deletes the documents of many listings, see delete_document(). Backends that can write in bulk override this.
+        """
+        for listing_id in listing_ids:
+            self.delete_document(listing_id)
@@ -0,0 +1,159 @@
+"""
+The search documents of property listings and the settings of searches, shared by all the search backends.
+"""
+import json
+import hashlib
+from datetime import datetime
+from sqlalchemy.orm import joinedload, selectinload
+
+DESC_EXCERPT_LENGTH = 100
+SUGGEST_MIN_PREFIX_LENGTH = 2
+SUGGEST_MAX_PREFIX_LENGTH = 50
+# Fields returned with every search hit. They hold everything the search results page shows so the page can be
+# rendered without querying the database.
+SEARCH_RESULT_FIELDS = [
+    "id",
+    "name",
+    "desc_excerpt",
+    "price",
+    "location",
+    "type",
+    "owner",
+    "date_listed",
+    "updated_at",
+    "cover_photo_location",
+    "cover_photo_path",
+    "cover_photo_variants",
+]
+# Fields searched by the search term and their boosts
+SEARCH_FIELD_BOOSTS = {"name": 3, "desc": 1, "location": 1}
+# Search filters and the facets counted for them. The facet of a filter is counted with all the other filters
+# applied but not itself, so that e.g every type can still be picked after picking one.
+SEARCH_FILTERS = ("type", "location", "min_price", "max_price", "lat", "lon", "radius")
+GEO_RADIUS_DEFAULT_KM = 5
+GEO_RADIUS_MAX_KM = 100
+LOCATION_FACET_SIZE = 10
+# (from, to) price ranges of the price facet, in Kwacha. Like the min_price and max_price filters, which the
+# ranges link to, "from" is inclusive and "to" exclusive so a price of 5000 is in (5000, 10000) only.
+PRICE_RANGES = [
+    (None, 2500),
+    (2500, 5000),
+    (5000, 10000),
+    (10000, 100000),
+    (100000, 1000000),
+    (1000000, None),
+]
+MAP_MAX_CLUSTERS = 500
+# Listings are clustered by the map tiles of a zoom level this much deeper than the map's, i.e a cluster covers about
+# 1/8th of the width of a 256px tile on screen
+MAP_CLUSTER_ZOOM_OFFSET = 3
+MAP_MAX_ZOOM = 29 - MAP_CLUSTER_ZOOM_OFFSET  # 29 is the highest precision of the geotile_grid aggregation
+
+
+def property_document(obj):
+    """
+    Returns the fields of a Property that are indexed by the search backend, including the owner's username and the
+    cover photo so that search results can be rendered from the index alone.
+    """
+    cover_photo = obj.property_photos[0] if obj.property_photos else None
+    document = {
+        "id": obj.id,
+        "name": obj.name,
+        "desc": obj.desc,
+        "desc_excerpt": obj.desc[:DESC_EXCERPT_LENGTH],
+        "location": obj.location,
+        "price": obj.price,
+        "price_amount": float(obj.price_amount) if obj.price_amount is not None else None,
+        "geo_location": {"lat": obj.latitude, "lon": obj.longitude}
+        if obj.latitude is not None
+        else None,
+        "type": obj.type,
+        "owner": obj.owner.username,
+        "date_listed": obj.date_listed,
+        "updated_at": obj.updated_at,
+        "cover_photo_location": cover_photo.storage_location if cover_photo else None,
+        "cover_photo_path": f"{cover_photo.folder}{cover_photo.filename}" if cover_photo else None,
+        # The resized variants of the cover photo, see app.images.save_derivatives()
+        "cover_photo_variants": json.loads(cover_photo.variants)
+        if cover_photo and cover_photo.variants
+        else None,
+        "suggest": {"input": suggestion_inputs(obj)},
+    }
+    document["content_hash"] = content_hash(document)
+    return document
+
+
+def content_hash(document):
+    """
+    Returns a hash of the fields of a search document, stored with the document so that a document that differs
+    from its listing can be found by comparing hashes, see app.search.drift.
+    """
+    fields = {field: value for field, value in document.items() if field != "content_hash"}
+    return hashlib.sha1(json.dumps(fields, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def suggestion_inputs(obj):
+    """
+    Returns the inputs of the completion field of a listing: every suffix of the name, so that typing "apart" also
+    suggests "Affordable Apartments on rent", and the location.
+    """
+    name_words = obj.name.split()
+    inputs = [" ".join(name_words[i:]) for i in range(len(name_words))]
+    inputs.append(obj.location)
+    return inputs
+
+
+def search_result(document):
+    """
+    Converts the source of a search hit (or a document built by property_document()) into the dictionary the
+    search results template renders. Returns None if the document was indexed before all SEARCH_RESULT_FIELDS were
+    stored, in which case the listing has to be loaded from the database.
+    """
+    if any(field not in document for field in SEARCH_RESULT_FIELDS):
+        return None
+
+    def to_datetime(value):
+        return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+    return {
+        "id": document["id"],
+        "name": document["name"],
+        "desc": document["desc_excerpt"],
+        "price": document["price"],
+        "location": document["location"],
+        "type": document["type"],
+        "owner": document["owner"],
+        "date_listed": to_datetime(document["date_listed"]),
+        "updated_at": to_datetime(document["updated_at"]),
+        "cover_photo_location": document["cover_photo_location"],
+        "cover_photo_path": document["cover_photo_path"],
+        "cover_photo_variants": document["cover_photo_variants"],
+    }
+
+
+def iter_property_documents(db_model, start_after_id=0, chunk_size=1000, ids=None, session=None):
+    """
+    Streams the search documents of the rows of db_model ordered by id, optionally only of the given ids. The rows are
+    read in chunks of chunk_size using the primary key (WHERE id > last id ... LIMIT chunk_size) so only one chunk is
+    in memory at a time and every chunk is an index range scan no matter how far into the table it is.
+
+    Every chunk is expunged from the session once its documents have been built; pass a session of your own when
+    the objects of the current session (e.g the logged in user) must stay attached.
+    """
+    session = session or db_model.query.session
+    last_id = start_after_id
+    while True:
+        query = (
+            session.query(db_model)
+            .options(joinedload(db_model.owner), selectinload(db_model.property_photos))
+            .filter(db_model.id > last_id)
+        )
+        if ids is not None:
+            query = query.filter(db_model.id.in_(ids))
+        rows = query.order_by(db_model.id).limit(chunk_size).all()
+        if not rows:
+            return
+        for row in rows:
+            yield property_document(row)
+        last_id = rows[-1].id
+        session.expunge_all()  # release the chunk from the session's identity map
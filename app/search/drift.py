@@ -0,0 +1,92 @@
+"""
+Finds and repairs the differences between the property table and the search index: listings missing from the index,
+documents that differ from their listing and documents whose listing has been deleted. Both stores are streamed in
+listing id order and merge-joined, so only a chunk of each is in memory at a time whatever the size of the table.
+"""
+import json
+from datetime import datetime
+from sqlalchemy.orm import Session
+from app import db, redis_client
+from app.search import search_backend, reindex_listings, SEARCH_OUTBOX_BATCH_SIZE
+from app.search.documents import iter_property_documents
+
+SEARCH_DRIFT_REPORT_KEY = "search:drift:last_report"
+
+
+def database_document_hashes(db_model, chunk_size=1000):
+    """
+    Streams the (listing id, content hash) pairs of the rows of db_model ordered by id.
+    """
+    session = Session(bind=db.engine)  # iter_property_documents() expunges the objects of its session
+    try:
+        for document in iter_property_documents(db_model, chunk_size=chunk_size, session=session):
+            yield document["id"], document["content_hash"]
+    finally:
+        session.close()
+
+
+def diff_document_hashes(database_hashes, index_hashes):
+    """
+    Merge-joins two streams of (listing id, content hash) pairs ordered by listing id and yields the
+    (listing id, kind) pairs of the listings that differ, where kind is "missing" (in the database only), "stale"
+    (the hashes differ) or "orphaned" (in the index only).
+    """
+    database_hashes, index_hashes = iter(database_hashes), iter(index_hashes)
+    database_item, index_item = next(database_hashes, None), next(index_hashes, None)
+    while database_item is not None or index_item is not None:
+        if index_item is None or (database_item is not None and database_item[0] < index_item[0]):
+            yield database_item[0], "missing"
+            database_item = next(database_hashes, None)
+        elif database_item is None or index_item[0] < database_item[0]:
+            yield index_item[0], "orphaned"
+            index_item = next(index_hashes, None)
+        else:
+            if database_item[1] != index_item[1]:
+                yield database_item[0], "stale"
+            database_item, index_item = next(database_hashes, None), next(index_hashes, None)
+
+
+def check_index_drift(db_model, repair=True, chunk_size=1000, batch_size=SEARCH_OUTBOX_BATCH_SIZE):
+    """
+    Compares the rows of db_model with the documents of the search index and, with repair=True, reindexes the
+    listings that differ in bulk writes of batch_size listings (see reindex_listings()). A listing written during
+    the check may be reported and reindexed needlessly, which is harmless.
+
+    Returns the counts e.g {"database": 1200, "index": 1201, "missing": 0, "stale": 3, "orphaned": 1,
+    "repaired": 4}, which are also saved in redis for /metrics, see last_drift_report().
+    """
+    counts = {"database": 0, "index": 0, "missing": 0, "stale": 0, "orphaned": 0, "repaired": 0}
+
+    def counted(hashes, store):
+        for item in hashes:
+            counts[store] += 1
+            yield item
+
+    to_repair = []
+    for listing_id, kind in diff_document_hashes(
+        counted(database_document_hashes(db_model, chunk_size), "database"),
+        counted(search_backend().iter_document_hashes(chunk_size), "index"),
+    ):
+        counts[kind] += 1
+        if repair:
+            to_repair.append(listing_id)
+            if len(to_repair) == batch_size:
+                reindex_listings(db_model, to_repair)
+                counts["repaired"] += len(to_repair)
+                to_repair = []
+    if to_repair:
+        reindex_listings(db_model, to_repair)
+        counts["repaired"] += len(to_repair)
+
+    redis_client.set(
+        SEARCH_DRIFT_REPORT_KEY, json.dumps(dict(counts, checked_at=datetime.utcnow().isoformat()))
+    )
+    return counts
+
+
+def last_drift_report():
+    """
+    Returns the counts of the last check_index_drift() run with the time it ended, or None if it hasn't run yet.
+    """
+    report = redis_client.get(SEARCH_DRIFT_REPORT_KEY)
+    return json.loads(report) if report else None
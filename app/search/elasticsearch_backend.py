@@ -0,0 +1,653 @@
+import os
+import time
+import threading
+from itertools import chain
+from datetime import datetime, timedelta
+from decouple import config
+from flask import current_app
+from elasticsearch import NotFoundError, RequestError, TransportError
+from elasticsearch.helpers import bulk, parallel_bulk, BulkIndexError
+from elasticsearch_dsl import Document, Keyword, Text, Integer, Date, Completion, Double, GeoPoint, Object
+from elasticsearch_dsl.connections import connections
+from sqlalchemy.orm import Session
+from app import db, redis_client
+from app.search import bump_search_generation
+from app.search.backend import SearchBackend
+from app.search.documents import (
+    iter_property_documents,
+    SEARCH_RESULT_FIELDS,
+    SEARCH_FIELD_BOOSTS,
+    GEO_RADIUS_DEFAULT_KM,
+    LOCATION_FACET_SIZE,
+    PRICE_RANGES,
+    MAP_MAX_CLUSTERS,
+    MAP_CLUSTER_ZOOM_OFFSET,
+    MAP_MAX_ZOOM,
+)
+
+# Searches and writes go through the property_index alias, which points to a versioned index
+# e.g "property_index-20210618100510". See rebuild_index().
+PROPERTY_INDEX_ALIAS = "property_index"
+
+REINDEX_CHECKPOINT_KEY = "search:reindex:last_id"
+# While an index is being rebuilt these keys hold the name of the new index, which receives a copy of every write,
+# and the ids of the documents deleted during the rebuild.
+REBUILD_TARGET_KEY = "search:rebuild:target"
+REBUILD_DELETED_IDS_KEY = "search:rebuild:deleted_ids"
+
+POINT_IN_TIME_KEEP_ALIVE = "5m"
+# Searches against a point in time sort by _shard_doc after the score and id (see ElasticsearchBackend.search()).
+# The listing id is unique so _shard_doc never breaks a tie; the search_after value given for it is the one that
+# excludes the hit the page starts after, by the direction of the sort.
+SHARD_DOC_SEARCH_AFTER = {"asc": 2 ** 63 - 1, "desc": -1}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Returns the ElasticSearch client, which is also the default connection of the ElasticSearch DSL. The connection
+    is created on first use so that importing the search package doesn't require ElasticSearch or its settings.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = connections.create_connection(
+                    hosts=[os.environ.get("ELASTICSEARCH_URL", config("ELASTICSEARCH_URL"))],
+                    http_auth=(
+                        os.environ.get("ELASTICSEARCH_USERNAME", config("ELASTICSEARCH_USERNAME")),
+                        os.environ.get("ELASTICSEARCH_PASS", config("ELASTICSEARCH_PASS")),
+                    ),
+                )
+    return _client
+
+
+class PropertyDataMapping(Document):
+    """
+    This class create a mapping for the data that will be indexed into ElasticSearch from the database.
+    """
+
+    id = Integer()
+    name = Text(analyzer="standard", fields={"raw": Keyword()})
+    desc = Text(analyzer="standard")
+    location = Text(analyzer="standard", fields={"raw": Keyword()})
+    type = Keyword()
+    price_amount = Double()
+    geo_location = GeoPoint()  # None if the location of the listing couldn't be geocoded, see app.geocoding
+    date_listed = Date()
+    updated_at = Date()
+    # Stored only to render search results, not searchable
+    desc_excerpt = Keyword(index=False)
+    price = Keyword(index=False)
+    owner = Keyword(index=False)
+    cover_photo_location = Keyword(index=False)
+    cover_photo_path = Keyword(index=False)
+    cover_photo_variants = Object(enabled=False)
+    content_hash = Keyword(index=False)  # see app.search.documents.content_hash()
+    # Search-as-you-type suggestions for the navbar search box, see ElasticsearchBackend.suggest()
+    suggest = Completion(analyzer="simple")
+
+    class Index:
+        name = PROPERTY_INDEX_ALIAS  # Name of the alias of the index where the data that will be searched is indexed
+        settings = {"number_of_shards": 1}
+
+    def save(self, **kwargs):
+        return super(PropertyDataMapping, self).save(**kwargs)
+
+
+class ElasticsearchBackend(SearchBackend):
+    """
+    Serves searches from the property_index alias of an ElasticSearch cluster.
+    """
+
+    @property
+    def client(self):
+        return get_client()
+
+    def init(self):
+        init_index()
+
+    def search(self, search_term, per_page, search_after=None, reverse=False, pit_id=None, filters=None):
+        """
+        Results are paginated with search_after instead of from/size, so ElasticSearch doesn't have to collect and
+        sort every result before the requested page and the cost of a page doesn't grow with its depth. If pit_id is
+        given the search runs against that point in time, so that pages stay consistent while listings are being
+        indexed; an expired point in time is ignored. The facet counts are computed by the same request, see
+        search_facet_aggregations().
+        """
+        filter_clauses = search_filter_clauses(filters or {})
+        sort_order = ("asc", "desc") if reverse else ("desc", "asc")
+        body = {
+            "query": text_query(search_term),
+            # Filters are applied to the hits after the aggregations have been computed, see
+            # search_facet_aggregations()
+            "post_filter": {"bool": {"filter": list(filter_clauses.values())}},
+            "aggs": search_facet_aggregations(filter_clauses),
+            "size": per_page + 1,  # one extra hit tells whether there is another page
+            "sort": [{"_score": sort_order[0]}, {"id": sort_order[1]}],
+            "_source": SEARCH_RESULT_FIELDS,
+        }
+        if search_after:
+            body["search_after"] = list(search_after)[:2]
+
+        response = None
+        if pit_id:
+            # ElasticSearch adds an implicit _shard_doc tiebreaker to the sort of a search against a point in time,
+            # whose search_after must then have a value for it too. It is added explicitly so that the search_after
+            # of every search has as many values as its sort, and left out of the sort values of the hits so that
+            # cursors hold the (score, id) of a hit whether or not the page was searched with a point in time.
+            pit_body = dict(
+                body,
+                sort=body["sort"] + [{"_shard_doc": sort_order[1]}],
+                pit={"id": pit_id, "keep_alive": POINT_IN_TIME_KEEP_ALIVE},
+            )
+            if search_after:
+                pit_body["search_after"] = body["search_after"] + [SHARD_DOC_SEARCH_AFTER[sort_order[1]]]
+            try:
+                response = self.client.search(body=pit_body)
+            except NotFoundError:  # the point in time has expired
+                pit_id = None
+        if response is None:
+            response = self.client.search(index=PROPERTY_INDEX_ALIAS, body=body)
+
+        raw_hits = response["hits"]["hits"]
+        has_more = len(raw_hits) > per_page
+        raw_hits = raw_hits[:per_page]
+        if reverse:
+            raw_hits.reverse()
+        hits = [
+            dict(hit["_source"], id=int(hit["_id"]), sort=hit["sort"][:2]) for hit in raw_hits
+        ]
+        return {
+            "hits": hits,
+            "total": response["hits"]["total"]["value"],
+            "has_more": has_more,
+            "pit_id": response.get("pit_id", pit_id),
+            "facets": search_facets(response["aggregations"]),
+        }
+
+    def suggest(self, prefix, size):
+        """
+        Completion suggesters are served from an in-memory structure in ElasticSearch.
+        """
+        completion = {"field": "suggest", "size": size, "skip_duplicates": True}
+        if len(prefix) >= 4:  # tolerate typos once there are enough characters for them to be likely
+            completion["fuzzy"] = {"fuzziness": 1}
+        response = self.client.search(
+            index=PROPERTY_INDEX_ALIAS,
+            body={
+                "_source": ["name", "location"],
+                "suggest": {"listing": {"prefix": prefix, "completion": completion}},
+            },
+        )
+        suggestions = []
+        for option in response["suggest"]["listing"][0]["options"]:
+            source = option["_source"]
+            # Suggest the location if that is what matched, else the name of the listing
+            if option["text"].lower() == source["location"].lower():
+                text = source["location"]
+            else:
+                text = source["name"]
+            if text not in suggestions:
+                suggestions.append(text)
+        return suggestions
+
+    def map_clusters(self, bounding_box, zoom, search_term=None, filters=None):
+        """
+        Listings are clustered with the geotile_grid aggregation and each cluster is placed at the centroid of its
+        listings.
+        """
+        west, south, east, north = bounding_box
+        query = {
+            "bool": {
+                "filter": [
+                    {
+                        "geo_bounding_box": {
+                            "geo_location": {
+                                "top_left": {"lat": north, "lon": west},
+                                "bottom_right": {"lat": south, "lon": east},
+                            }
+                        }
+                    },
+                    *search_filter_clauses(filters or {}).values(),
+                ]
+            }
+        }
+        if search_term:
+            query["bool"]["must"] = text_query(search_term)
+        response = self.client.search(
+            index=PROPERTY_INDEX_ALIAS,
+            body={
+                "size": 0,
+                "query": query,
+                "aggs": {
+                    "clusters": {
+                        "geotile_grid": {
+                            "field": "geo_location",
+                            "precision": min(zoom, MAP_MAX_ZOOM) + MAP_CLUSTER_ZOOM_OFFSET,
+                            "size": MAP_MAX_CLUSTERS,
+                        },
+                        "aggs": {
+                            "centroid": {"geo_centroid": {"field": "geo_location"}},
+                            "listing_id": {"min": {"field": "id"}},
+                        },
+                    }
+                },
+            },
+        )
+        return [
+            {
+                "lat": bucket["centroid"]["location"]["lat"],
+                "lon": bucket["centroid"]["location"]["lon"],
+                "count": bucket["doc_count"],
+                "listing_id": int(bucket["listing_id"]["value"]),
+            }
+            for bucket in response["aggregations"]["clusters"]["buckets"]
+        ]
+
+    def open_point_in_time(self):
+        """
+        Returns None if the cluster doesn't support points in time (ElasticSearch < 7.10).
+        """
+        try:
+            response = self.client.open_point_in_time(
+                index=PROPERTY_INDEX_ALIAS, keep_alive=POINT_IN_TIME_KEEP_ALIVE
+            )
+        except (AttributeError, TransportError):
+            return None
+        return response["id"]
+
+    def iter_document_hashes(self, chunk_size=1000):
+        """
+        Pages through the index sorted by id with search_after. The pages aren't read from a point in time, so a
+        document written during the scan may be seen in its old or new version.
+        """
+        search_after = None
+        while True:
+            body = {
+                "size": chunk_size,
+                "sort": [{"id": "asc"}],
+                "_source": ["content_hash"],
+                "track_total_hits": False,
+            }
+            if search_after is not None:
+                body["search_after"] = search_after
+            hits = self.client.search(index=PROPERTY_INDEX_ALIAS, body=body)["hits"]["hits"]
+            if not hits:
+                return
+            for hit in hits:
+                yield int(hit["_id"]), hit["_source"].get("content_hash")
+            search_after = hits[-1]["sort"]
+
+    def index_document(self, document):
+        self.index_documents([document])
+
+    def delete_document(self, listing_id):
+        self.delete_documents([listing_id])
+
+    def index_documents(self, documents):
+        self.bulk_write(
+            {"_op_type": "index", "_id": document["id"], "_source": document}
+            for document in documents
+        )
+
+    def delete_documents(self, listing_ids):
+        listing_ids = list(listing_ids)
+        self.bulk_write({"_op_type": "delete", "_id": listing_id} for listing_id in listing_ids)
+        if listing_ids and redis_client.get(REBUILD_TARGET_KEY):
+            redis_client.sadd(REBUILD_DELETED_IDS_KEY, *listing_ids)
+
+    def bulk_write(self, actions):
+        """
+        Sends the actions to the index through the bulk API, waiting for them to be searchable. While the index is
+        being rebuilt they are also sent to the new index, see rebuild_index(). Deleting a document that isn't in the
+        index is not an error; any other failed action raises BulkIndexError.
+        """
+        actions = list(actions)
+        if not actions:
+            return
+        targets = [(PROPERTY_INDEX_ALIAS, {"refresh": "wait_for"})]
+        rebuild_target = redis_client.get(REBUILD_TARGET_KEY)
+        if rebuild_target:
+            targets.append((rebuild_target.decode("utf-8"), {}))
+        for index_name, options in targets:
+            _, errors = bulk(
+                self.client,
+                (dict(action, _index=index_name) for action in actions),
+                raise_on_error=False,
+                **options,
+            )
+            errors = [error for error in errors if error.get("delete", {}).get("status") != 404]
+            if errors:
+                raise BulkIndexError(f"{len(errors)} document(s) failed to be written to {index_name}", errors)
+
+
+def text_query(search_term):
+    return {
+        "multi_match": {
+            "query": search_term,
+            "fields": [f"{field}^{boost}" for field, boost in SEARCH_FIELD_BOOSTS.items()],
+            "fuzziness": 1,
+        }
+    }
+
+
+def search_filter_clauses(filters):
+    """
+    Returns the ElasticSearch filter clauses of the search filters, keyed by the facet they belong to.
+    """
+    clauses = {}
+    if filters.get("type"):
+        clauses["type"] = {"term": {"type": filters["type"]}}
+    if filters.get("location"):
+        clauses["location"] = {"term": {"location.raw": filters["location"]}}
+    price_range = {}
+    if filters.get("min_price") is not None:
+        price_range["gte"] = filters["min_price"]
+    if filters.get("max_price") is not None:
+        price_range["lt"] = filters["max_price"]
+    if price_range:
+        clauses["price"] = {"range": {"price_amount": price_range}}
+    if filters.get("lat") is not None and filters.get("lon") is not None:
+        # Not a facet, so it narrows the counts of every facet
+        clauses["distance"] = {
+            "geo_distance": {
+                "distance": f"{filters.get('radius', GEO_RADIUS_DEFAULT_KM)}km",
+                "geo_location": {"lat": filters["lat"], "lon": filters["lon"]},
+            }
+        }
+    return clauses
+
+
+def search_facet_aggregations(filter_clauses):
+    """
+    Returns the aggregations counting the results of a search per type, location and price range. Each facet is
+    counted with the filters of the other facets only, that is why the filters go in a post_filter instead of the
+    query.
+    """
+    facets = {
+        "type": {"terms": {"field": "type"}},
+        "location": {"terms": {"field": "location.raw", "size": LOCATION_FACET_SIZE}},
+        "price": {
+            "range": {
+                "field": "price_amount",
+                "ranges": [
+                    {key: value for key, value in (("from", low), ("to", high)) if value is not None}
+                    for low, high in PRICE_RANGES
+                ],
+            }
+        },
+    }
+    return {
+        facet: {
+            "filter": {
+                "bool": {
+                    "filter": [clause for name, clause in filter_clauses.items() if name != facet]
+                }
+            },
+            "aggs": {"values": aggregation},
+        }
+        for facet, aggregation in facets.items()
+    }
+
+
+def search_facets(aggregations):
+    """
+    Converts the facet aggregations of a search response into lists of {"value", "count"} dictionaries, leaving out
+    empty buckets. The value of a price bucket is its [from, to] range.
+    """
+    facets = {}
+    for facet in ("type", "location"):
+        facets[facet] = [
+            {"value": bucket["key"], "count": bucket["doc_count"]}
+            for bucket in aggregations[facet]["values"]["buckets"]
+        ]
+    facets["price"] = [
+        {"value": list(price_range), "count": bucket["doc_count"]}
+        for price_range, bucket in zip(PRICE_RANGES, aggregations["price"]["values"]["buckets"])
+        if bucket["doc_count"]
+    ]
+    return facets
+
+
+def generate_index_actions(
+    db_model, start_after_id=0, chunk_size=1000, index_name=PROPERTY_INDEX_ALIAS, session=None, ids=None
+):
+    """
+    Streams the rows of db_model ordered by id, optionally only of the given ids, as ElasticSearch bulk index
+    actions, see iter_property_documents().
+    """
+    for document in iter_property_documents(db_model, start_after_id, chunk_size, ids=ids, session=session):
+        yield {
+            "_index": index_name,
+            "_id": document["id"],
+            "_source": document,
+        }
+
+
+def bulk_index_existing_data(
+    db_model,
+    batch_size=500,
+    chunk_size=1000,
+    thread_count=4,
+    resume=False,
+    checkpoint_store=None,
+    progress_callback=None,
+    index_name=PROPERTY_INDEX_ALIAS,
+):
+    """
+    Indexes the rows of db_model into ElasticSearch through the bulk API. Up to thread_count bulk requests of
+    batch_size documents are in flight at once. Documents are written to index_name, the property_index alias by
+    default.
+
+    The id of the last document that ElasticSearch has acknowledged, with every document before it, is saved in
+    checkpoint_store (a redis client) after every batch. With resume=True indexing starts after that id, so an
+    interrupted reindex can be continued instead of restarted. The checkpoint stops at the first document that
+    failed and is kept when the run ends with failures, so resuming retries them. progress_callback(indexed, failed,
+    total, last_id, elapsed_seconds) is called after every batch. Returns a dictionary with the number of documents
+    indexed and failed, the checkpoint and the throughput.
+    """
+    start_after_id = 0
+    if resume and checkpoint_store is not None:
+        start_after_id = int(checkpoint_store.get(REINDEX_CHECKPOINT_KEY) or 0)
+
+    # parallel_bulk pulls the actions from a thread of its own, which has no app context, so the documents are read
+    # with a session bound to the engine rather than the app's scoped session.
+    session = Session(bind=db.engine)
+    try:
+        total = session.query(db_model).filter(db_model.id > start_after_id).count()
+
+        indexed = failed = 0
+        last_id = checkpoint_id = start_after_id
+        started_at = time.monotonic()
+        # parallel_bulk yields one result per action in the same order as the actions, so when the result of a
+        # document is seen every document before it has been acknowledged too.
+        results = parallel_bulk(
+            get_client(),
+            generate_index_actions(db_model, start_after_id, chunk_size, index_name, session),
+            thread_count=thread_count,
+            chunk_size=batch_size,
+            queue_size=thread_count,
+            raise_on_error=False,
+            raise_on_exception=False,
+        )
+        for ok, result in results:
+            last_id = int(result["index"]["_id"])
+            if ok:
+                indexed += 1
+                if not failed:
+                    checkpoint_id = last_id
+            else:
+                failed += 1
+            if (indexed + failed) % batch_size == 0:
+                if checkpoint_store is not None:
+                    checkpoint_store.set(REINDEX_CHECKPOINT_KEY, checkpoint_id)
+                if progress_callback is not None:
+                    progress_callback(indexed, failed, total, last_id, time.monotonic() - started_at)
+    finally:
+        session.close()
+
+    elapsed = time.monotonic() - started_at
+    bump_search_generation()
+    if checkpoint_store is not None:
+        if failed:
+            checkpoint_store.set(REINDEX_CHECKPOINT_KEY, checkpoint_id)
+        else:
+            checkpoint_store.delete(REINDEX_CHECKPOINT_KEY)  # the reindex has completed
+    if progress_callback is not None:
+        progress_callback(indexed, failed, total, last_id, elapsed)
+    return {
+        "indexed": indexed,
+        "failed": failed,
+        "checkpoint_id": checkpoint_id,
+        "seconds": round(elapsed, 2),
+        "docs_per_second": round(indexed / elapsed, 1) if elapsed else 0,
+    }
+
+
+def index_existing_data(db_model):
+    """
+    This function can be used to indexed existing data from the database into ElasticSearch.
+    """
+    return bulk_index_existing_data(db_model)
+
+
+def versioned_index_name():
+    return f"{PROPERTY_INDEX_ALIAS}-{datetime.utcnow().strftime('%Y%m%d%H%M%S')}"
+
+
+def create_versioned_index(index_name):
+    """
+    Creates an index with the current settings and mappings of PropertyDataMapping.
+    """
+    PropertyDataMapping._index.clone(name=index_name).create(using=get_client())
+
+
+def indices_behind_alias():
+    es = get_client()
+    if not es.indices.exists_alias(name=PROPERTY_INDEX_ALIAS):
+        return []
+    return list(es.indices.get_alias(name=PROPERTY_INDEX_ALIAS).keys())
+
+
+def init_index():
+    """
+    Creates the first versioned index and points the property_index alias to it if the alias doesn't exist yet.
+    Installs that still have a concrete index named property_index keep using it until rebuild_index() is run.
+
+    The fields added to PropertyDataMapping since an existing index was created are added to its mapping; changing
+    the mapping of an existing field needs rebuild_index().
+    """
+    es = get_client()
+    if es.indices.exists_alias(name=PROPERTY_INDEX_ALIAS) or es.indices.exists(
+        index=PROPERTY_INDEX_ALIAS
+    ):
+        try:
+            es.indices.put_mapping(
+                index=PROPERTY_INDEX_ALIAS, body=PropertyDataMapping._doc_type.mapping.to_dict()
+            )
+        except RequestError as err:
+            current_app.logger.warning(f"The mapping of {PROPERTY_INDEX_ALIAS} needs a rebuild: {err}")
+        return
+    index_name = versioned_index_name()
+    create_versioned_index(index_name)
+    es.indices.put_alias(
+        index=index_name, name=PROPERTY_INDEX_ALIAS, body={"is_write_index": True}
+    )
+
+
+def rebuild_index(db_model, keep=1, catch_up_margin=60, progress_callback=None, **bulk_options):
+    """
+    Rebuilds the search index without downtime, e.g after changing PropertyDataMapping:
+
+    1. A new versioned index is created with the current mappings.
+    2. Every listing is bulk indexed into it while searches keep using the old index. Writes made in the meantime
+       are copied to the new index by ElasticsearchBackend.index_document() and delete_document().
+    3. Listings updated since the rebuild started (minus catch_up_margin seconds) are indexed again and listings
+       deleted during the rebuild are deleted again, in case the bulk indexing wrote an older copy after the write.
+    4. The property_index alias is atomically switched to the new index.
+    5. Old versioned indices are deleted, except the `keep` most recent ones which are kept for rolling back.
+
+    Returns the name of the new index.
+    """
+    es = get_client()
+    new_index = versioned_index_name()
+    create_versioned_index(new_index)
+    redis_client.delete(REBUILD_DELETED_IDS_KEY)
+    redis_client.set(REBUILD_TARGET_KEY, new_index)
+    started_at = datetime.utcnow()
+    try:
+        summary = bulk_index_existing_data(
+            db_model,
+            index_name=new_index,
+            progress_callback=progress_callback,
+            **bulk_options,
+        )
+        if summary["failed"]:
+            raise RuntimeError(
+                f"{summary['failed']} documents failed to be indexed into {new_index}, the alias wasn't switched"
+            )
+
+        # Catch up with the writes made while the bulk indexing was running
+        changed_since = started_at - timedelta(seconds=catch_up_margin)
+        session = Session(bind=db.engine)
+        try:
+            changed_ids = [
+                listing_id
+                for listing_id, in session.query(db_model.id).filter(db_model.updated_at >= changed_since)
+            ]
+            index_actions = (
+                generate_index_actions(db_model, index_name=new_index, session=session, ids=changed_ids)
+                if changed_ids
+                else ()
+            )
+            delete_actions = (
+                {"_op_type": "delete", "_index": new_index, "_id": int(deleted_id)}
+                for deleted_id in redis_client.smembers(REBUILD_DELETED_IDS_KEY)
+            )
+            _, errors = bulk(es, chain(index_actions, delete_actions), raise_on_error=False)
+        finally:
+            session.close()
+        errors = [error for error in errors if error.get("delete", {}).get("status") != 404]
+        if errors:
+            raise BulkIndexError(f"{len(errors)} document(s) failed to be caught up in {new_index}", errors)
+        es.indices.refresh(index=new_index)
+
+        old_indices = indices_behind_alias()
+        actions = [
+            {"remove": {"index": old_index, "alias": PROPERTY_INDEX_ALIAS}}
+            for old_index in old_indices
+        ]
+        if not old_indices and es.indices.exists(index=PROPERTY_INDEX_ALIAS):
+            # A concrete index named property_index from before indices were versioned. It has to be removed in
+            # the same request that creates the alias since an alias can't have the name of an index.
+            actions.append({"remove_index": {"index": PROPERTY_INDEX_ALIAS}})
+        actions.append(
+            {"add": {"index": new_index, "alias": PROPERTY_INDEX_ALIAS, "is_write_index": True}}
+        )
+        es.indices.update_aliases(body={"actions": actions})
+        bump_search_generation()
+    except Exception:
+        es.indices.delete(index=new_index, ignore=404)
+        raise
+    finally:
+        redis_client.delete(REBUILD_TARGET_KEY, REBUILD_DELETED_IDS_KEY)
+
+    prune_old_indices(new_index, keep)
+    return new_index
+
+
+def prune_old_indices(current_index, keep=1):
+    """
+    Deletes the versioned indices that are not behind the alias, except the `keep` most recent ones.
+    """
+    es = get_client()
+    versioned_indices = sorted(
+        es.indices.get(index=f"{PROPERTY_INDEX_ALIAS}-*").keys(), reverse=True
+    )
+    old_indices = [index for index in versioned_indices if index != current_index]
+    for old_index in old_indices[keep:]:
+        es.indices.delete(index=old_index, ignore=404)
+    return old_indices[keep:]
@@ -0,0 +1,437 @@
+"""
+A search backend that keeps an inverted index of the listings in the memory of every process, for installs, tests
+and benchmarks without an ElasticSearch cluster. The index is built from the property table on first use and kept up
+to date with the listings written by any process, see InMemorySearchBackend.sync().
+"""
+import math
+import re
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, defaultdict
+import numpy as np
+from sqlalchemy.orm import Session
+from app import db, redis_client
+from app.clustering import cluster_points
+from app.search import search_generation, SEARCH_CHANGES_KEY
+from app.search.backend import SearchBackend
+from app.search.documents import (
+    iter_property_documents,
+    SEARCH_RESULT_FIELDS,
+    SEARCH_FIELD_BOOSTS,
+    GEO_RADIUS_DEFAULT_KM,
+    LOCATION_FACET_SIZE,
+    PRICE_RANGES,
+)
+
+TOKEN_RE = re.compile(r"\w+")
+# BM25 parameters, the same as ElasticSearch's defaults
+BM25_K1 = 1.2
+BM25_B = 0.75
+TYPE_FACET_SIZE = 10  # the default size of ElasticSearch's terms aggregation
+EARTH_RADIUS_KM = 6371.0088
+
+
+def tokenize(text):
+    return TOKEN_RE.findall((text or "").lower())
+
+
+def normalize_suggestion(text):
+    return " ".join((text or "").lower().split())
+
+
+def deletions(term):
+    """
+    Returns the strings made by deleting one character of the term e.g "rent" -> {"ent", "rnt", "ret", "ren"}.
+    """
+    return {term[:i] + term[i + 1:] for i in range(len(term))}
+
+
+def within_one_edit(a, b):
+    """
+    Returns whether a can be changed into b by inserting, deleting or substituting one character or swapping two
+    adjacent characters, i.e whether they are a fuzziness 1 match.
+    """
+    if a == b:
+        return True
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) == len(b):
+        differences = [i for i in range(len(a)) if a[i] != b[i]]
+        if len(differences) == 1:
+            return True
+        if len(differences) == 2:
+            i, j = differences
+            return j == i + 1 and a[i] == b[j] and a[j] == b[i]
+        return False
+    shorter, longer = (a, b) if len(a) < len(b) else (b, a)
+    i = 0
+    while i < len(shorter) and shorter[i] == longer[i]:
+        i += 1
+    return shorter[i:] == longer[i + 1:]
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """
+    Returns the great circle distance between two points (haversine formula).
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def filter_predicates(filters):
+    """
+    Returns the search filters as functions of a document, keyed by the facet they belong to like
+    app.search.elasticsearch_backend.search_filter_clauses().
+    """
+    predicates = {}
+    if filters.get("type"):
+        predicates["type"] = lambda document: document["type"] == filters["type"]
+    if filters.get("location"):
+        predicates["location"] = lambda document: document["location"] == filters["location"]
+    min_price, max_price = filters.get("min_price"), filters.get("max_price")
+    if min_price is not None or max_price is not None:
+        predicates["price"] = lambda document: (
+            document["price_amount"] is not None
+            and (min_price is None or document["price_amount"] >= min_price)
+            and (max_price is None or document["price_amount"] < max_price)
+        )
+    if filters.get("lat") is not None and filters.get("lon") is not None:
+        radius = filters.get("radius", GEO_RADIUS_DEFAULT_KM)
+        predicates["distance"] = lambda document: (
+            document["geo_location"] is not None
+            and distance_km(
+                filters["lat"],
+                filters["lon"],
+                document["geo_location"]["lat"],
+                document["geo_location"]["lon"],
+            )
+            <= radius
+        )
+    return predicates
+
+
+class InvertedIndex:
+    """
+    An inverted index of search documents. Searches are scored like ElasticSearch's multi_match query: every field of
+    SEARCH_FIELD_BOOSTS is scored with BM25 and a document gets the boosted score of its best field. Every word of
+    the search term also matches the words of the index within one edit of it (fuzziness 1), weighted down by the
+    number of edits relative to the length of the word, and the matches of a word share one document frequency, as
+    Lucene does.
+
+    Fuzzy matches are found with a table of every word of the index and every deletion of one of its characters:
+    two words are within one edit of each other only if they, or one of their deletions, are the same, so the words
+    close to a search word are found with len(word) + 1 lookups instead of comparing it to the whole vocabulary.
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.postings = {field: defaultdict(dict) for field in SEARCH_FIELD_BOOSTS}  # term -> {listing id: tf}
+        self.field_lengths = {field: {} for field in SEARCH_FIELD_BOOSTS}
+        self.total_field_lengths = dict.fromkeys(SEARCH_FIELD_BOOSTS, 0)
+        self.term_counts = Counter()  # term -> number of fields of documents the term is in
+        self.fuzzy_lookup = defaultdict(set)  # term or deletion of a term -> terms
+        self.suggestions = []  # sorted (normalized completion input, listing id) pairs
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, document):
+        listing_id = document["id"]
+        self.remove(listing_id)
+        self.documents[listing_id] = document
+        for field in SEARCH_FIELD_BOOSTS:
+            tokens = tokenize(document[field])
+            self.field_lengths[field][listing_id] = len(tokens)
+            self.total_field_lengths[field] += len(tokens)
+            for term, frequency in Counter(tokens).items():
+                self.postings[field][term][listing_id] = frequency
+                self._add_term(term)
+        for suggestion_input in document["suggest"]["input"]:
+            insort(self.suggestions, (normalize_suggestion(suggestion_input), listing_id))
+
+    def remove(self, listing_id):
+        document = self.documents.pop(listing_id, None)
+        if document is None:
+            return
+        for field in SEARCH_FIELD_BOOSTS:
+            self.total_field_lengths[field] -= self.field_lengths[field].pop(listing_id)
+            for term in set(tokenize(document[field])):
+                postings = self.postings[field][term]
+                del postings[listing_id]
+                if not postings:
+                    del self.postings[field][term]
+                self._remove_term(term)
+        for suggestion_input in document["suggest"]["input"]:
+            entry = (normalize_suggestion(suggestion_input), listing_id)
+            position = bisect_left(self.suggestions, entry)
+            if position < len(self.suggestions) and self.suggestions[position] == entry:
+                del self.suggestions[position]
+
+    def _add_term(self, term):
+        self.term_counts[term] += 1
+        if self.term_counts[term] == 1:
+            for key in deletions(term) | {term}:
+                self.fuzzy_lookup[key].add(term)
+
+    def _remove_term(self, term):
+        self.term_counts[term] -= 1
+        if self.term_counts[term] == 0:
+            del self.term_counts[term]
+            for key in deletions(term) | {term}:
+                self.fuzzy_lookup[key].discard(term)
+                if not self.fuzzy_lookup[key]:
+                    del self.fuzzy_lookup[key]
+
+    def expand(self, term):
+        """
+        Returns the terms of the index within one edit of the term with the weight of their matches.
+        """
+        candidates = set()
+        for key in deletions(term) | {term}:
+            candidates |= self.fuzzy_lookup.get(key, set())
+        matches = {}
+        for candidate in candidates:
+            if within_one_edit(term, candidate):
+                weight = 1.0 if candidate == term else 1.0 - 1.0 / min(len(term), len(candidate))
+                if weight > 0:
+                    matches[candidate] = weight
+        return matches
+
+    def score(self, search_term):
+        """
+        Returns the {listing id: score} of the documents matching the search term.
+        """
+        document_count = len(self.documents)
+        if not document_count:
+            return {}
+        field_scores = {field: defaultdict(float) for field in SEARCH_FIELD_BOOSTS}
+        for query_term in set(tokenize(search_term)):
+            matches = self.expand(query_term)
+            for field, boost in SEARCH_FIELD_BOOSTS.items():
+                average_length = self.total_field_lengths[field] / document_count or 1
+                field_lengths = self.field_lengths[field]
+                matched_postings = {
+                    term: self.postings[field][term]
+                    for term in matches
+                    if term in self.postings[field]
+                }
+                if not matched_postings:
+                    continue
+                # The matches share the document frequency of the most frequent one so that a rare misspelling
+                # doesn't outscore the word that was searched for
+                document_frequency = max(len(postings) for postings in matched_postings.values())
+                idf = math.log(1 + (document_count - document_frequency + 0.5) / (document_frequency + 0.5))
+                term_scores = {}  # the score of the best match of the query term in each document
+                for term, postings in matched_postings.items():
+                    weight = matches[term]
+                    for listing_id, frequency in postings.items():
+                        length_norm = 1 - BM25_B + BM25_B * field_lengths[listing_id] / average_length
+                        term_score = weight * idf * frequency / (frequency + BM25_K1 * length_norm)
+                        if term_score > term_scores.get(listing_id, 0):
+                            term_scores[listing_id] = term_score
+                for listing_id, term_score in term_scores.items():
+                    field_scores[field][listing_id] += boost * term_score
+
+        scores = {}
+        for scores_of_field in field_scores.values():
+            for listing_id, field_score in scores_of_field.items():
+                if field_score > scores.get(listing_id, 0):
+                    scores[listing_id] = field_score
+        return scores
+
+    def facets(self, listing_ids, predicates):
+        """
+        Counts the documents per type, location and price range. A document is counted in a facet if it passes the
+        filters of the other facets, like app.search.elasticsearch_backend.search_facet_aggregations().
+        """
+        counts = {"type": Counter(), "location": Counter(), "price": Counter()}
+        for listing_id in listing_ids:
+            document = self.documents[listing_id]
+            failed_filters = {name for name, predicate in predicates.items() if not predicate(document)}
+            for facet, facet_counts in counts.items():
+                if failed_filters - {facet}:
+                    continue
+                if facet != "price":
+                    facet_counts[document[facet]] += 1
+                elif document["price_amount"] is not None:
+                    for price_range in PRICE_RANGES:
+                        low, high = price_range
+                        if (low is None or document["price_amount"] >= low) and (
+                            high is None or document["price_amount"] < high
+                        ):
+                            facet_counts[price_range] += 1
+                            break
+
+        def top_values(facet_counts, size):
+            ordered = sorted(facet_counts.items(), key=lambda item: (-item[1], item[0]))
+            return [{"value": value, "count": count} for value, count in ordered[:size]]
+
+        return {
+            "type": top_values(counts["type"], TYPE_FACET_SIZE),
+            "location": top_values(counts["location"], LOCATION_FACET_SIZE),
+            "price": [
+                {"value": list(price_range), "count": counts["price"][price_range]}
+                for price_range in PRICE_RANGES
+                if counts["price"][price_range]
+            ],
+        }
+
+    def complete(self, prefix, size):
+        """
+        Returns up to `size` listing names and locations with a completion input starting with the prefix.
+        """
+        suggestions = []
+        position = bisect_left(self.suggestions, (prefix,))
+        while position < len(self.suggestions) and len(suggestions) < size:
+            suggestion_input, listing_id = self.suggestions[position]
+            if not suggestion_input.startswith(prefix):
+                break
+            document = self.documents[listing_id]
+            # Suggest the location if that is what matched, else the name of the listing
+            if suggestion_input == normalize_suggestion(document["location"]):
+                text = document["location"]
+            else:
+                text = document["name"]
+            if text not in suggestions:
+                suggestions.append(text)
+            position += 1
+        return suggestions
+
+
+class InMemorySearchBackend(SearchBackend):
+    """
+    Serves searches from an InvertedIndex in the memory of the process. Points in time are not supported, pages of
+    results are consistent as long as no listing is written in between.
+    """
+
+    def __init__(self):
+        self.index = InvertedIndex()
+        self.generation = None  # the search generation the index is up to date with, None until it is built
+        self._lock = threading.RLock()
+
+    def init(self):
+        self.sync()
+
+    def sync(self):
+        """
+        Brings the index up to date. On first use the index is built from the property table; after that the listings
+        changed since the index was last synced, by this process or any other, are read from the database again.
+        They are found in the SEARCH_CHANGES_KEY sorted set, which bump_search_generation() updates on every write.
+        """
+        generation = search_generation()
+        if generation == self.generation:
+            return
+        with self._lock:
+            if self.generation is None:
+                self._load()
+            elif generation != self.generation:
+                changed_ids = [
+                    int(listing_id)
+                    for listing_id in redis_client.zrangebyscore(
+                        SEARCH_CHANGES_KEY, f"({self.generation}", generation
+                    )
+                ]
+                if changed_ids:
+                    self._load(changed_ids)
+            self.generation = generation
+
+    def _load(self, listing_ids=None):
+        """
+        Indexes the listings with the given ids, or all of them, from the database and removes the given listings
+        that no longer exist. The listings are read with a session of their own so that the objects of the request's
+        session aren't expunged.
+        """
+        from app.base.models import Property  # imported here because app.base.models imports app.search
+
+        session = Session(bind=db.engine)
+        try:
+            loaded_ids = set()
+            for document in iter_property_documents(Property, ids=listing_ids, session=session):
+                self.index.add(document)
+                loaded_ids.add(document["id"])
+        finally:
+            session.close()
+        for listing_id in set(listing_ids or []) - loaded_ids:
+            self.index.remove(listing_id)
+
+    def search(self, search_term, per_page, search_after=None, reverse=False, pit_id=None, filters=None):
+        self.sync()
+        with self._lock:
+            scores = self.index.score(search_term)
+            predicates = filter_predicates(filters or {})
+            matching_ids = [
+                listing_id
+                for listing_id in scores
+                if all(predicate(self.index.documents[listing_id]) for predicate in predicates.values())
+            ]
+            # Sorted by score then id like the ElasticSearch backend, as the (-score, id) pairs of the hits
+            sort_keys = sorted((-scores[listing_id], listing_id) for listing_id in matching_ids)
+            if reverse:
+                end = bisect_left(sort_keys, (-search_after[0], search_after[1])) if search_after else len(sort_keys)
+                has_more = end > per_page
+                page_keys = sort_keys[max(end - per_page, 0):end]
+            else:
+                start = bisect_right(sort_keys, (-search_after[0], search_after[1])) if search_after else 0
+                has_more = len(sort_keys) - start > per_page
+                page_keys = sort_keys[start:start + per_page]
+
+            hits = []
+            for negative_score, listing_id in page_keys:
+                document = self.index.documents[listing_id]
+                hit = {field: document[field] for field in SEARCH_RESULT_FIELDS}
+                hit["sort"] = [-negative_score, listing_id]
+                hits.append(hit)
+            return {
+                "hits": hits,
+                "total": len(sort_keys),
+                "has_more": has_more,
+                "pit_id": None,
+                "facets": self.index.facets(scores, predicates),
+            }
+
+    def suggest(self, prefix, size):
+        self.sync()
+        with self._lock:
+            return self.index.complete(prefix, size)
+
+    def map_clusters(self, bounding_box, zoom, search_term=None, filters=None):
+        self.sync()
+        with self._lock:
+            listing_ids = self.index.score(search_term) if search_term else self.index.documents
+            predicates = filter_predicates(filters or {})
+            documents = [
+                self.index.documents[listing_id]
+                for listing_id in listing_ids
+                if self.index.documents[listing_id]["geo_location"] is not None
+            ]
+        documents = [
+            document
+            for document in documents
+            if all(predicate(document) for predicate in predicates.values())
+        ]
+        return cluster_points(
+            np.array([document["id"] for document in documents], dtype=np.int32),
+            np.array([document["geo_location"]["lat"] for document in documents], dtype=np.float32),
+            np.array([document["geo_location"]["lon"] for document in documents], dtype=np.float32),
+            bounding_box,
+            zoom,
+        )
+
+    def iter_document_hashes(self, chunk_size=1000):
+        self.sync()
+        with self._lock:
+            hashes = sorted(
+                (listing_id, document.get("content_hash"))
+                for listing_id, document in self.index.documents.items()
+            )
+        return iter(hashes)
+
+    def index_document(self, document):
+        with self._lock:
+            if self.generation is not None:  # else the listing will be read when the index is built
+                self.index.add(document)
+
+    def delete_document(self, listing_id):
+        with self._lock:
+            self.index.remove(listing_id)
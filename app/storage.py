@@ -0,0 +1,41 @@
+"""
+Writing of processed images to where they are served from: the static folder of the app server or Amazon S3,
+depending on the IMAGE_STORAGE_LOCATION setting. Images are encoded in memory (see app.images) and written straight
+to their final location by the worker that processed them, so workers don't need a filesystem in common.
+"""
+import os
+import shutil
+from pathlib import Path
+from app import s3
+from app.images import IMAGE_CONTENT_TYPES
+from config import IMAGE_UPLOAD_CONFIG
+
+STORAGE_LOCATION = IMAGE_UPLOAD_CONFIG["STORAGE_LOCATION"]  # "app_server_storage" or "amazon_s3"
+aws_bucket_name = IMAGE_UPLOAD_CONFIG["AMAZON_S3"]["S3_BUCKET"]
+
+
+def store_image(image_file, key, static_folder):
+    """
+    Writes an image file (e.g a BytesIO) under key, a path relative to the static folder or to the root of the S3
+    bucket e.g "assets/images/listings/5de13ba062fa4/79cff318.jpg". On the app server the image is written under
+    a temporary name and renamed once complete, so a page never serves a partly written image. Doesn't use the app
+    context, so it can be called from any thread.
+    """
+    _, file_ext = os.path.splitext(key)
+    if STORAGE_LOCATION == "amazon_s3":
+        s3.upload_fileobj(
+            image_file,
+            aws_bucket_name,
+            key,
+            ExtraArgs={
+                "ACL": "public-read",
+                "ContentType": IMAGE_CONTENT_TYPES.get(file_ext.lower(), "image/png"),
+            },
+        )
+        return
+    path = Path(static_folder) / key
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = path.with_name(f".{path.name}.part")
+    with open(partial_path, "wb") as partial_file:
+        shutil.copyfileobj(image_file, partial_file)
+    os.replace(partial_path, path)
@@ -1,17 +1,23 @@
 import os
-import io
+import time
 import shutil
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from flask import current_app
-from PIL import Image
+from celery.utils.log import get_task_logger
 from decouple import config
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
-from app import db, s3, redis_client
+from app import db, s3
+from app.uploads import open_staged_upload, discard_staged_uploads, clean_up_staged_uploads
+from app.images import save_derivatives, save_profile_image, derivative_filenames
+from app.storage import store_image
 from config import IMAGE_UPLOAD_CONFIG
-from app.base.models import DeactivatedUserAccounts, User
+from app.base.models import DeactivatedUserAccounts, User, Property, PropertyPhoto, SearchOutbox
+from app.search import SEARCH_OUTBOX_BATCH_SIZE
+from app.search.drift import check_index_drift
 
 
 celery = current_app.celery
@@ -22,11 +28,15 @@ profile_image_upload_dir = IMAGE_UPLOAD_CONFIG["IMAGE_SAVE_DIRECTORIES"][
 cover_image_upload_dir = IMAGE_UPLOAD_CONFIG["IMAGE_SAVE_DIRECTORIES"][
     "USER_COVER_IMAGES"
 ]
-temp_image_dir = IMAGE_UPLOAD_CONFIG["IMAGE_SAVE_DIRECTORIES"]["TEMP_DIR"]
 property_listing_images_dir = IMAGE_UPLOAD_CONFIG["IMAGE_SAVE_DIRECTORIES"][
     "PROPERTY_LISTING_IMAGES"
 ]
 image_server_config = IMAGE_UPLOAD_CONFIG["STORAGE_LOCATION"]
+# Threads resizing the images of a listing at once. Pillow releases the GIL while it decodes, resizes and encodes
+# so the images are processed in parallel; a process pool isn't an option as the prefork pool's worker processes
+# are daemonic and can't have children.
+IMAGE_PROCESSING_THREADS = int(os.environ.get("IMAGE_PROCESSING_THREADS", os.cpu_count() or 1))
+logger = get_task_logger(__name__)
 
 
 @celery.task()
@@ -35,78 +45,14 @@ def profile_image_process(image_name, photo_type=None):
     Resize the image file using the PIL image library and save it to the app server or
     Amazon S3 depending on the configuration.
     """
-    temp_image_path = Path(f"{current_app.root_path}/base/static/{temp_image_dir}")
-
-    img_data = redis_client.get(
-        image_name
-    )  # get image from redis using image_name as the key
-    decoded_img = Image.open(io.BytesIO(img_data))
-    decoded_img.thumbnail((800, 800))
-    decoded_img.save(
-        f"{temp_image_path}/{image_name}"
-    )  # save the resized image to the temporary folder
-
-    if image_server_config == "app_server_storage":
-        profile_image_upload_path = Path(
-            f"{current_app.root_path}/base/static/{profile_image_upload_dir}"
-        )
-        cover_image_upload_path = Path(
-            f"{current_app.root_path}/base/static/{cover_image_upload_dir}"
-        )
+    destination_dir = profile_image_upload_dir if photo_type == "profile" else cover_image_upload_dir
 
-        if photo_type == "profile":
-            shutil.copyfile(
-                f"{temp_image_path}/{image_name}",
-                f"{profile_image_upload_path}/{image_name}",
-            )
-        else:
-            shutil.copyfile(
-                f"{temp_image_path}/{image_name}",
-                f"{cover_image_upload_path}/{image_name}",
-            )
-        os.remove(
-            f"{temp_image_path}/{image_name}"
-        )  # Clean up by deleting the image in the temporary folder
-        redis_client.delete(image_name)  # Clean up by deleting the image in redis
-    elif image_server_config == "amazon_s3":
-        # Upload the image to Amazon S3 if the configuration is set to "amazon_s3"
-        profile_image_upload_to_S3.delay(
-            image_name, profile_image_upload_dir
-        ) if photo_type == "profile" else profile_image_upload_to_S3.delay(
-            image_name, cover_image_upload_dir
-        )
+    def store(image_file, filename):
+        store_image(image_file, f"{destination_dir}{filename}", current_app.static_folder)
 
-
-@celery.task()
-def profile_image_upload_to_S3(image_name, destination_dir):
-    """
-    Upload the image to Amazon S3.
-    """
-    # Full path where the image is stored temporary
-    temp_image_path = Path(f"{current_app.root_path}/base/static/{temp_image_dir}")
-
-    jpeg_extensions = [".jpg", ".jpeg"]
-    _, file_ext = os.path.splitext(image_name)
-
-    try:
-        s3.upload_fileobj(
-            open(f"{temp_image_path}/{image_name}", "rb"),
-            aws_bucket_name,
-            f"{destination_dir}{image_name}",
-            ExtraArgs={
-                "ACL": "public-read",
-                "ContentType": "image/jpeg"
-                if file_ext in jpeg_extensions
-                else "image/png",
-            },
-        )
-        os.remove(
-            f"{temp_image_path}/{image_name}"
-        )  # Clean up by deleting the image in the temporary folder
-        redis_client.delete(image_name)  # Clean up by deleting the image in redis
-        return "file uploaded"
-    except Exception as err:
-        print(err)
+    with open_staged_upload(image_name) as staged_image:
+        save_profile_image(staged_image, image_name, store)
+    discard_staged_uploads(image_name)  # Clean up by deleting the staged upload
 
 
 @celery.task()
@@ -144,79 +90,61 @@ def send_email(to, subject, template):
         print(err)
 
 
-@celery.task()
-def process_property_listing_images(redis_img_dict_key):
+def resize_listing_image(images_folder, image_filename, static_folder):
     """
-    Resize the image file using the PIL image library and save it to the app server or
-    Amazon S3 depending on the configuration. Since a property listing has many images, a
-    directory is created with redis_img_dict_key as the directory name where the image files
-    are saved.
+    Resizes an image staged in images_folder into its derivatives (see app.images) and stores them in images_folder
+    on the app server or Amazon S3. Runs in the threads of process_property_listing_images so it must not use the
+    app context. Returns the variants of the image and the seconds it took.
     """
-    temp_image_path = Path(f"{current_app.root_path}/base/static/{temp_image_dir}")
-    redis_images = redis_client.hgetall(redis_img_dict_key)
-    folder_to_save_image = Path(
-        f"{current_app.root_path}/base/static/{property_listing_images_dir}{redis_img_dict_key}"
-    )
-    folder_to_save_image.mkdir(parents=True, exist_ok=True)
-
-    for image_filename in redis_images.keys():
-        image_filename = image_filename.decode("utf-8")
-        image_file = redis_client.hget(redis_img_dict_key, image_filename)
-        image_obj = Image.open(io.BytesIO(image_file))
-        image_obj.thumbnail((800, 800))
-        image_obj.save(
-            f"{current_app.root_path}/base/static/{temp_image_dir}{image_filename}"
-        )
+    started_at = time.perf_counter()
 
-        if image_server_config == "app_server_storage":
-            shutil.copyfile(
-                f"{temp_image_path}/{image_filename}",
-                f"{folder_to_save_image}/{image_filename}",
-            )
-            os.remove(
-                f"{temp_image_path}/{image_filename}"
-            )  # Clean up by deleting the image in the temporary folder
-            redis_client.hdel(
-                redis_img_dict_key, image_filename
-            )  # Clean up by deleting the image in redis
-        elif image_server_config == "amazon_s3":
-            # Upload the image to Amazon S3 if the configuration is set to "amazon_s3"
-            property_image_upload_to_S3.delay(image_filename, redis_img_dict_key)
+    def store(image_file, filename):
+        # images_folder is used as a name for the folder where images will be saved
+        store_image(image_file, f"{property_listing_images_dir}{images_folder}/{filename}", static_folder)
+
+    with open_staged_upload(f"{images_folder}/{image_filename}") as staged_image:
+        variants = save_derivatives(staged_image, image_filename, store)
+    return variants, time.perf_counter() - started_at
 
 
 @celery.task()
-def property_image_upload_to_S3(image_name, redis_img_dict_key):
+def process_property_listing_images(listing_id, images_folder, image_filenames):
     """
-    Upload the image to Amazon S3.
-    """
-    # Full path where the image is stored temporary
-    temp_image_path = Path(f"{current_app.root_path}/base/static/{temp_image_dir}")
+    Resize the image files of the listing staged in images_folder (see app.uploads) into several sizes, each in the
+    format of the upload and as WebP (see app.images), and save them to the app server or Amazon S3 depending on the
+    configuration. Since a property listing has many images, a directory is created with images_folder as the
+    directory name where the image files are saved.
 
-    jpeg_extensions = [".jpg", ".jpeg"]
-    _, file_ext = os.path.splitext(image_name)
+    The images are resized and stored in parallel by up to IMAGE_PROCESSING_THREADS threads, so a listing takes
+    about as long as its slowest image. Returns the seconds each image took, which are also logged.
+    """
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(min(IMAGE_PROCESSING_THREADS, len(image_filenames)), 1)) as pool:
+        futures = {
+            image_filename: pool.submit(
+                resize_listing_image, images_folder, image_filename, current_app.static_folder
+            )
+            for image_filename in image_filenames
+        }
+    variants, timings = {}, {}
+    for image_filename, future in futures.items():
+        try:
+            variants[image_filename], timings[image_filename] = future.result()
+        except Exception as err:
+            # The staged upload is left for clean_up_staged_uploads() to delete
+            logger.error(f"Failed to process {images_folder}/{image_filename}: {err}")
+            continue
+        logger.info(f"Processed {images_folder}/{image_filename} in {timings[image_filename]:.3f}s")
+    logger.info(
+        f"Processed {len(variants)}/{len(image_filenames)} images of {images_folder} in "
+        f"{time.perf_counter() - started_at:.3f}s"
+    )
 
-    try:
-        s3.upload_fileobj(
-            open(f"{temp_image_path}/{image_name}", "rb"),
-            aws_bucket_name,
-            # redis_images_key is used as a name for the folder where images will be saved
-            f"{property_listing_images_dir}{redis_img_dict_key}/{image_name}",
-            ExtraArgs={
-                "ACL": "public-read",
-                "ContentType": "image/jpeg"
-                if file_ext in jpeg_extensions
-                else "image/png",
-            },
-        )
-        os.remove(
-            f"{temp_image_path}/{image_name}"
-        )  # Clean up by deleting the image in the temporary folder
-        redis_client.hdel(
-            redis_img_dict_key, image_name
-        )  # Clean up by deleting the image in redis
-        return "file uploaded"
-    except Exception as err:
-        print(err)
+    # Clean up by deleting the staged uploads, all at once
+    discard_staged_uploads(*(f"{images_folder}/{image_filename}" for image_filename in variants))
+    # Record the variants once they are in place, the pages start to link to them
+    PropertyPhoto.record_variants(listing_id, f"{images_folder}/", variants)
+    return timings
 
 
 @celery.task()
@@ -229,9 +157,11 @@ def delete_property_listing_images(
 
     if images_location == "amazon_s3":
         for image_name in images_list[1:]:
-            s3.delete_object(
-                Bucket=s3_bucket_name, Key=f"{image_path}{images_folder}{image_name}"
-            )
+            # The resized variants of the image, see app.images
+            for filename in derivative_filenames(image_name):
+                s3.delete_object(
+                    Bucket=s3_bucket_name, Key=f"{image_path}{images_folder}{filename}"
+                )
     elif images_location == "app_server_storage":
         try:
             path_to_image = Path(
@@ -243,6 +173,43 @@ def delete_property_listing_images(
     return "deletion task completed"
 
 
+@celery.task(bind=True, max_retries=8)
+def drain_search_outbox(self):
+    """
+    Applies the pending entries of the search outbox to the search index in batches, see SearchOutbox.drain(). While
+    the search backend fails the task is retried with an exponential backoff; the entries stay in the outbox until
+    they are applied.
+    """
+    drained = 0
+    try:
+        while True:
+            batch_drained = SearchOutbox.drain(SEARCH_OUTBOX_BATCH_SIZE)
+            drained += batch_drained
+            if batch_drained < SEARCH_OUTBOX_BATCH_SIZE:
+                return drained
+    except Exception as err:
+        db.session.rollback()
+        SearchOutbox.record_failure()
+        raise self.retry(exc=err, countdown=min(2 ** self.request.retries, 300))
+
+
+@celery.task()
+def check_search_index_drift(repair=True):
+    """
+    Finds the listings whose search index documents differ from the database and reindexes them, see
+    app.search.drift. Returns the counts of the check.
+    """
+    return check_index_drift(Property, repair=repair)
+
+
+@celery.task()
+def remove_expired_staged_uploads():
+    """
+    Deletes the staged uploads that were never processed, see app.uploads.
+    """
+    return clean_up_staged_uploads()
+
+
 @celery.task()
 def delete_user_account(scheduled_acc_for_deletion):
     current_datetime = datetime.today()
@@ -0,0 +1,130 @@
+"""
+Staging of uploaded images until a Celery worker has processed them. Uploads are streamed in chunks to a spool
+directory or to Amazon S3 (the UPLOAD_STAGING_BACKEND setting) and only their keys are passed to the tasks, so an
+upload is never held whole in the memory of a web worker or stored in redis.
+
+Staged uploads are deleted once they have been processed. The ones that never are, e.g because their task failed,
+are deleted when they are older than UPLOAD_STAGING_TTL by the clean_up_staged_uploads task.
+"""
+import os
+import time
+import tempfile
+from pathlib import Path
+from app import s3
+from config import IMAGE_UPLOAD_CONFIG
+
+STAGING_CONFIG = IMAGE_UPLOAD_CONFIG["STAGING"]
+STAGING_BACKEND = STAGING_CONFIG["BACKEND"]  # "filesystem" or "amazon_s3"
+SPOOL_DIR = Path(STAGING_CONFIG["SPOOL_DIR"]).resolve()
+STAGING_S3_PREFIX = STAGING_CONFIG["S3_PREFIX"]
+STAGING_TTL = STAGING_CONFIG["TTL"]  # seconds
+aws_bucket_name = IMAGE_UPLOAD_CONFIG["AMAZON_S3"]["S3_BUCKET"]
+
+CHUNK_SIZE = 64 * 1024
+# Uploads read back from S3 are kept in memory up to this size and spooled to a temporary file above it
+SPOOLED_MAX_SIZE = 2 * 1024 * 1024
+S3_DELETE_BATCH_SIZE = 1000  # the most keys a DeleteObjects request accepts
+
+
+def staged_path(key):
+    """
+    Returns the path of the staged upload in the spool directory. Keys are relative paths e.g
+    "5de13ba062fa4/79cff318.jpg"; a key that points outside of the spool directory raises ValueError.
+    """
+    path = (SPOOL_DIR / key).resolve()
+    if SPOOL_DIR not in path.parents:
+        raise ValueError(f"Invalid staged upload key {key!r}")
+    return path
+
+
+def stage_upload(file_storage, key):
+    """
+    Streams an uploaded file (a werkzeug FileStorage) to the staging area under key.
+    """
+    if STAGING_BACKEND == "amazon_s3":
+        s3.upload_fileobj(file_storage.stream, aws_bucket_name, f"{STAGING_S3_PREFIX}{key}")
+        return
+    path = staged_path(key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write under a temporary name and rename once complete so a task never reads a partly written upload
+    partial_path = path.with_name(f".{path.name}.part")
+    with open(partial_path, "wb") as staged_file:
+        file_storage.save(staged_file, CHUNK_SIZE)
+    os.replace(partial_path, path)
+
+
+def open_staged_upload(key):
+    """
+    Returns the staged upload as a readable and seekable binary file, which the caller must close. Uploads staged
+    in S3 are downloaded into a SpooledTemporaryFile.
+    """
+    if STAGING_BACKEND == "amazon_s3":
+        staged_file = tempfile.SpooledTemporaryFile(max_size=SPOOLED_MAX_SIZE)
+        s3.download_fileobj(aws_bucket_name, f"{STAGING_S3_PREFIX}{key}", staged_file)
+        staged_file.seek(0)
+        return staged_file
+    return open(staged_path(key), "rb")
+
+
+def discard_staged_uploads(*keys):
+    """
+    Deletes staged uploads, with one request per S3_DELETE_BATCH_SIZE uploads when they are staged in S3. The
+    folders left empty in the spool directory are removed too.
+    """
+    if STAGING_BACKEND == "amazon_s3":
+        for start in range(0, len(keys), S3_DELETE_BATCH_SIZE):
+            s3.delete_objects(
+                Bucket=aws_bucket_name,
+                Delete={
+                    "Objects": [
+                        {"Key": f"{STAGING_S3_PREFIX}{key}"}
+                        for key in keys[start:start + S3_DELETE_BATCH_SIZE]
+                    ],
+                    "Quiet": True,
+                },
+            )
+        return
+    folders = set()
+    for key in keys:
+        path = staged_path(key)
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        folders.add(path.parent)
+    for folder in folders - {SPOOL_DIR}:
+        try:
+            folder.rmdir()
+        except OSError:  # not empty or already removed
+            pass
+
+
+def clean_up_staged_uploads(ttl=STAGING_TTL):
+    """
+    Deletes the staged uploads older than ttl seconds. Returns the number of uploads deleted.
+    """
+    cutoff = time.time() - ttl
+    if STAGING_BACKEND == "amazon_s3":
+        expired_keys = []
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=aws_bucket_name, Prefix=STAGING_S3_PREFIX):
+            for staged_object in page.get("Contents", []):
+                if staged_object["LastModified"].timestamp() < cutoff:
+                    expired_keys.append(staged_object["Key"][len(STAGING_S3_PREFIX):])
+        discard_staged_uploads(*expired_keys)
+        return len(expired_keys)
+
+    deleted = 0
+    # Sorted in reverse so the files of a folder are seen before the folder
+    for path in sorted(SPOOL_DIR.rglob("*"), reverse=True):
+        try:
+            if path.stat().st_mtime >= cutoff:
+                continue
+            if path.is_dir():
+                path.rmdir()
+            else:
+                path.unlink()
+                deleted += 1
+        except OSError:  # deleted by a task meanwhile, or a folder that isn't empty
+            pass
+    return deleted
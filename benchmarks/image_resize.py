@@ -0,0 +1,108 @@
+"""
+Compares the CPU time and peak memory of resizing uploaded photos into the listing image derivatives with a full
+decode of the image ("before") and with app.images.open_image(), which decodes JPEG images at a reduced resolution
+("after").
+
+    python -m benchmarks.image_resize [image ...]
+
+Importing app.images initialises the app package, so the benchmark runs in the same environment as the app: the
+requirements installed and the settings read by config.py (SECRET_KEY, JWT_SECRET_KEY, IMAGE_STORAGE_LOCATION,
+S3_BUCKET, AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY) set in .env or in the environment. No connection is made to
+the database, redis or S3.
+
+Without arguments a 12 megapixel JPEG like the ones taken by phones, with an EXIF orientation tag, is generated and
+used. Every measurement runs in a new process so the peak RSS of one doesn't hide the next one's; the baseline
+is the peak RSS of the process before resizing.
+"""
+import io
+import sys
+import time
+import resource
+import multiprocessing
+from PIL import Image
+from app.images import EXIF_ORIENTATION, IMAGE_DERIVATIVES, open_image, resize_derivatives
+
+PHONE_PHOTO_SIZE = (4032, 3024)
+ROUNDS = 3
+
+
+def phone_photo():
+    """
+    Returns the bytes of a 12 megapixel JPEG taken with the phone held upright (EXIF orientation 6), with smooth
+    gradients and some sensor noise like a photo of a room.
+    """
+    gradient = Image.linear_gradient("L").resize(PHONE_PHOTO_SIZE)
+    noise = Image.effect_noise(PHONE_PHOTO_SIZE, 16)
+    image = Image.merge("RGB", (gradient, Image.blend(gradient, noise, 0.3), gradient.rotate(180)))
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = 6
+    image_file = io.BytesIO()
+    image.save(image_file, format="JPEG", quality=90, exif=exif.tobytes())
+    return image_file.getvalue()
+
+
+def resize_full_decode(image_bytes):
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    resized = image
+    for size in IMAGE_DERIVATIVES.values():
+        resized = resized.copy()
+        resized.thumbnail(size)
+    return resized.size
+
+
+def resize_draft_decode(image_bytes):
+    image, _ = open_image(io.BytesIO(image_bytes), IMAGE_DERIVATIVES["full"])
+    for _, resized in resize_derivatives(image):
+        pass
+    return resized.size
+
+
+RESIZERS = {"before": resize_full_decode, "after": resize_draft_decode}
+
+
+def measure(mode, image_bytes, results):
+    """
+    Resizes the image ROUNDS times and puts the mean CPU time in ms, and the peak RSS of the process in MiB before
+    and after resizing.
+    """
+    resize = RESIZERS[mode]
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    rss_unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    baseline_rss_mib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_unit
+    started = time.process_time()
+    for _ in range(ROUNDS):
+        resize(image_bytes)
+    cpu_ms = (time.process_time() - started) / ROUNDS * 1000
+    peak_rss_mib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_unit
+    results.put((cpu_ms, baseline_rss_mib, peak_rss_mib))
+
+
+def run(mode, image_bytes):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=measure, args=(mode, image_bytes, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main(paths):
+    if paths:
+        images = {}
+        for path in paths:
+            with open(path, "rb") as image_file:
+                images[path] = image_file.read()
+    else:
+        images = {"generated 12MP JPEG": phone_photo()}
+
+    print(f"{'image':<32}{'mode':<8}{'CPU ms':>10}{'baseline RSS MiB':>18}{'peak RSS MiB':>14}")
+    for name, image_bytes in images.items():
+        for mode in RESIZERS:
+            cpu_ms, baseline_rss_mib, peak_rss_mib = run(mode, image_bytes)
+            print(f"{name[-32:]:<32}{mode:<8}{cpu_ms:>10.1f}{baseline_rss_mib:>18.1f}{peak_rss_mib:>14.1f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,6 +4,7 @@ Copyright (c) 2019 - present AppSeed.us
 """
 
 import os
+import tempfile
 from decouple import config
 
 
@@ -27,7 +28,12 @@ class Config(object):
     JWT_BLACKLIST_TOKEN_CHECKS = ["access", "refresh"]
     JWT_ACCESS_TOKEN_EXPIRES = 43200
     ELASTICSEARCH_URL = os.environ.get("ELASTICSEARCH_URL", "http://localhost:9200")
-    RESULTS_PER_PAGE = os.environ.get("RESULTS_PER_PAGE", 25)
+    # "elasticsearch", or "memory" to search an index kept in the memory of each worker, see app.search
+    SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "elasticsearch")
+    RESULTS_PER_PAGE = int(os.environ.get("RESULTS_PER_PAGE", 25))
+    LISTINGS_PER_PAGE = int(os.environ.get("LISTINGS_PER_PAGE", 24))
+    # Part of every ETag, change it on deploys that change the templates so browsers don't keep showing old pages
+    ETAG_VERSION = os.environ.get("ETAG_VERSION", "1")
 
 
 class ProductionConfig(Config):
@@ -70,7 +76,16 @@ IMAGE_UPLOAD_CONFIG = {
         "PROPERTY_LISTING_IMAGES": "assets/images/listings/",
         "USER_PROFILE_IMAGES": "assets/images/user/profile/",
         "USER_COVER_IMAGES": "assets/images/user/cover/",
-        "TEMP_DIR": "assets/images/temp/"
     },
-    "STORAGE_LOCATION": os.environ.get("IMAGE_STORAGE_LOCATION", config("IMAGE_STORAGE_LOCATION"))
+    "STORAGE_LOCATION": os.environ.get("IMAGE_STORAGE_LOCATION", config("IMAGE_STORAGE_LOCATION")),
+    # Where uploaded images wait for the Celery workers to process them, see app.uploads. With "filesystem" the
+    # spool directory must be shared by the web and worker hosts; "amazon_s3" stages them in S3_BUCKET instead.
+    "STAGING": {
+        "BACKEND": os.environ.get("UPLOAD_STAGING_BACKEND", "filesystem"),
+        "SPOOL_DIR": os.environ.get(
+            "UPLOAD_SPOOL_DIR", os.path.join(tempfile.gettempdir(), "property-deals-uploads")
+        ),
+        "S3_PREFIX": "staging/uploads/",
+        "TTL": int(os.environ.get("UPLOAD_STAGING_TTL", 24 * 60 * 60)),  # seconds
+    },
 }
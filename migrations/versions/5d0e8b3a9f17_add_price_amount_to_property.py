@@ -0,0 +1,83 @@
+"""add price_amount to property
+
+Revision ID: 5d0e8b3a9f17
+Revises: c4d27e9f1a03
+Create Date: 2026-10-18 16:22:09.408215
+
+"""
+import re
+from decimal import Decimal, InvalidOperation
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5d0e8b3a9f17'
+down_revision = 'c4d27e9f1a03'
+branch_labels = None
+depends_on = None
+
+# Copy of app.base.models.parse_price() as it was when this migration was written
+PRICE_NUMBER = r"((?:\d{1,3}(?:[, ]\d{3})+|\d+)(?:\.\d+)?)\s*(k|m|thousand|million)?\b"
+PRICE_RE = re.compile(PRICE_NUMBER, re.IGNORECASE)
+CURRENCY_PRICE_RE = re.compile(r"(?:zmw|zk|k|\$)\s*" + PRICE_NUMBER, re.IGNORECASE)
+PRICE_MULTIPLIERS = {"k": 1000, "thousand": 1000, "m": 1000000, "million": 1000000}
+PRICE_AMOUNT_LIMIT = 10 ** 10
+BATCH_SIZE = 1000
+
+
+def parse_price(price):
+    match = CURRENCY_PRICE_RE.search(price or "") or PRICE_RE.search(price or "")
+    if match is None:
+        return None
+    number, multiplier = match.groups()
+    try:
+        amount = Decimal(re.sub(r"[, ]", "", number))
+    except InvalidOperation:
+        return None
+    if multiplier:
+        amount *= PRICE_MULTIPLIERS[multiplier.lower()]
+    try:
+        amount = amount.quantize(Decimal("0.01"))
+    except InvalidOperation:  # more digits than the decimal context holds
+        return None
+    if amount >= PRICE_AMOUNT_LIMIT:  # e.g a phone number rather than a price
+        return None
+    return amount
+
+
+def upgrade():
+    op.add_column('property', sa.Column('price_amount', sa.Numeric(precision=12, scale=2), nullable=True))
+
+    connection = op.get_bind()
+    property_table = sa.table(
+        'property',
+        sa.column('id', sa.Integer),
+        sa.column('price', sa.String),
+        sa.column('price_amount', sa.Numeric(precision=12, scale=2)),
+    )
+    update = (
+        property_table.update()
+        .where(property_table.c.id == sa.bindparam('property_id'))
+        .values(price_amount=sa.bindparam('amount'))
+    )
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select([property_table.c.id, property_table.c.price])
+            .where(property_table.c.id > last_id)
+            .order_by(property_table.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        amounts = [
+            {'property_id': row.id, 'amount': parse_price(row.price)}
+            for row in rows
+        ]
+        connection.execute(update, amounts)
+        last_id = rows[-1].id
+
+
+def downgrade():
+    op.drop_column('property', 'price_amount')
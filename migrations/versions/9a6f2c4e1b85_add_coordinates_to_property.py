@@ -0,0 +1,163 @@
+"""add latitude and longitude to property
+
+Revision ID: 9a6f2c4e1b85
+Revises: 5d0e8b3a9f17
+Create Date: 2026-10-18 17:48:31.572604
+
+"""
+import re
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a6f2c4e1b85'
+down_revision = '5d0e8b3a9f17'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+# Copy of app.geocoding as it was when this migration was written
+# Place name: (latitude, longitude, town the place is in)
+TOWNS = {
+    "lusaka": (-15.4167, 28.2833, "lusaka"),
+    "ndola": (-12.9587, 28.6366, "ndola"),
+    "kitwe": (-12.8024, 28.2132, "kitwe"),
+    "kabwe": (-14.4469, 28.4464, "kabwe"),
+    "chingola": (-12.5290, 27.8838, "chingola"),
+    "mufulira": (-12.5497, 28.2407, "mufulira"),
+    "livingstone": (-17.8419, 25.8543, "livingstone"),
+    "luanshya": (-13.1367, 28.4166, "luanshya"),
+    "kasama": (-10.2129, 31.1808, "kasama"),
+    "chipata": (-13.6333, 32.6500, "chipata"),
+    "solwezi": (-12.1688, 26.3894, "solwezi"),
+    "mansa": (-11.1998, 28.8943, "mansa"),
+    "mongu": (-15.2484, 23.1274, "mongu"),
+    "choma": (-16.8065, 26.9531, "choma"),
+    "mazabuka": (-15.8561, 27.7480, "mazabuka"),
+    "kafue": (-15.7691, 28.1814, "kafue"),
+    "chililabombwe": (-12.3700, 27.8280, "chililabombwe"),
+    "kalulushi": (-12.8415, 28.0948, "kalulushi"),
+    "kapiri mposhi": (-13.9710, 28.6690, "kapiri mposhi"),
+    "siavonga": (-16.5383, 28.7088, "siavonga"),
+    "monze": (-16.2803, 27.4732, "monze"),
+    "chirundu": (-16.0333, 28.8500, "chirundu"),
+    "mpika": (-11.8343, 31.4529, "mpika"),
+    "petauke": (-14.2426, 31.3253, "petauke"),
+    "nakonde": (-9.3444, 32.7470, "nakonde"),
+    "mbala": (-8.8446, 31.3656, "mbala"),
+    "kaoma": (-14.7833, 24.8000, "kaoma"),
+    "chongwe": (-15.3290, 28.6820, "chongwe"),
+    "chibombo": (-14.6570, 28.0700, "chibombo"),
+    "lundazi": (-12.2928, 33.1783, "lundazi"),
+    "sesheke": (-17.4760, 24.2960, "sesheke"),
+    "kasempa": (-13.4584, 25.8338, "kasempa"),
+    "samfya": (-11.3650, 29.5550, "samfya"),
+    "nchelenge": (-9.3450, 28.7340, "nchelenge"),
+}
+AREAS = {
+    "kabulonga": (-15.4250, 28.3400, "lusaka"),
+    "woodlands": (-15.4320, 28.3200, "lusaka"),
+    "roma": (-15.3800, 28.3150, "lusaka"),
+    "rhodes park": (-15.4050, 28.3100, "lusaka"),
+    "longacres": (-15.4080, 28.3000, "lusaka"),
+    "olympia": (-15.3900, 28.3200, "lusaka"),
+    "chelston": (-15.3700, 28.3800, "lusaka"),
+    "avondale": (-15.3750, 28.3600, "lusaka"),
+    "ibex hill": (-15.4450, 28.3650, "lusaka"),
+    "meanwood": (-15.4550, 28.3750, "lusaka"),
+    "chalala": (-15.4700, 28.3300, "lusaka"),
+    "kalingalinga": (-15.4150, 28.3300, "lusaka"),
+    "matero": (-15.3750, 28.2500, "lusaka"),
+    "chilenje": (-15.4450, 28.3050, "lusaka"),
+    "emmasdale": (-15.3850, 28.2750, "lusaka"),
+    "makeni": (-15.4600, 28.2550, "lusaka"),
+    "libala": (-15.4400, 28.3000, "lusaka"),
+    "kamwala": (-15.4300, 28.2850, "lusaka"),
+    "northmead": (-15.4000, 28.3050, "lusaka"),
+    "fairview": (-15.4100, 28.2950, "lusaka"),
+    "mass media": (-15.4120, 28.3180, "lusaka"),
+    "leopards hill": (-15.4750, 28.4200, "lusaka"),
+    "foxdale": (-15.3550, 28.3250, "lusaka"),
+    "salama park": (-15.4600, 28.3600, "lusaka"),
+    "mtendere": (-15.4100, 28.3600, "lusaka"),
+    "kabwata": (-15.4350, 28.2950, "lusaka"),
+    "bauleni": (-15.4400, 28.3500, "lusaka"),
+    "lilayi": (-15.5100, 28.3000, "lusaka"),
+    "state lodge": (-15.4800, 28.4100, "lusaka"),
+    "silverest": (-15.4000, 28.4700, "lusaka"),
+    "chudleigh": (-15.4200, 28.3250, "lusaka"),
+    "thorn park": (-15.4180, 28.2900, "lusaka"),
+    "villa elizabetta": (-15.3950, 28.2650, "lusaka"),
+    "jesmondine": (-15.4550, 28.3200, "lusaka"),
+    "chainama": (-15.3950, 28.3500, "lusaka"),
+    "kamanga": (-15.3650, 28.3950, "lusaka"),
+    "kaunda square": (-15.3850, 28.3800, "lusaka"),
+    "chamba valley": (-15.3350, 28.3300, "lusaka"),
+    "chunga": (-15.3550, 28.2400, "lusaka"),
+    "kalundu": (-15.3800, 28.3300, "lusaka"),
+}
+
+
+def normalize_place_name(text):
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", (text or "").lower()).split())
+
+
+def find_places(text, places):
+    padded_text = f" {normalize_place_name(text)} "
+    return {name: place for name, place in places.items() if f" {name} " in padded_text}
+
+
+def geocode(location):
+    towns = find_places(location, TOWNS)
+    areas = find_places(location, AREAS)
+    if towns:
+        areas = {name: area for name, area in areas.items() if area[2] in towns}
+    # Prefer the longest (usually most specific) name when several areas or several towns are mentioned
+    for places in (areas, towns):
+        if places:
+            latitude, longitude, _ = places[max(places, key=len)]
+            return latitude, longitude
+    return None
+
+
+def upgrade():
+    op.add_column('property', sa.Column('latitude', sa.Float(), nullable=True))
+    op.add_column('property', sa.Column('longitude', sa.Float(), nullable=True))
+
+    # Geocode the existing listings. geocode() works offline so this doesn't depend on any external service.
+    connection = op.get_bind()
+    property_table = sa.table(
+        'property',
+        sa.column('id', sa.Integer),
+        sa.column('location', sa.Text),
+        sa.column('latitude', sa.Float),
+        sa.column('longitude', sa.Float),
+    )
+    update = (
+        property_table.update()
+        .where(property_table.c.id == sa.bindparam('property_id'))
+        .values(latitude=sa.bindparam('lat'), longitude=sa.bindparam('lon'))
+    )
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select([property_table.c.id, property_table.c.location])
+            .where(property_table.c.id > last_id)
+            .order_by(property_table.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+        coordinates = []
+        for row in rows:
+            latitude, longitude = geocode(row.location) or (None, None)
+            coordinates.append({'property_id': row.id, 'lat': latitude, 'lon': longitude})
+        connection.execute(update, coordinates)
+        last_id = rows[-1].id
+
+
+def downgrade():
+    op.drop_column('property', 'longitude')
+    op.drop_column('property', 'latitude')
@@ -0,0 +1,31 @@
+"""add updated_at to property and User
+
+Revision ID: c4d27e9f1a03
+Revises: 8b1e4d0a6c52
+Create Date: 2026-10-18 14:03:51.127730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d27e9f1a03'
+down_revision = '8b1e4d0a6c52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('User', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.add_column('property', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    # Existing rows haven't been changed since they were created as far as we know
+    op.execute('UPDATE "User" SET updated_at = date_registered')
+    op.execute('UPDATE property SET updated_at = date_listed')
+    op.alter_column('User', 'updated_at', nullable=False)
+    op.alter_column('property', 'updated_at', nullable=False)
+
+
+def downgrade():
+    op.drop_column('property', 'updated_at')
+    op.drop_column('User', 'updated_at')
@@ -0,0 +1,29 @@
+"""add search_outbox table
+
+Revision ID: e3b7c1d95a20
+Revises: 9a6f2c4e1b85
+Create Date: 2026-10-18 19:12:40.318205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3b7c1d95a20'
+down_revision = '9a6f2c4e1b85'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('search_outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('listing_id', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('search_outbox')
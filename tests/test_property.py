@@ -1,13 +1,24 @@
 import copy
+import html
 import json
 import os
+import re
 import time
 import botocore
+import numpy as np
+import pytest
+from PIL import Image
 from flask import current_app, url_for, g
 from flask_login import current_user
+from werkzeug.datastructures import FileStorage
 from decouple import config
-from app import db, s3
-from app.base.models import Property, User
+from app import db, s3, redis_client
+from app.base.models import Property, User, SearchOutbox, parse_price
+from app.base.utils import encode_cursor, stage_property_listing_images, listing_image_sources
+from app.images import save_derivatives, save_profile_image, IMAGE_DERIVATIVES, EXIF_ORIENTATION
+from app.uploads import open_staged_upload, discard_staged_uploads, staged_path, STAGING_BACKEND
+from app.geocoding import geocode, AREAS, TOWNS
+from app.clustering import cluster_points
 from config import IMAGE_UPLOAD_CONFIG
 from .conftest import test_user_data, property_listing_data, register_user, login_user, logout_user
 
@@ -193,6 +204,87 @@ def test_property_details(test_client):
     assert b"Update" and b"Delete Property?" not in response_3.data
 
 
+def test_listings_feed(test_client):
+    """
+    WHEN the '/index' page is requested (GET) with and without a cursor,
+    THEN assert the newest listing is on the first page, assert a cursor pointing past the listing returns an empty
+    page and assert that an invalid cursor falls back to the first page.
+    """
+    listed_property = Property.query.filter_by(name=property_listing_data["name"]).first()
+
+    response = test_client.get("/index")
+    assert response.status_code == 200
+    assert listed_property.name.encode() in response.data
+
+    cursor = encode_cursor((listed_property.date_listed, listed_property.id))
+    response_2 = test_client.get(f"/index?cursor={cursor}")
+    assert response_2.status_code == 200
+    assert listed_property.name.encode() not in response_2.data
+
+    response_3 = test_client.get("/index?cursor=not-a-valid-cursor")
+    assert response_3.status_code == 200
+    assert listed_property.name.encode() in response_3.data
+
+    # Cursors that decode to values of the wrong shape
+    for values in ([1], ["x", 1], (listed_property.date_listed, "1"), (listed_property.date_listed, 1, 2)):
+        response_4 = test_client.get(f"/index?cursor={encode_cursor(values)}")
+        assert response_4.status_code == 200
+        assert listed_property.name.encode() in response_4.data
+
+
+def test_listings_feed_conditional_get(test_client):
+    """
+    WHEN the '/index' page is requested (GET) again with the ETag of the previous response,
+    THEN assert the response is http 304 not modified without a body.
+    """
+    response = test_client.get("/index")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response_2 = test_client.get("/index", headers={"If-None-Match": etag})
+    assert response_2.status_code == 304
+    assert response_2.data == b""
+
+
+def test_search_outbox(test_client):
+    """
+    WHEN a listing is changed,
+    THEN assert that the change is recorded in the search outbox in the same transaction and that draining the
+    outbox applies it to the search index.
+    """
+    listing = Property.query.filter_by(name=property_listing_data["name"]).first()
+    listing.type = "Sale"
+    db.session.flush()
+    assert SearchOutbox.query.filter_by(listing_id=listing.id).count() >= 1
+    db.session.commit()
+    while SearchOutbox.drain():
+        pass
+    assert SearchOutbox.stats()["pending"] == 0
+    response = test_client.get(url_for("home_blueprint.search", q=property_listing_data["name"], type="Sale"))
+    assert property_listing_data["name"].encode() in response.data
+
+    listing.type = property_listing_data["type"]
+    db.session.commit()
+    while SearchOutbox.drain():
+        pass
+
+
+def test_bulk_reindex(test_client):
+    """
+    WHEN every listing is bulk indexed (the documents are read in a thread of parallel_bulk, outside the app
+    context),
+    THEN assert that every listing is indexed and that the checkpoint is cleared once the reindex has completed.
+    """
+    if current_app.config["SEARCH_BACKEND"] != "elasticsearch":
+        pytest.skip("bulk indexing only applies to the elasticsearch search backend")
+    from app.search.elasticsearch_backend import bulk_index_existing_data, REINDEX_CHECKPOINT_KEY
+
+    summary = bulk_index_existing_data(Property, batch_size=1, thread_count=2, checkpoint_store=redis_client)
+    assert summary["failed"] == 0
+    assert summary["indexed"] == Property.query.count()
+    assert redis_client.get(REINDEX_CHECKPOINT_KEY) is None
+
+
 def test_search_listing(test_client):
     """
     WHEN the '/delete-listing/<id>' page is requested (GET),
@@ -204,6 +296,225 @@ def test_search_listing(test_client):
     assert response.status_code == 200
     assert b"Affordable Apartments on rent" and b"Apartments for rent at an affordable price." in response.data
 
+    # Cursors with sort values of the wrong shape fall back to the first page
+    for values in (("after", 2, None, "x", 1), ("after", 2, None, 1.5), ("after", 2, None, 1.5, 1, 2), ("after",)):
+        response_2 = test_client.get(
+            url_for("home_blueprint.search", q=g.search_form.q.data, cursor=encode_cursor(values))
+        )
+        assert response_2.status_code == 200
+        assert property_listing_data["name"].encode() in response_2.data
+
+
+def test_search_pagination(test_client):
+    """
+    WHEN the search results span several pages (searched against a point in time from the second page on),
+    THEN assert that following the next links reaches every page once and that the previous links lead back.
+    """
+    user = User.query.filter_by(email=test_user_data["email"]).first()
+    listings = [
+        Property.add_property(
+            dict(
+                name=f"Paginated cottage {number}",
+                desc="A cottage listed to test the pages of search results.",
+                price="Negotiable",
+                images_folder="5de13ba062fa4/",
+                photos=json.dumps(["5de13ba062fa4/", "79cff318.jpg"]),
+                location="Kabulonga",
+                type="Rent",
+                user_id=user.id,
+            )
+        )
+        for number in range(3)
+    ]
+    while SearchOutbox.drain():
+        pass
+
+    def page_links(response):
+        links = re.findall(r'class="btn btn-primary[^"]*" href="([^"]*)"', response.get_data(as_text=True))
+        prev_url, next_url = links
+        return html.unescape(prev_url), html.unescape(next_url)
+
+    def page_names(response):
+        return {listing.name for listing in listings if listing.name.encode() in response.data}
+
+    per_page = current_app.config["RESULTS_PER_PAGE"]
+    current_app.config["RESULTS_PER_PAGE"] = 1
+    try:
+        pages = [test_client.get(url_for("home_blueprint.search", q="paginated cottage"))]
+        for _ in range(2):
+            pages.append(test_client.get(page_links(pages[-1])[1]))
+        assert [response.status_code for response in pages] == [200, 200, 200]
+        names = [page_names(response) for response in pages]
+        assert all(len(page) == 1 for page in names)
+        assert set.union(*names) == {listing.name for listing in listings}
+        assert page_links(pages[-1])[1] == "#"  # the last page
+
+        previous_page = test_client.get(page_links(pages[2])[0])
+        assert page_names(previous_page) == names[1]
+        assert page_names(test_client.get(page_links(previous_page)[0])) == names[0]
+    finally:
+        current_app.config["RESULTS_PER_PAGE"] = per_page
+        for listing in listings:
+            Property.delete_property(listing)
+        while SearchOutbox.drain():
+            pass
+
+
+def test_search_filters(test_client):
+    """
+    WHEN the '/search/' page is requested (GET) with type and price filters,
+    THEN assert the listing is found only when it matches the filters and that the facet counts and the chips of the
+    filters in use are shown.
+    """
+    search_term = property_listing_data["name"]
+    response = test_client.get(url_for("home_blueprint.search", q=search_term, type="Rent"))
+    assert response.status_code == 200
+    assert property_listing_data["name"].encode() in response.data
+    assert b"Rent &times;" in response.data
+
+    response_2 = test_client.get(url_for("home_blueprint.search", q=search_term, type="Sale"))
+    assert property_listing_data["name"].encode() not in response_2.data
+    assert b"Rent</a>" in response_2.data  # the type facet still offers the listing's type
+
+    # A "Negotiable" price has no amount so it is left out when filtering by price
+    response_3 = test_client.get(url_for("home_blueprint.search", q=search_term, max_price=5000))
+    assert property_listing_data["name"].encode() not in response_3.data
+
+
+def test_map_markers(test_client):
+    """
+    WHEN the '/search/map-markers' endpoint is requested (GET) with a bounding box and zoom level,
+    THEN assert the response is JSON holding the markers and that a malformed bounding box is rejected.
+    """
+    response = test_client.get(
+        url_for("home_blueprint.map_markers", bbox="21.9,-18.1,33.7,-8.2", zoom=6)
+    )
+    assert response.status_code == 200
+    assert isinstance(response.get_json()["markers"], list)
+
+    response_2 = test_client.get(url_for("home_blueprint.map_markers", bbox="21.9,-18.1", zoom=6))
+    assert response_2.status_code == 400
+
+
+def test_geocode():
+    assert geocode("Plot 5, Kabulonga, Lusaka") == AREAS["kabulonga"][:2]
+    assert geocode("Woodlands, Kitwe") == TOWNS["kitwe"][:2]
+    assert geocode("my location") is None
+
+
+def test_cluster_points():
+    """
+    Assert that nearby points are merged into one cluster at their centroid when the map is zoomed out, split when
+    it is zoomed in, and that points outside the map are left out.
+    """
+    ids = np.array([1, 2, 3, 4], dtype=np.int32)
+    latitudes = np.array([-15.425, -15.432, -12.8024, 10.0], dtype=np.float32)
+    longitudes = np.array([28.34, 28.32, 28.2132, 10.0], dtype=np.float32)
+    zambia = (21.9, -18.1, 33.7, -8.2)
+
+    clusters = sorted(cluster_points(ids, latitudes, longitudes, zambia, 6), key=lambda c: c["count"])
+    assert [cluster["count"] for cluster in clusters] == [1, 2]
+    assert clusters[0]["listing_id"] == 3
+    assert abs(clusters[1]["lat"] - -15.4285) < 0.001
+
+    assert len(cluster_points(ids, latitudes, longitudes, zambia, 14)) == 3
+
+
+def test_upload_staging():
+    """
+    Assert that staged uploads are read back unchanged and deleted once discarded, and that a staging key can't
+    point outside of the spool directory.
+    """
+    with open("./tests/imgs_for_testing_listings/img-1.jpg", "rb") as image_file:
+        image_data = image_file.read()
+        image_file.seek(0)
+        images_folder, image_filenames = stage_property_listing_images([FileStorage(image_file, "img-1.jpg")])
+    assert image_filenames[0].endswith(".jpg")
+    key = f"{images_folder}/{image_filenames[0]}"
+    with open_staged_upload(key) as staged_image:
+        assert staged_image.read() == image_data
+    discard_staged_uploads(key)
+
+    if STAGING_BACKEND == "filesystem":
+        assert not staged_path(key).parent.exists()
+        with pytest.raises(ValueError):
+            staged_path("../config.py")
+
+
+def store_in(directory):
+    """
+    Returns a store callable for app.images that writes the encoded images to directory.
+    """
+    def store(image_file, filename):
+        (directory / filename).write_bytes(image_file.getvalue())
+    return store
+
+
+def test_save_derivatives(test_client, tmp_path):
+    """
+    Assert that an image is resized into every derivative size, in its own format and as WebP, and that the
+    srcsets of the image list the resized files.
+    """
+    with open("./tests/imgs_for_testing_listings/img-1.jpg", "rb") as image_file:
+        variants = save_derivatives(image_file, "79cff318.jpg", store_in(tmp_path))
+    assert list(variants) == list(IMAGE_DERIVATIVES)
+    assert variants["full"]["filename"] == "79cff318.jpg"
+    for derivative, (max_width, max_height) in IMAGE_DERIVATIVES.items():
+        variant = variants[derivative]
+        assert variant["width"] <= max_width and variant["height"] <= max_height
+        assert (tmp_path / variant["filename"]).exists() and (tmp_path / variant["webp"]).exists()
+    assert variants["thumb"]["width"] < variants["card"]["width"] < variants["full"]["width"]
+
+    image = listing_image_sources("app_server_storage", "5de13ba062fa4/", "79cff318.jpg", variants)
+    assert image["url"].endswith("/5de13ba062fa4/79cff318.jpg")
+    assert f"/5de13ba062fa4/79cff318_thumb.webp {variants['thumb']['width']}w" in image["webp_srcset"]
+    assert f"/5de13ba062fa4/79cff318_card.jpg {variants['card']['width']}w" in image["srcset"]
+    assert listing_image_sources("app_server_storage", "5de13ba062fa4/", "79cff318.jpg", None)["srcset"] is None
+
+
+def test_resize_rotated_photo(tmp_path):
+    """
+    Assert that a photo taken with the phone held upright is decoded at a reduced size, rotated to its EXIF
+    orientation and saved without its EXIF data.
+    """
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = 6  # rotated 90 degrees clockwise
+    Image.new("RGB", (3200, 2400), "white").save(tmp_path / "upload.jpg", exif=exif.tobytes())
+
+    variants = save_derivatives(tmp_path / "upload.jpg", "79cff318.jpg", store_in(tmp_path))
+    assert (variants["full"]["width"], variants["full"]["height"]) == (600, 800)
+    save_profile_image(tmp_path / "upload.jpg", "profile.jpg", store_in(tmp_path))
+    for filename in ("79cff318.jpg", variants["thumb"]["webp"], "profile.jpg"):
+        with Image.open(tmp_path / filename) as image:
+            assert image.height > image.width
+            assert EXIF_ORIENTATION not in image.getexif()
+
+
+def test_parse_price():
+    assert parse_price("K2,500") == 2500
+    assert parse_price("ZMW 1.2m") == 1200000
+    assert parse_price("3 bedroomed house, K4 500 per month") == 4500
+    assert parse_price("Negotiable") is None
+    assert parse_price("K2,500 m") == 2500000000
+    # Amounts that don't fit in Property.price_amount
+    assert parse_price("Call 0977123456789") is None
+    assert parse_price("K" + "9" * 30) is None
+    assert parse_price("K" + "9" * 49) is None
+
+
+def test_search_suggestions(test_client):
+    """
+    WHEN the '/search/suggest' endpoint is requested (GET) with the beginning of a word of a listing name,
+    THEN assert the response is JSON containing the name of the listing and that a prefix shorter than two characters
+    returns no suggestions.
+    """
+    response = test_client.get(url_for("home_blueprint.search_suggestions", q="apart"))
+    assert response.status_code == 200
+    assert property_listing_data["name"] in response.get_json()["suggestions"]
+
+    response_2 = test_client.get(url_for("home_blueprint.search_suggestions", q="a"))
+    assert response_2.get_json()["suggestions"] == []
+
 
 def test_deleting_property(test_client):
     """
@@ -0,0 +1,96 @@
+from datetime import datetime
+from app.search.drift import diff_document_hashes
+from app.search.memory_backend import InvertedIndex, filter_predicates, within_one_edit
+
+
+def make_document(listing_id, name, desc, location, type="Rent", price_amount=None, geo_location=None):
+    name_words = name.split()
+    return {
+        "id": listing_id,
+        "name": name,
+        "desc": desc,
+        "desc_excerpt": desc[:100],
+        "location": location,
+        "price": str(price_amount or "Negotiable"),
+        "price_amount": price_amount,
+        "geo_location": geo_location,
+        "type": type,
+        "owner": "johndoe",
+        "date_listed": datetime(2021, 6, listing_id),
+        "updated_at": datetime(2021, 6, listing_id),
+        "cover_photo_location": None,
+        "cover_photo_path": None,
+        "cover_photo_variants": None,
+        "suggest": {"input": [" ".join(name_words[i:]) for i in range(len(name_words))] + [location]},
+    }
+
+
+def build_index():
+    index = InvertedIndex()
+    index.add(
+        make_document(1, "Affordable Apartments on rent", "Apartments for rent.", "Kabulonga", price_amount=2500)
+    )
+    index.add(make_document(2, "Family house", "Four bedroomed house.", "Ndola", type="Sale", price_amount=900000))
+    index.add(make_document(3, "Apartment in Roma", "A small apartment.", "Roma, Lusaka", price_amount=4000))
+    return index
+
+
+def test_within_one_edit():
+    assert within_one_edit("apartment", "apartments")
+    assert within_one_edit("house", "hoase")
+    assert within_one_edit("house", "hosue")
+    assert not within_one_edit("apartmnt", "apartments")
+
+
+def test_inverted_index_search():
+    """
+    Assert that searches are fuzzy, that the exact word scores higher than a near miss and that removed documents
+    are no longer found.
+    """
+    index = build_index()
+    scores = index.score("apartment")
+    assert set(scores) == {1, 3}
+    assert scores[3] > scores[1]
+    assert set(index.score("hoose")) == {2}
+
+    index.remove(3)
+    assert set(index.score("apartment")) == {1}
+    assert "roma" not in index.fuzzy_lookup
+
+
+def test_inverted_index_facets_and_suggestions():
+    index = build_index()
+    predicates = filter_predicates({"max_price": 3000})
+    facets = index.facets(index.documents, predicates)
+    assert facets["type"] == [{"value": "Rent", "count": 1}]
+    # The price facet isn't narrowed by the price filter
+    assert {"value": [100000, 1000000], "count": 1} in facets["price"]
+
+    assert index.complete("apart", 8) == ["Apartment in Roma", "Affordable Apartments on rent"]
+    assert index.complete("ndo", 8) == ["Ndola"]
+
+
+def test_price_range_boundaries():
+    """
+    Assert that a listing priced on the boundary of two price ranges is counted in the range it is found by.
+    """
+    index = InvertedIndex()
+    index.add(make_document(4, "Cottage", "A cottage.", "Roma", price_amount=5000))
+    facets = index.facets(index.documents, filter_predicates({}))
+    assert facets["price"] == [{"value": [5000, 10000], "count": 1}]
+    for (low, high), found in (((2500, 5000), False), ((5000, 10000), True)):
+        predicate = filter_predicates({"min_price": low, "max_price": high})["price"]
+        assert predicate(index.documents[4]) is found
+
+
+def test_diff_document_hashes():
+    database_hashes = [(1, "a"), (2, "b"), (4, "d"), (6, "f")]
+    index_hashes = [(2, "b"), (3, "c"), (4, "x"), (5, "e")]
+    assert list(diff_document_hashes(database_hashes, index_hashes)) == [
+        (1, "missing"),
+        (3, "orphaned"),
+        (4, "stale"),
+        (5, "orphaned"),
+        (6, "missing"),
+    ]
+    assert list(diff_document_hashes([], index_hashes[:1])) == [(2, "orphaned")]
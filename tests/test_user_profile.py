@@ -96,6 +96,12 @@ def test_login(test_client):
     assert b"Create Property" and b"My Listings" in response.data
     assert b"My Profile" and b"Logout" in response.data
 
+    # The password hash isn't cached with the rest of the user, it is loaded when needed
+    user = User.query.filter_by(username=test_user_data["username"]).first()
+    assert "password" not in User.cached_principal(user.id)
+    cached_user = User.from_cached_principal(User.cached_principal(user.id))
+    assert check_password_hash(cached_user.password, test_user_data["password"])
+
 
 def test_user_unverified_email(test_client):
     """